@@ -3,14 +3,22 @@ import json
 import logging
 import os
 from pathlib import Path
+import signal
 import time
 import uuid
 from aiohttp import web, WSMsgType
 from typing import Dict, Any
 
 from server.api_core import VideoGenerationAPI
-from server.api_session import SessionManager
+from server.api_session import SessionManager, dispatch_metrics
 from server.api_metrics import MetricsTracker
+from server.ws_codec import CODECS, get_codec, send_message
+from server.outbound import OutboundMetrics, OutboundQueue
+from server.drain import DrainController
+from server.liveness import SessionReaper
+from server.shared_state import shared_state
+from server.workers import run_workers
+from server.llm_utils import llm_metrics, llm_provider_router
 from server.api_config import *
 
 # Set up colored logging
@@ -21,12 +29,41 @@ logger = get_logger(__name__)
 
 # Create global session and metrics managers
 session_manager = SessionManager()
-metrics_tracker = MetricsTracker()
+metrics_tracker = MetricsTracker(shared_state)
+outbound_metrics = OutboundMetrics(window=DISPATCH_METRICS_WINDOW_SECONDS)
+
+def exit_process():
+    """Exit once drained, through the graceful shutdown of aiohttp (which handles SIGINT)"""
+    os.kill(os.getpid(), signal.SIGINT)
+
+session_reaper = SessionReaper(
+    session_manager, metrics_tracker,
+    idle_timeout=WS_IDLE_TIMEOUT_SECONDS,
+    interval=WS_REAP_INTERVAL_SECONDS,
+    metrics_retention=METRICS_USER_RETENTION_SECONDS
+)
+
+drain_controller = DrainController(
+    session_manager,
+    timeout=DRAIN_TIMEOUT_SECONDS,
+    reconnect_after=DRAIN_RECONNECT_AFTER_SECONDS,
+    on_drained=exit_process
+)
 
 # Dictionary to track connected anonymous clients by IP address
 anon_connections = {}
 anon_connection_lock = asyncio.Lock()
 
+async def track_anon_connection(client_ip: str, delta: int) -> int:
+    """Update the number of anonymous connections of an IP address, returns it (across all the workers if shared)"""
+    anon_connections[client_ip] = max(0, anon_connections.get(client_ip, 0) + delta)
+    count = anon_connections[client_ip]
+    if not count:
+        del anon_connections[client_ip]
+    if shared_state is not None:
+        count = await shared_state.request('gauge', key=f'anon:{client_ip}', delta=delta)
+    return count
+
 async def status_handler(request: web.Request) -> web.Response:
     """Handler for API status endpoint"""
     api = session_manager.shared_api
@@ -57,11 +94,19 @@ async def status_handler(request: web.Request) -> web.Response:
         'endpoint_status': endpoint_statuses,
         'active_endpoints': sum(1 for ep in endpoint_statuses if not ep['busy'] and ('error_until' not in ep or ep['error_until'] < time.time())),
         'active_sessions': session_stats,
+        'caches': api.get_cache_stats(),
+        'admission': api.admission.get_stats(),
+        'drain': drain_controller.get_stats(),
+        'liveness': session_reaper.get_stats(),
+        'worker': {
+            'pid': os.getpid(),
+            'shared_state': shared_state.get_stats() if shared_state is not None else None
+        },
         'metrics': api_metrics
     })
 
-async def metrics_handler(request: web.Request) -> web.Response:
-    """Handler for detailed metrics endpoint (protected)"""
+def is_authorized(request: web.Request) -> bool:
+    """Check the API key of a protected endpoint"""
     # Check for API key in header or query param
     auth_header = request.headers.get('Authorization', '')
     api_key = None
@@ -72,16 +117,35 @@ async def metrics_handler(request: web.Request) -> web.Response:
         api_key = request.query.get('key')
     
     # Validate API key (using SECRET_TOKEN as the API key)
-    if not api_key or api_key != SECRET_TOKEN:
+    return bool(api_key) and api_key == SECRET_TOKEN
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    """Handler for detailed metrics endpoint (protected)"""
+    if not is_authorized(request):
         return web.json_response({
             'error': 'Unauthorized'
         }, status=401)
     
     # Get detailed metrics
     detailed_metrics = metrics_tracker.get_detailed_metrics()
+    detailed_metrics['caches'] = session_manager.shared_api.get_cache_stats(detailed=True)
+    detailed_metrics['llm_calls'] = llm_metrics.get_stats()
+    detailed_metrics['llm_providers'] = llm_provider_router.get_stats()
+    detailed_metrics['dispatch'] = dispatch_metrics.get_stats()
+    detailed_metrics['outbound'] = outbound_metrics.get_stats()
     
     return web.json_response(detailed_metrics)
 
+async def drain_handler(request: web.Request) -> web.Response:
+    """Handler for the drain endpoint (protected): drain the server then exit, before a deploy"""
+    if not is_authorized(request):
+        return web.json_response({
+            'error': 'Unauthorized'
+        }, status=401)
+    
+    drain_controller.start('admin')
+    return web.json_response(drain_controller.get_stats(), status=202)
+
 async def websocket_handler(request: web.Request) -> web.WebSocketResponse:
     # Check if maintenance mode is enabled
     if MAINTENANCE_MODE:
@@ -91,21 +155,51 @@ async def websocket_handler(request: web.Request) -> web.WebSocketResponse:
             'maintenance': True
         }, status=503)  # 503 Service Unavailable
     
+    # Get the Hugging Face token from query parameters
+    hf_token = request.query.get('hf_token', '')
+    
+    # Validate the token and determine the user role
+    user_role = await session_manager.shared_api.validate_user_token(hf_token)
+    
+    # A client which lost its connection may resume its session (its requests kept running)
+    resume_token = request.query.get('session_token', '')
+    resumable_session = session_manager.get_resumable_session(resume_token, user_role) if resume_token else None
+    
+    # Shed new sessions (before accepting the WebSocket) when the server is overloaded or draining
+    admission = session_manager.shared_api.admission
+    retry_after = admission.admit_session(user_role, resuming=resumable_session is not None)
+    if retry_after is not None:
+        logger.warning(f"Server {'draining' if admission.draining else 'overloaded'}, rejecting session "
+                       f"with role {user_role} (retry after {retry_after}s)")
+        return web.json_response({
+            'error': 'Server is restarting' if admission.draining else 'Server is busy',
+            'busy': True,
+            'draining': admission.draining,
+            'retry_after': retry_after
+        }, status=503, headers={'Retry-After': str(retry_after)})
+    
     ws = web.WebSocketResponse(
         max_msg_size=1024*1024*20,  # 20MB max message size
-        timeout=30.0  # we want to keep things tight and short
+        timeout=30.0,  # we want to keep things tight and short
+        heartbeat=WS_HEARTBEAT_SECONDS or None,  # ping the client, and close the connection if it stops answering
+        protocols=tuple(CODECS)  # clients may pick their codec as the subprotocol
     )
     
     await ws.prepare(request)
     
-    # Get the Hugging Face token from query parameters
-    hf_token = request.query.get('hf_token', '')
-    
-    # Generate a unique user ID for this connection
-    user_id = str(uuid.uuid4())
+    # Encode the messages of this connection with the codec picked by the client
+    ws.codec = get_codec(request.query.get('codec') or ws.ws_protocol, WS_DEFAULT_CODEC)
+    # All the messages to this connection go through a single writer
+    ws.outbox = OutboundQueue(
+        ws, outbound_metrics,
+        max_messages=WS_OUTBOX_MAX_MESSAGES,
+        max_bytes=WS_OUTBOX_MAX_BYTES,
+        policy=WS_SLOW_CONSUMER_POLICY,
+        send_timeout=WS_SEND_TIMEOUT_SECONDS
+    )
     
-    # Validate the token and determine the user role
-    user_role = await session_manager.shared_api.validate_user_token(hf_token)
+    # Generate a unique user ID for this connection (or keep the one of the resumed session)
+    user_id = resumable_session.user_id if resumable_session else str(uuid.uuid4())
     logger.info(f"User {user_id} connected with role: {user_role}")
     
     # Get client IP address
@@ -121,13 +215,13 @@ async def websocket_handler(request: web.Request) -> web.WebSocketResponse:
     if user_role == 'anon':
         async with anon_connection_lock:
             # Track this connection
-            anon_connections[client_ip] = anon_connections.get(client_ip, 0) + 1
+            connection_count = await track_anon_connection(client_ip, 1)
             # Store the IP so we can clean up later
             ws.client_ip = client_ip
             
             # Log multiple connections from same IP but don't restrict them
-            if anon_connections[client_ip] > 1:
-                logger.info(f"Multiple anonymous connections from IP {client_ip}: {anon_connections[client_ip]} connections")
+            if connection_count > 1:
+                logger.info(f"Multiple anonymous connections from IP {client_ip}: {connection_count} connections")
     
     # Store the user role in the websocket for easy access
     ws.user_role = user_role
@@ -136,33 +230,38 @@ async def websocket_handler(request: web.Request) -> web.WebSocketResponse:
     # Register with metrics
     metrics_tracker.register_session(user_id, client_ip)
     
-    # Create a new session for this user
-    user_session = await session_manager.create_session(user_id, user_role, ws)
+    # Resume the session of this user, or create a new one
+    user_session = None
+    if resumable_session is not None:
+        user_session = await session_manager.resume_session(resume_token, user_role, ws)
+    if user_session is None:
+        user_session = await session_manager.create_session(user_id, user_role, ws)
+    
+    if user_session.resume_token:
+        await send_message(ws, {
+            'action': 'session',
+            'session_token': user_session.resume_token,
+            'resumed': user_session is resumable_session,
+            'resume_grace_seconds': SESSION_RESUME_GRACE_SECONDS
+        })
 
     try:
         async for msg in ws:
-            if msg.type == WSMsgType.TEXT:
+            if msg.type in (WSMsgType.TEXT, WSMsgType.BINARY):
+                user_session.last_activity = time.time()
                 try:
-                    data = json.loads(msg.data)
+                    data = ws.codec.decode(msg.data)
                     action = data.get('action')
                     
                     # Check for rate limiting
-                    request_type = 'other'
-                    if action in ['join_chat', 'leave_chat', 'chat_message']:
-                        request_type = 'chat'
-                    elif action in ['generate_video']:
-                        request_type = 'video'
-                    elif action == 'search':
-                        request_type = 'search'
-                    elif action == 'simulate':
-                        request_type = 'simulation'
+                    request_type = user_session.get_request_type(action)
                     
                     # Record the request for metrics
                     await metrics_tracker.record_request(user_id, client_ip, request_type, user_role)
                     
                     # Check rate limits (except for admins)
                     if user_role != 'admin' and await metrics_tracker.is_rate_limited(user_id, request_type, user_role):
-                        await ws.send_json({
+                        await send_message(ws, {
                             'action': action,
                             'requestId': data.get('requestId'),
                             'success': False,
@@ -170,23 +269,12 @@ async def websocket_handler(request: web.Request) -> web.WebSocketResponse:
                         })
                         continue
                     
-                    # Route requests to appropriate queues
-                    if action in ['join_chat', 'leave_chat', 'chat_message']:
-                        await user_session.chat_queue.put(data)
-                    elif action in ['generate_video']:
-                        request_id = data.get('requestId', 'unknown')
-                        #logger.info(f"[{request_id}] Received generate_video request from user {user_id}, adding to video queue")
-                        await user_session.video_queue.put(data)
-                    elif action == 'search':
-                        await user_session.search_queue.put(data)
-                    elif action == 'simulate':
-                        await user_session.simulation_queue.put(data)
-                    else:
-                        await user_session.process_generic_request(data)
+                    # Run the request, or queue it in its lane
+                    await user_session.dispatch(data)
                         
                 except Exception as e:
                     logger.error(f"Error processing WebSocket message for user {user_id}: {str(e)}")
-                    await ws.send_json({
+                    await send_message(ws, {
                         'action': data.get('action') if 'data' in locals() else 'unknown',
                         'success': False,
                         'error': f'Error processing message: {str(e)}'
@@ -196,18 +284,22 @@ async def websocket_handler(request: web.Request) -> web.WebSocketResponse:
                 break
                 
     finally:
-        # Cleanup session
-        await session_manager.delete_session(user_id)
+        # aiohttp closes the connection when a pong doesn't come back (the client or its network is gone)
+        if isinstance(ws.exception(), asyncio.TimeoutError) and user_session.ws is ws:
+            logger.info(f"User {user_id} missed a pong, releasing its session")
+            session_reaper.record_missed_pong(user_session)
+        
+        # Cleanup session (or keep it for a while, so the client can resume it)
+        await session_manager.release_session(user_id, ws)
+        ws.outbox.close()
         
         # Cleanup anonymous connection tracking
         if getattr(ws, 'user_role', None) == 'anon' and hasattr(ws, 'client_ip'):
             client_ip = ws.client_ip
             async with anon_connection_lock:
                 if client_ip in anon_connections:
-                    anon_connections[client_ip] = max(0, anon_connections[client_ip] - 1)
-                    if anon_connections[client_ip] == 0:
-                        del anon_connections[client_ip]
-                    logger.info(f"Anonymous connection from {client_ip} closed. Remaining: {anon_connections.get(client_ip, 0)}")
+                    remaining = await track_anon_connection(client_ip, -1)
+                    logger.info(f"Anonymous connection from {client_ip} closed. Remaining: {remaining}")
         
         # Unregister from metrics
         metrics_tracker.unregister_session(user_id, client_ip)
@@ -220,10 +312,33 @@ async def init_app() -> web.Application:
         client_max_size=1024**2*20  # 20MB max size
     )
     
+    # Start the background tasks of the shared API (cache refills etc)
+    async def startup(app):
+        # Workers of the multi-process mode share their state through the supervisor
+        if shared_state is not None:
+            await shared_state.connect()
+        await session_manager.shared_api.start_background_tasks()
+        # Stopped with the other background tasks of the shared API
+        session_manager.shared_api.background_tasks.append(asyncio.create_task(session_reaper.run()))
+        
+        # Drain on SIGTERM (sent on deploys) instead of dropping the running requests
+        if DRAIN_ON_SIGTERM:
+            try:
+                asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, drain_controller.start, 'SIGTERM')
+            except (NotImplementedError, RuntimeError):
+                logger.warning("Signal handlers not supported, SIGTERM won't drain the server")
+    
+    app.on_startup.append(startup)
+    
     # Add cleanup logic
     async def cleanup(app):
-        logger.info("Shutting down server, closing all sessions...")
+        # Let the running requests complete first (if not drained already), then close what is left
+        logger.info("Shutting down server, draining then closing all sessions...")
+        await drain_controller.start('shutdown', exit_when_drained=False)
         await session_manager.close_all_sessions()
+        await session_manager.shared_api.stop_background_tasks()
+        if shared_state is not None:
+            await shared_state.close()
     
     app.on_shutdown.append(cleanup)
     
@@ -231,6 +346,7 @@ async def init_app() -> web.Application:
     app.router.add_get('/ws', websocket_handler)
     app.router.add_get('/api/status', status_handler)
     app.router.add_get('/api/metrics', metrics_handler)
+    app.router.add_post('/api/drain', drain_handler)
     
     # Set up static file serving
     # Define the path to the public directory
@@ -293,6 +409,14 @@ async def init_app() -> web.Application:
     
     return app
 
-if __name__ == '__main__':
+def run_worker():
+    """Run a worker process of the multi-process mode, listening on the port shared by all the workers"""
     app = asyncio.run(init_app())
-    web.run_app(app, host='0.0.0.0', port=8080)
\ No newline at end of file
+    web.run_app(app, host='0.0.0.0', port=8080, reuse_port=True)
+
+if __name__ == '__main__':
+    if API_WORKERS > 1:
+        run_workers(run_worker, API_WORKERS)
+    else:
+        app = asyncio.run(init_app())
+        web.run_app(app, host='0.0.0.0', port=8080)
\ No newline at end of file
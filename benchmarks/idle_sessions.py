@@ -0,0 +1,85 @@
+"""
+Memory, tasks and dispatch latency of idle sessions: opens N simulated connections
+(10,000 by default), then sends a heartbeat on a sample of them. Run from the repository root with:
+
+    python benchmarks/idle_sessions.py [connections]
+"""
+import sys
+import time
+import asyncio
+import logging
+import statistics
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from server.api_session import SessionManager
+from server.outbound import OutboundMetrics, OutboundQueue
+from server.ws_codec import get_codec
+
+# Heartbeats timed (on as many different sessions)
+SAMPLE_SIZE = 1000
+
+
+class SimulatedWebSocket:
+    """Connection of a client which reads everything it gets"""
+
+    def __init__(self, outbound_metrics):
+        self.codec = get_codec('json')
+        self.outbox = OutboundQueue(self, outbound_metrics)
+        self.received = asyncio.Event()
+
+    async def send_str(self, data):
+        self.received.set()
+
+    async def send_bytes(self, data):
+        self.received.set()
+
+
+async def main(connections: int):
+    logging.disable(logging.INFO)
+    session_manager = SessionManager()
+    outbound_metrics = OutboundMetrics()
+
+    tasks_before = len(asyncio.all_tasks())
+    tracemalloc.start()
+    memory_before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    sockets = []
+    for index in range(connections):
+        ws = SimulatedWebSocket(outbound_metrics)
+        sockets.append(ws)
+        await session_manager.create_session(f'user-{index}', 'anon', ws)
+    connect_time = time.perf_counter() - started
+    memory = tracemalloc.get_traced_memory()[0] - memory_before
+    tracemalloc.stop()
+    idle_tasks = len(asyncio.all_tasks()) - tasks_before
+
+    latencies = []
+    step = max(1, connections // SAMPLE_SIZE)
+    for index in range(0, connections, step):
+        ws = sockets[index]
+        ws.received.clear()
+        started = time.perf_counter()
+        await session_manager.sessions[f'user-{index}'].dispatch({'action': 'heartbeat', 'requestId': 'heartbeat'})
+        await ws.received.wait()
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    # Lanes and writers started by the heartbeats, which should be gone once they are idle
+    await asyncio.sleep(0.1)
+    tasks_after_heartbeats = len(asyncio.all_tasks()) - tasks_before
+
+    print(f"connections:               {connections}")
+    print(f"connect time:              {connect_time:.2f}s ({connect_time / connections * 1e6:.0f}µs each)")
+    print(f"memory:                    {memory / 1024 / 1024:.1f} MiB ({memory / connections:.0f} bytes each)")
+    print(f"tasks while idle:          {idle_tasks}")
+    print(f"tasks after heartbeats:    {tasks_after_heartbeats}")
+    print(f"heartbeat latency (n={len(latencies)}): p50 {statistics.median(latencies) * 1e6:.0f}µs, "
+          f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1e6:.0f}µs")
+
+    await session_manager.close_all_sessions()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000))
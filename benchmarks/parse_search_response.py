@@ -0,0 +1,42 @@
+"""
+Microbenchmark of parse_search_response against the pipeline it replaced,
+yaml.safe_load(sanitize_yaml_response(...)), run from the repository root with:
+
+    python benchmarks/parse_search_response.py [iterations]
+"""
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import yaml
+
+from server.utils import parse_search_response, sanitize_yaml_response
+
+RESPONSES = {
+    'closed_title': 'title: "A cat surfing at sunset"\ndescription: "A tabby rides the waves"\ntags:\n  - cat\n  - surf',
+    'fenced': '```yaml\ntitle: "Robot chef"\ndescription: "A robot cooks pasta"\ntags:\n  - robot\n  - cooking\n```',
+    'nested_title': 'title: "title: "Space Cats""\ndescription: "Cats in orbit"\ntags:\n  - space',
+    'stray_closing_quote': 'Neon city"\ndescription: "Rain on neon signs"\ntags:\n  - city',
+}
+
+
+def legacy_parse(text):
+    try:
+        return yaml.safe_load(sanitize_yaml_response(text.strip()))
+    except yaml.YAMLError:
+        return None
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print(f"{'response':<22}{'yaml (µs)':>12}{'parser (µs)':>14}{'speedup':>10}")
+    for name, text in RESPONSES.items():
+        legacy = timeit.timeit(lambda: legacy_parse(text), number=iterations) / iterations * 1e6
+        parser = timeit.timeit(lambda: parse_search_response(text), number=iterations) / iterations * 1e6
+        print(f"{name:<22}{legacy:>12.1f}{parser:>14.1f}{legacy / parser:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Reconnect storm: N simulated clients (5,000 by default) connect at once, then disconnect
+while as many reconnect, as after a deploy. Reports the latency of the connects and disconnects.
+With a teardown delay, each session takes that long to stop, which must not delay the connects.
+Run from the repository root with:
+
+    python benchmarks/session_churn.py [clients] [teardown delay in seconds]
+"""
+import sys
+import time
+import asyncio
+import logging
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from server.api_session import SessionManager, UserSession
+
+
+class SimulatedWebSocket:
+    async def send_str(self, data):
+        pass
+
+    async def send_bytes(self, data):
+        pass
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(name, latencies, elapsed):
+    print(f"{name:<12} {len(latencies)} in {elapsed:.2f}s, "
+          f"p50 {percentile(latencies, 0.5) * 1e3:.2f}ms, "
+          f"p99 {percentile(latencies, 0.99) * 1e3:.2f}ms, "
+          f"max {max(latencies) * 1e3:.2f}ms")
+
+
+async def main(clients: int, teardown_delay: float):
+    logging.disable(logging.INFO)
+    if teardown_delay > 0:
+        stop = UserSession.stop
+
+        async def slow_stop(self):
+            await asyncio.sleep(teardown_delay)
+            await stop(self)
+        UserSession.stop = slow_stop
+    session_manager = SessionManager()
+
+    # Latencies are counted from when the client shows up, including the time it waits for its turn
+    async def connect(user_id):
+        issued = time.perf_counter()
+        await asyncio.sleep(0)
+        await session_manager.create_session(user_id, 'anon', SimulatedWebSocket())
+        return time.perf_counter() - issued
+
+    async def disconnect(user_id):
+        issued = time.perf_counter()
+        await asyncio.sleep(0)
+        await session_manager.delete_session(user_id)
+        return time.perf_counter() - issued
+
+    started = time.perf_counter()
+    latencies = await asyncio.gather(*(connect(f'first-{index}') for index in range(clients)))
+    report('connects', latencies, time.perf_counter() - started)
+
+    # The first clients go away while the same number come back
+    started = time.perf_counter()
+    disconnects = [asyncio.create_task(disconnect(f'first-{index}')) for index in range(clients)]
+    reconnects = [asyncio.create_task(connect(f'second-{index}')) for index in range(clients)]
+    reconnect_latencies = await asyncio.gather(*reconnects)
+    report('reconnects', reconnect_latencies, time.perf_counter() - started)
+    disconnect_latencies = await asyncio.gather(*disconnects)
+    report('disconnects', disconnect_latencies, time.perf_counter() - started)
+    print(f"sessions:    {session_manager.session_count} (closing: {session_manager.closing_sessions})")
+
+    await session_manager.close_all_sessions()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 5000,
+        float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    ))
@@ -0,0 +1,69 @@
+"""
+Microbenchmark of the WebSocket codecs: encode and decode cost per message type, and the
+encoding of a chat broadcast to many clients. Run from the repository root with:
+
+    python benchmarks/ws_codecs.py [iterations]
+"""
+import sys
+import base64
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from server.ws_codec import CODECS, BroadcastMessage
+
+# Clients in the chat room of the broadcast
+ROOM_SIZE = 100
+
+MESSAGES = {
+    'heartbeat': {'action': 'heartbeat', 'requestId': 'request-1', 'success': True, 'user_role': 'anon'},
+    'chat_message': {
+        'action': 'chat_message', 'broadcast': True, 'videoId': 'video-1',
+        'username': 'someone', 'content': 'what a strange cat 🐱', 'timestamp': '2026-01-01T00:00:00'
+    },
+    'search_result': {
+        'action': 'search', 'requestId': 'request-2', 'success': True,
+        'result': {
+            'id': 'video-2', 'title': 'A cat surfing at sunset', 'description': 'A tabby rides the waves ' * 10,
+            'tags': ['cat', 'surf', 'sunset'], 'seed': 123456, 'thumbnailUrl': ''
+        }
+    },
+    'video_response': {
+        'action': 'generate_video', 'requestId': 'request-3', 'success': True,
+        'video': 'data:video/mp4;base64,' + base64.b64encode(bytes(range(256)) * 8 * 1024).decode('ascii')
+    },
+}
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print(f"codecs: {', '.join(CODECS)}")
+    print(f"{'message':<16}{'codec':<10}{'size':>10}{'encode (µs)':>14}{'decode (µs)':>14}")
+    for name, message in MESSAGES.items():
+        # the big messages are slow enough with fewer iterations
+        number = max(1, iterations // 20) if name == 'video_response' else iterations * 10
+        for codec in CODECS.values():
+            data = codec.encode(message)
+            encode = timeit.timeit(lambda: codec.encode(message), number=number) / number * 1e6
+            decode = timeit.timeit(lambda: codec.decode(data), number=number) / number * 1e6
+            print(f"{name:<16}{codec.name:<10}{len(data):>10}{encode:>14.1f}{decode:>14.1f}")
+
+    print(f"\nchat broadcast to {ROOM_SIZE} clients, per broadcast:")
+    message = MESSAGES['chat_message']
+    for codec in CODECS.values():
+        def per_client():
+            for _ in range(ROOM_SIZE):
+                codec.encode(message)
+
+        def once():
+            broadcast = BroadcastMessage(message)
+            for _ in range(ROOM_SIZE):
+                broadcast.encode(codec)
+        encode_each = timeit.timeit(per_client, number=iterations) / iterations * 1e6
+        encode_once = timeit.timeit(once, number=iterations) / iterations * 1e6
+        print(f"{codec.name:<10}encoded per client {encode_each:>8.1f}µs, encoded once {encode_once:>8.1f}µs")
+
+
+if __name__ == '__main__':
+    main()
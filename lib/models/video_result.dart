@@ -19,6 +19,10 @@ class VideoResult {
   final String evolvedDescription;
   final String condensedHistory;
 
+  // Handle of the story kept by the server for this video's simulation,
+  // sent back with each simulate call so the server doesn't need our history
+  final String storyId;
+
   final int views;
   final String createdAt;
 
@@ -34,6 +38,7 @@ class VideoResult {
     this.seed = 0,
     this.evolvedDescription = '',
     this.condensedHistory = '',
+    this.storyId = '',
     this.views = 0,
     String? createdAt,
   }) : id = id ?? const Uuid().v4(),
@@ -52,6 +57,7 @@ class VideoResult {
       seed: json['seed'] as int? ?? 0,
       evolvedDescription: json['evolvedDescription'] as String? ?? '',
       condensedHistory: json['condensedHistory'] as String? ?? '',
+      storyId: json['storyId'] as String? ?? '',
       views: json['views'] as int? ?? 0,
       createdAt: json['createdAt'] as String?,
     );
@@ -69,6 +75,7 @@ class VideoResult {
     'seed': seed,
     'evolvedDescription': evolvedDescription,
     'condensedHistory': condensedHistory,
+    'storyId': storyId,
     'views': views,
     'createdAt': createdAt,
   };
@@ -86,6 +93,7 @@ class VideoResult {
     int? seed,
     String? evolvedDescription,
     String? condensedHistory,
+    String? storyId,
     int? views,
     String? createdAt,
   }) {
@@ -101,6 +109,7 @@ class VideoResult {
       seed: seed ?? this.seed,
       evolvedDescription: evolvedDescription ?? this.evolvedDescription,
       condensedHistory: condensedHistory ?? this.condensedHistory,
+      storyId: storyId ?? this.storyId,
       views: views ?? this.views,
       createdAt: createdAt ?? this.createdAt,
     );
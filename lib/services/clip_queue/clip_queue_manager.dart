@@ -293,11 +293,13 @@ class ClipQueueManager {
           condensedHistory: video.condensedHistory,
           evolutionCount: _evolutionCounter,
           chatMessages: chatMessagesString,
+          storyId: video.storyId,
         );
         
         // Update the video with the evolved description
         final newEvolvedDescription = result['evolved_description'] as String;
         final newCondensedHistory = result['condensed_history'] as String;
+        final newStoryId = result['story_id'] as String;
         
         // debugPrint('SIMULATION: Received evolved description (${newEvolvedDescription.length} chars)');
         // debugPrint('SIMULATION: First 100 chars: ${newEvolvedDescription.substring(0, min(100, newEvolvedDescription.length))}...');
@@ -305,6 +307,7 @@ class ClipQueueManager {
         video = video.copyWith(
           evolvedDescription: newEvolvedDescription,
           condensedHistory: newCondensedHistory,
+          storyId: newStoryId,
         );
         
         _evolutionCounter++;
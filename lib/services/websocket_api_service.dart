@@ -1378,6 +1378,9 @@ class WebSocketApiService {
   }
 
   /// Simulate a video by evolving its description to create a dynamic narrative
+  ///
+  /// The server keeps the story of the video: the returned 'story_id' must be
+  /// passed back as [storyId] on the next call (the other story fields are then ignored)
   Future<Map<String, String>> simulate({
     required String videoId,
     required String originalTitle,
@@ -1386,13 +1389,15 @@ class WebSocketApiService {
     required String condensedHistory,
     int evolutionCount = 0,
     String chatMessages = '',
+    String storyId = '',
   }) async {
     // Skip if the API is not connected
     if (!isConnected) {
       debugPrint('WebSocketApiService: Cannot simulate video, not connected');
       return {
         'evolved_description': currentDescription,
-        'condensed_history': condensedHistory
+        'condensed_history': condensedHistory,
+        'story_id': storyId
       };
     }
 
@@ -1445,6 +1450,7 @@ class WebSocketApiService {
             'condensed_history': condensedHistory,
             'evolution_count': evolutionCount,
             'chat_messages': formattedChatMessages,
+            if (storyId.isNotEmpty) 'story_id': storyId,
             'llm_config': {
               'provider': llmProvider,
               'model': llmModel,
@@ -1463,18 +1469,22 @@ class WebSocketApiService {
 
       final evolvedDescription = response['evolved_description'] as String? ?? currentDescription;
       final newHistory = response['condensed_history'] as String? ?? condensedHistory;
+      // a new handle is returned if our story was evicted from the server
+      final newStoryId = response['story_id'] as String? ?? storyId;
       
       // debugPrint('WebSocketApiService: Simulation successful, received ${evolvedDescription.length} chars for evolved description');
       
       return {
         'evolved_description': evolvedDescription,
-        'condensed_history': newHistory
+        'condensed_history': newHistory,
+        'story_id': newStoryId
       };
     } catch (e) {
       debugPrint('WebSocketApiService: Error simulating video: $e');
       return {
         'evolved_description': currentDescription,
-        'condensed_history': condensedHistory
+        'condensed_history': condensedHistory,
+        'story_id': storyId
       };
     }
   }
@@ -0,0 +1,135 @@
+"""
+Admission control: new sessions and generation requests are shed (with a retry-after)
+when the server is overloaded, so most users get good service instead of all users getting slow service.
+"""
+import math
+import time
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionController:
+    """
+    Estimates the load of the server as the highest of:
+    - the in-flight endpoint generations (of all the workers) over the capacity of the available endpoints
+    - the event loop lag over max_loop_lag
+
+    Each role has a load threshold (None or no threshold means never shed). Above it, new sessions
+    are rejected, and generation requests are deferred up to defer_timeout, then rejected.
+    While the server drains, everything new is rejected whatever the load.
+    """
+
+    def __init__(self, endpoint_manager, thresholds: Dict[str, Optional[float]], generations_per_endpoint: float = 2.0,
+                 max_loop_lag: float = 0.5, defer_timeout: float = 5.0, retry_after: float = 5.0,
+                 lag_interval: float = 0.5):
+        self.endpoint_manager = endpoint_manager
+        self.thresholds = thresholds
+        self.generations_per_endpoint = generations_per_endpoint
+        self.max_loop_lag = max_loop_lag
+        self.defer_timeout = defer_timeout
+        self.retry_after = retry_after
+        self.lag_interval = lag_interval
+        self.loop_lag = 0.0
+        self.draining = False
+        # Notified after each loop lag measure, so deferred requests can check the load again
+        self.load_updated = asyncio.Condition()
+
+        # Statistics: decision counts per kind ('sessions', 'requests') and role
+        self.decisions: Dict[str, Dict[str, Dict[str, int]]] = {
+            'sessions': defaultdict(lambda: defaultdict(int)),
+            'requests': defaultdict(lambda: defaultdict(int))
+        }
+
+    async def monitor_loop_lag(self) -> None:
+        """Measure how late the event loop wakes up a sleeping task (runs as a background task)"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            lag = max(0.0, loop.time() - started - self.lag_interval)
+            # React to spikes right away, but decay slowly
+            self.loop_lag = lag if lag > self.loop_lag else 0.7 * self.loop_lag + 0.3 * lag
+            async with self.load_updated:
+                self.load_updated.notify_all()
+
+    def get_load(self) -> Dict[str, Any]:
+        """Get the current load of the server and the signals it is made of"""
+        endpoints = self.endpoint_manager.endpoints
+        current_time = time.time()
+        available = sum(1 for ep in endpoints if current_time > ep.error_until)
+        busy = sum(1 for ep in endpoints if ep.busy)
+        in_flight = self.endpoint_manager.get_in_flight_generations()
+        capacity = available * self.generations_per_endpoint
+
+        load = self.loop_lag / self.max_loop_lag if self.max_loop_lag > 0 else 0.0
+        if endpoints:
+            # With every endpoint in error, generations can't be served at all
+            load = max(load, in_flight / capacity if capacity else 1.0)
+
+        return {
+            'load': load,
+            'in_flight_generations': in_flight,
+            'generation_capacity': capacity,
+            'endpoint_utilisation': busy / len(endpoints) if endpoints else 0.0,
+            'loop_lag': self.loop_lag
+        }
+
+    def _is_overloaded(self, user_role: str) -> bool:
+        threshold = self.thresholds.get(user_role)
+        return threshold is not None and self.get_load()['load'] >= threshold
+
+    def _get_retry_after(self) -> int:
+        return max(1, math.ceil(self.retry_after))
+
+    def admit_session(self, user_role: str, resuming: bool = False) -> Optional[int]:
+        """
+        Check whether a new session may be created, returns a retry-after (in seconds) if not.
+        Resumed sessions only bring back their own load, so they are only rejected when draining.
+        """
+        if self.draining or (not resuming and self._is_overloaded(user_role)):
+            self.decisions['sessions'][user_role]['rejected'] += 1
+            return self._get_retry_after()
+        self.decisions['sessions'][user_role]['admitted'] += 1
+        return None
+
+    async def admit_request(self, user_role: str) -> Optional[int]:
+        """
+        Check whether a generation request may run, waiting up to defer_timeout for the load to go down.
+        Returns a retry-after (in seconds) if it is rejected.
+        """
+        decisions = self.decisions['requests'][user_role]
+        if self.draining:
+            decisions['rejected'] += 1
+            return self._get_retry_after()
+        if not self._is_overloaded(user_role):
+            decisions['admitted'] += 1
+            return None
+
+        decisions['deferred'] += 1
+        deadline = time.time() + self.defer_timeout
+        async with self.load_updated:
+            while self.draining or self._is_overloaded(user_role):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    decisions['rejected'] += 1
+                    return self._get_retry_after()
+                try:
+                    await asyncio.wait_for(self.load_updated.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+        decisions['admitted'] += 1
+        return None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get the current load and the number of admission decisions per role"""
+        return {
+            **self.get_load(),
+            'thresholds': dict(self.thresholds),
+            'sessions': {role: dict(counts) for role, counts in self.decisions['sessions'].items()},
+            'requests': {role: dict(counts) for role, counts in self.decisions['requests'].items()}
+        }
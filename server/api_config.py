@@ -6,6 +6,58 @@ PRODUCT_VERSION = "2.0.0"
 # you should use Mistral 7b instruct for good performance and accuracy balance
 TEXT_MODEL = os.environ.get('HF_TEXT_MODEL', '')
 
+# Task-based LLM routing: each task gets its own model, token budget and timeout (in seconds),
+# eg. a small and fast model for the short structured search and caption jobs,
+# and a stronger one for the narrative of simulate (an empty model means TEXT_MODEL).
+# This only applies to the built-in provider, users with their own provider keep their model.
+LLM_TASK_ROUTES = {
+    'search': {
+        'model': os.environ.get('LLM_SEARCH_MODEL', ''),
+        'max_new_tokens': int(os.environ.get('LLM_SEARCH_MAX_TOKENS', '200')),
+        'timeout': float(os.environ.get('LLM_SEARCH_TIMEOUT', '20')),
+    },
+    'caption': {
+        'model': os.environ.get('LLM_CAPTION_MODEL', ''),
+        'max_new_tokens': int(os.environ.get('LLM_CAPTION_MAX_TOKENS', '180')),
+        'timeout': float(os.environ.get('LLM_CAPTION_TIMEOUT', '30')),
+    },
+    'simulate': {
+        'model': os.environ.get('LLM_SIMULATE_MODEL', ''),
+        'max_new_tokens': int(os.environ.get('LLM_SIMULATE_MAX_TOKENS', '240')),
+        'timeout': float(os.environ.get('LLM_SIMULATE_TIMEOUT', '45')),
+    },
+    'clip_prompt': {
+        'model': os.environ.get('LLM_CLIP_PROMPT_MODEL', ''),
+        'max_new_tokens': int(os.environ.get('LLM_CLIP_PROMPT_MAX_TOKENS', '200')),
+        'timeout': float(os.environ.get('LLM_CLIP_PROMPT_TIMEOUT', '15')),
+    },
+    'condense': {
+        'model': os.environ.get('LLM_CONDENSE_MODEL', ''),
+        'max_new_tokens': int(os.environ.get('LLM_CONDENSE_MAX_TOKENS', '300')),
+        'timeout': float(os.environ.get('LLM_CONDENSE_TIMEOUT', '30')),
+    },
+}
+
+# Ordered list of providers used for the built-in LLM, as comma-separated "provider:model" entries
+# (eg. "built-in,together:meta-llama/Llama-3.3-70B-Instruct"). "built-in" is the default HF inference
+# with the task's model, calls fail over to the next provider on errors or timeouts.
+LLM_PROVIDERS = [
+    entry.strip() for entry in os.environ.get('LLM_PROVIDERS', 'built-in').split(',') if entry.strip()
+]
+# deadline of a provider attempt when another provider can take over, the task timeout bounds the whole call
+LLM_PROVIDER_ATTEMPT_TIMEOUT = float(os.environ.get('LLM_PROVIDER_ATTEMPT_TIMEOUT', '12'))
+LLM_PROVIDER_EWMA_ALPHA = 0.2
+# a provider slower than this factor times the fastest one is only tried after the others
+LLM_PROVIDER_LATENCY_SLACK = float(os.environ.get('LLM_PROVIDER_LATENCY_SLACK', '2.0'))
+# consecutive failures before a provider's circuit opens, and initial cool-down (doubling up to 10 minutes)
+LLM_CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('LLM_CIRCUIT_FAILURE_THRESHOLD', '3'))
+LLM_CIRCUIT_RESET_SECONDS = int(os.environ.get('LLM_CIRCUIT_RESET_SECONDS', '30'))
+
+# LLM calls are streamed so we can measure the time to the first token
+LLM_STREAMING_ENABLED = os.environ.get('LLM_STREAMING_ENABLED', 'true').lower() in ('true', 'yes', '1', 't')
+# window of the rolling LLM latency and token histograms reported by /api/metrics
+LLM_METRICS_WINDOW_SECONDS = int(os.environ.get('LLM_METRICS_WINDOW_SECONDS', str(60 * 60)))
+
 # Environment variable to control maintenance mode
 MAINTENANCE_MODE = os.environ.get('MAINTENANCE_MODE', 'false').lower() in ('true', 'yes', '1', 't')
 
@@ -47,6 +99,185 @@ GUIDANCE_SCALE = 1.0
 
 THUMBNAIL_FRAMES = 65
 
+# Search result cache: popular queries are served from a pool of past results
+SEARCH_CACHE_ENABLED = os.environ.get('SEARCH_CACHE_ENABLED', 'true').lower() in ('true', 'yes', '1', 't')
+# number of distinct results kept (and served round-robin) per query
+SEARCH_CACHE_POOL_SIZE = int(os.environ.get('SEARCH_CACHE_POOL_SIZE', '8'))
+SEARCH_CACHE_MAX_QUERIES = int(os.environ.get('SEARCH_CACHE_MAX_QUERIES', '2000'))
+SEARCH_CACHE_TTL_SECONDS = int(os.environ.get('SEARCH_CACHE_TTL_SECONDS', str(60 * 60)))
+# how often the background task tops up the pools of the hottest queries
+SEARCH_CACHE_REFILL_INTERVAL_SECONDS = int(os.environ.get('SEARCH_CACHE_REFILL_INTERVAL_SECONDS', '30'))
+SEARCH_CACHE_REFILL_QUERIES = int(os.environ.get('SEARCH_CACHE_REFILL_QUERIES', '5'))
+# near-duplicate queries ("cat surfing", "a surfing cat video") can share a pool
+SEARCH_CACHE_SIMILARITY_ENABLED = os.environ.get('SEARCH_CACHE_SIMILARITY_ENABLED', 'true').lower() in ('true', 'yes', '1', 't')
+# minimum (estimated) Jaccard similarity of the character trigrams of two queries
+SEARCH_CACHE_SIMILARITY_THRESHOLD = float(os.environ.get('SEARCH_CACHE_SIMILARITY_THRESHOLD', '0.6'))
+# fraction of near-duplicate hits checked against the exact similarity
+SEARCH_CACHE_SIMILARITY_SAMPLE_RATE = float(os.environ.get('SEARCH_CACHE_SIMILARITY_SAMPLE_RATE', '0.05'))
+
+# Search racing: launch several generations concurrently and keep the first valid one,
+# instead of retrying sequentially when the YAML is invalid or contains <PLACEHOLDER> tags
+SEARCH_RACE_ENABLED = os.environ.get('SEARCH_RACE_ENABLED', 'true').lower() in ('true', 'yes', '1', 't')
+SEARCH_RACE_MAX_WIDTH = int(os.environ.get('SEARCH_RACE_MAX_WIDTH', '3'))
+# acceptable probability that all the raced attempts fail (the width adapts to reach it)
+SEARCH_RACE_TARGET_FAILURE = float(os.environ.get('SEARCH_RACE_TARGET_FAILURE', '0.1'))
+# temperature gap between two raced attempts
+SEARCH_RACE_TEMPERATURE_SPREAD = float(os.environ.get('SEARCH_RACE_TEMPERATURE_SPREAD', '0.05'))
+
+# Caption cache: captions are keyed by a hash of (title, description, model, game master prompt),
+# concurrent identical requests share a single LLM call
+CAPTION_CACHE_ENABLED = os.environ.get('CAPTION_CACHE_ENABLED', 'true').lower() in ('true', 'yes', '1', 't')
+CAPTION_CACHE_MAX_ENTRIES = int(os.environ.get('CAPTION_CACHE_MAX_ENTRIES', '5000'))
+CAPTION_CACHE_TTL_SECONDS = int(os.environ.get('CAPTION_CACHE_TTL_SECONDS', str(24 * 60 * 60)))
+# optional disk tier (eg. "/tmp/data/caption_cache"), which survives restarts
+CAPTION_CACHE_DIR = os.environ.get('CAPTION_CACHE_DIR', '')
+CAPTION_CACHE_MAX_DISK_ENTRIES = int(os.environ.get('CAPTION_CACHE_MAX_DISK_ENTRIES', '50000'))
+
+# Clip prompts: the LLM writes the prompt of a video's next clip from its event history
+# while the current clip renders, clips whose prompt isn't ready use the static caption
+CLIP_PROMPT_ENABLED = os.environ.get('CLIP_PROMPT_ENABLED', 'true').lower() in ('true', 'yes', '1', 't')
+# how long a clip may wait for its prompt (0 means never delay a clip)
+CLIP_PROMPT_WAIT_SECONDS = float(os.environ.get('CLIP_PROMPT_WAIT_SECONDS', '0'))
+CLIP_PROMPT_MAX_VIDEOS = int(os.environ.get('CLIP_PROMPT_MAX_VIDEOS', '1000'))
+
+# Warm start: when endpoints are idle, the first clip of each search result is generated
+# (with the result's seed) before the client asks for it, and parked for WARM_START_TTL_SECONDS
+WARM_START_ENABLED = os.environ.get('WARM_START_ENABLED', 'false').lower() in ('true', 'yes', '1', 't')
+WARM_START_TTL_SECONDS = float(os.environ.get('WARM_START_TTL_SECONDS', '30'))
+WARM_START_MAX_ENTRIES = int(os.environ.get('WARM_START_MAX_ENTRIES', '200'))
+WARM_START_MAX_IN_FLIGHT = int(os.environ.get('WARM_START_MAX_IN_FLIGHT', '2'))
+# only warm start when at least this many endpoints are free (so real requests still find one)
+WARM_START_MIN_FREE_ENDPOINTS = int(os.environ.get('WARM_START_MIN_FREE_ENDPOINTS', '2'))
+
+# Thumbnails are derived with ffmpeg from a recently generated clip of the same video and seed
+# when there is one, instead of being generated by an endpoint
+THUMBNAIL_DERIVE_ENABLED = os.environ.get('THUMBNAIL_DERIVE_ENABLED', 'true').lower() in ('true', 'yes', '1', 't')
+# 'video' for a short low-resolution loop, 'image' for a poster frame
+THUMBNAIL_DERIVE_FORMAT = os.environ.get('THUMBNAIL_DERIVE_FORMAT', 'video')
+THUMBNAIL_DERIVE_WORKERS = int(os.environ.get('THUMBNAIL_DERIVE_WORKERS', '2'))
+# clips are kept in memory, so keep this small
+THUMBNAIL_SOURCE_CLIPS = int(os.environ.get('THUMBNAIL_SOURCE_CLIPS', '100'))
+THUMBNAIL_SOURCE_TTL_SECONDS = int(os.environ.get('THUMBNAIL_SOURCE_TTL_SECONDS', str(10 * 60)))
+
+# Thumbnail lane: the last THUMBNAIL_LANE_ENDPOINTS endpoints only generate thumbnails
+# (which can also use the other ones), and a thumbnail waits up to THUMBNAIL_QUEUE_TIMEOUT_SECONDS
+# for a free endpoint instead of failing right away
+THUMBNAIL_LANE_ENDPOINTS = int(os.environ.get('THUMBNAIL_LANE_ENDPOINTS', '0'))
+THUMBNAIL_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('THUMBNAIL_QUEUE_TIMEOUT_SECONDS', '5'))
+THUMBNAIL_QUEUE_MAX_SIZE = int(os.environ.get('THUMBNAIL_QUEUE_MAX_SIZE', '32'))
+# limits of the generate_video_thumbnails bulk action (cards per request, generated at a time)
+THUMBNAIL_BATCH_MAX_CARDS = int(os.environ.get('THUMBNAIL_BATCH_MAX_CARDS', '24'))
+THUMBNAIL_BATCH_CONCURRENCY = int(os.environ.get('THUMBNAIL_BATCH_CONCURRENCY', '4'))
+
+# Server-side story state of simulations: clients only send a story handle (story_id)
+STORY_STATE_MAX_STORIES = int(os.environ.get('STORY_STATE_MAX_STORIES', '5000'))
+STORY_STATE_TTL_SECONDS = int(os.environ.get('STORY_STATE_TTL_SECONDS', str(60 * 60)))
+# the recent scenes are condensed into the summary every K evolutions (by a cheap LLM call)
+STORY_CONDENSE_EVERY = int(os.environ.get('STORY_CONDENSE_EVERY', '4'))
+# hard budget of the simulate prompt, chat messages are truncated first (oldest first), then the history
+STORY_PROMPT_TOKEN_BUDGET = int(os.environ.get('STORY_PROMPT_TOKEN_BUDGET', '1800'))
+STORY_HISTORY_TOKEN_BUDGET = int(os.environ.get('STORY_HISTORY_TOKEN_BUDGET', '400'))
+
+# Shared stories: viewers can opt in (with the subscribe_story action) to a single
+# server-side simulation per video, evolved every SHARED_STORY_INTERVAL_SECONDS
+SHARED_STORY_ENABLED = os.environ.get('SHARED_STORY_ENABLED', 'true').lower() in ('true', 'yes', '1', 't')
+SHARED_STORY_INTERVAL_SECONDS = float(os.environ.get('SHARED_STORY_INTERVAL_SECONDS', '10'))
+# shared stories a session may be subscribed to at once, per role (None means no limit)
+SHARED_STORY_MAX_PER_SESSION = {
+    'anon': int(os.environ.get('SHARED_STORY_MAX_PER_SESSION_ANON', '1')),
+    'normal': int(os.environ.get('SHARED_STORY_MAX_PER_SESSION_NORMAL', '2')),
+    'pro': int(os.environ.get('SHARED_STORY_MAX_PER_SESSION_PRO', '4')),
+    'admin': None,
+}
+
+# Shared streams: viewers can opt in (with the subscribe_stream action) to receive the clips
+# of a video generated once for everyone, late joiners get the last SHARED_STREAM_REPLAY_CLIPS
+SHARED_STREAM_ENABLED = os.environ.get('SHARED_STREAM_ENABLED', 'true').lower() in ('true', 'yes', '1', 't')
+SHARED_STREAM_CLIP_INTERVAL_SECONDS = float(os.environ.get('SHARED_STREAM_CLIP_INTERVAL_SECONDS', '2.5'))
+SHARED_STREAM_REPLAY_CLIPS = int(os.environ.get('SHARED_STREAM_REPLAY_CLIPS', '3'))
+# shared streams a session may be subscribed to at once, per role (None means no limit)
+SHARED_STREAM_MAX_PER_SESSION = {
+    'anon': int(os.environ.get('SHARED_STREAM_MAX_PER_SESSION_ANON', '1')),
+    'normal': int(os.environ.get('SHARED_STREAM_MAX_PER_SESSION_NORMAL', '2')),
+    'pro': int(os.environ.get('SHARED_STREAM_MAX_PER_SESSION_PRO', '4')),
+    'admin': None,
+}
+
+# Admission control: the load is the highest of the in-flight endpoint generations over
+# ADMISSION_GENERATIONS_PER_ENDPOINT per available endpoint, and the event loop lag over ADMISSION_MAX_LOOP_LAG_SECONDS.
+# Above the threshold of their role, new sessions are rejected and generation requests are deferred
+# up to ADMISSION_DEFER_SECONDS then rejected, with a retry-after (admins are never shed)
+ADMISSION_CONTROL_ENABLED = os.environ.get('ADMISSION_CONTROL_ENABLED', 'true').lower() in ('true', 'yes', '1', 't')
+ADMISSION_THRESHOLDS = {
+    'anon': float(os.environ.get('ADMISSION_THRESHOLD_ANON', '0.75')),
+    'normal': float(os.environ.get('ADMISSION_THRESHOLD_NORMAL', '0.9')),
+    'pro': float(os.environ.get('ADMISSION_THRESHOLD_PRO', '1.0')),
+    'admin': None,
+}
+ADMISSION_GENERATIONS_PER_ENDPOINT = float(os.environ.get('ADMISSION_GENERATIONS_PER_ENDPOINT', '2'))
+ADMISSION_MAX_LOOP_LAG_SECONDS = float(os.environ.get('ADMISSION_MAX_LOOP_LAG_SECONDS', '0.5'))
+ADMISSION_DEFER_SECONDS = float(os.environ.get('ADMISSION_DEFER_SECONDS', '5'))
+ADMISSION_RETRY_AFTER_SECONDS = float(os.environ.get('ADMISSION_RETRY_AFTER_SECONDS', '10'))
+
+# Encoding of the WebSocket messages, chosen by the client with the "codec" query parameter
+# or the WebSocket subprotocol: 'json' (stdlib), 'orjson' or 'msgpack' (binary frames).
+# Clients which don't choose get WS_DEFAULT_CODEC (stdlib JSON if it isn't installed)
+WS_DEFAULT_CODEC = os.environ.get('WS_DEFAULT_CODEC', 'orjson')
+
+# Outbound queue of each connection: control messages go ahead of clips and thumbnails,
+# and once a client has WS_OUTBOX_MAX_MESSAGES or WS_OUTBOX_MAX_BYTES waiting, the policy applies:
+# 'coalesce' (keep the latest clip / story update of a video), then 'drop_stale' (drop the oldest
+# pushed clips, thumbnails and story updates), then 'disconnect' (each policy falls back to the next ones)
+WS_OUTBOX_MAX_MESSAGES = int(os.environ.get('WS_OUTBOX_MAX_MESSAGES', '256'))
+WS_OUTBOX_MAX_BYTES = int(os.environ.get('WS_OUTBOX_MAX_BYTES', str(32 * 1024 * 1024)))
+WS_SLOW_CONSUMER_POLICY = os.environ.get('WS_SLOW_CONSUMER_POLICY', 'coalesce')
+# a client which doesn't accept a message for this long is disconnected
+WS_SEND_TIMEOUT_SECONDS = float(os.environ.get('WS_SEND_TIMEOUT_SECONDS', '30'))
+
+# Session resumption: clients get a session token, and a client reconnecting with it (in the
+# session_token query parameter) within SESSION_RESUME_GRACE_SECONDS gets back its session, with the
+# requests which kept running meanwhile and up to SESSION_RESUME_BUFFER_MESSAGES results completed while away
+SESSION_RESUME_ENABLED = os.environ.get('SESSION_RESUME_ENABLED', 'true').lower() in ('true', 'yes', '1', 't')
+SESSION_RESUME_GRACE_SECONDS = float(os.environ.get('SESSION_RESUME_GRACE_SECONDS', '30'))
+SESSION_RESUME_BUFFER_MESSAGES = int(os.environ.get('SESSION_RESUME_BUFFER_MESSAGES', '16'))
+
+# Per-session dispatch of the WebSocket requests: the requests of a lane run in order,
+# at most SESSION_LANE_CONCURRENCY[lane] at a time (the video lane is limited by the user role),
+# and once a session runs SESSION_MAX_CONCURRENT_REQUESTS requests the next ones go by priority
+SESSION_LANE_CONCURRENCY = {
+    'chat': 1,  # keeps the messages of a user in order
+    'subscription': 1,
+    'search': int(os.environ.get('SESSION_SEARCH_CONCURRENCY', '1')),
+    'simulation': int(os.environ.get('SESSION_SIMULATION_CONCURRENCY', '1')),
+    'caption': int(os.environ.get('SESSION_CAPTION_CONCURRENCY', '2')),
+    'thumbnail': int(os.environ.get('SESSION_THUMBNAIL_CONCURRENCY', '2')),
+}
+SESSION_MAX_CONCURRENT_REQUESTS = int(os.environ.get('SESSION_MAX_CONCURRENT_REQUESTS', '16'))
+# window of the rolling dispatch latency histograms reported by /api/metrics
+DISPATCH_METRICS_WINDOW_SECONDS = int(os.environ.get('DISPATCH_METRICS_WINDOW_SECONDS', str(60 * 60)))
+
+# Graceful drain (on SIGTERM, or a POST to /api/drain): new sessions and generation requests are rejected,
+# the running requests get up to DRAIN_TIMEOUT_SECONDS to complete and send their results, then clients
+# are told to reconnect after DRAIN_RECONNECT_AFTER_SECONDS and the server exits
+DRAIN_ON_SIGTERM = os.environ.get('DRAIN_ON_SIGTERM', 'true').lower() in ('true', 'yes', '1', 't')
+DRAIN_TIMEOUT_SECONDS = float(os.environ.get('DRAIN_TIMEOUT_SECONDS', '25'))
+DRAIN_RECONNECT_AFTER_SECONDS = int(os.environ.get('DRAIN_RECONNECT_AFTER_SECONDS', '5'))
+
+# Multi-process serving (Linux): API_WORKERS worker processes share the port (SO_REUSEPORT), and share the
+# endpoint slots, rate limit counters and chat rooms through a shared state server run by their supervisor
+# on a Unix socket (SHARED_STATE_SOCKET, set by the supervisor for its workers, in a temporary directory by default)
+API_WORKERS = int(os.environ.get('API_WORKERS', '1'))
+SHARED_STATE_SOCKET = os.environ.get('SHARED_STATE_SOCKET', '')
+
+# Liveness: the server pings each WebSocket every WS_HEARTBEAT_SECONDS and closes it when the pong doesn't
+# come back within half of that (0 disables the pings). Every WS_REAP_INTERVAL_SECONDS, the sessions without any
+# message for WS_IDLE_TIMEOUT_SECONDS (clients send a heartbeat every 30s) are reaped, and the usage metrics of the
+# users disconnected and inactive for METRICS_USER_RETENTION_SECONDS are dropped
+WS_HEARTBEAT_SECONDS = float(os.environ.get('WS_HEARTBEAT_SECONDS', '20'))
+WS_IDLE_TIMEOUT_SECONDS = float(os.environ.get('WS_IDLE_TIMEOUT_SECONDS', '300'))
+WS_REAP_INTERVAL_SECONDS = float(os.environ.get('WS_REAP_INTERVAL_SECONDS', '30'))
+METRICS_USER_RETENTION_SECONDS = float(os.environ.get('METRICS_USER_RETENTION_SECONDS', '3600'))
+
 # anonymous users are people browing TikSlop without being connected
 # this category suffers from regular abuse so we need to enforce strict limitations
 CONFIG_FOR_ANONYMOUS_USERS = {
@@ -4,23 +4,39 @@ import io
 import re
 import base64
 import uuid
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Set, Tuple
 import asyncio
 import time
 import datetime
-from collections import defaultdict
 from aiohttp import web, ClientSession
 from huggingface_hub import HfApi
 from gradio_client import Client
 import random
-import yaml
 import json
 
 from .api_config import *
 from .models import UserRole
-from .endpoint_manager import EndpointManager
-from .utils import generate_seed, sanitize_yaml_response
+from .endpoint_manager import EndpointManager, SharedEndpointManager
+from .shared_state import shared_state
+from .admission import AdmissionController
+from .utils import generate_seed, parse_search_response
 from .chat import ChatManager
+from .cache_utils import AsyncTTLCache, make_cache_key
+from .clip_prompts import ClipPromptPrefetcher, VideoEventLogs
+from .warm_start import WarmStartCache
+from .thumbnail_utils import ThumbnailDeriver
+from .search_cache import SearchCache
+from .similarity_index import SimilarityIndex
+from .shared_story import SharedStoryManager
+from .shared_stream import SharedStreamManager
+from .story_state import (
+    StoryState,
+    StoryStateStore,
+    estimate_tokens,
+    fit_chat_messages,
+    truncate_to_tokens
+)
+from .racing import AdaptiveRaceWidth, race_first
 from .config_utils import get_config_value
 from .video_utils import (
     generate_video_content_with_inference_endpoints,
@@ -29,10 +45,13 @@ from .video_utils import (
 from .llm_utils import (
     get_inference_client,
     generate_text,
+    get_task_route,
+    is_builtin_llm_config,
     SEARCH_VIDEO_PROMPT_TEMPLATE,
     GENERATE_CAPTION_PROMPT_TEMPLATE,
     SIMULATE_VIDEO_FIRST_PROMPT_TEMPLATE,
     SIMULATE_VIDEO_CONTINUE_PROMPT_TEMPLATE,
+    CONDENSE_STORY_PROMPT_TEMPLATE,
     GENERATE_CLIP_PROMPT_TEMPLATE
 )
 
@@ -45,22 +64,140 @@ logger = get_logger(__name__)
 class VideoGenerationAPI:
     def __init__(self):
         self.hf_api = HfApi(token=HF_TOKEN)
-        self.endpoint_manager = EndpointManager()
+        # The workers of the multi-process mode share the state of the endpoints
+        self.endpoint_manager = SharedEndpointManager(shared_state) if shared_state is not None else EndpointManager()
+        # Sheds new sessions and generation requests when the server is overloaded (or draining)
+        self.admission = AdmissionController(
+            self.endpoint_manager,
+            thresholds=ADMISSION_THRESHOLDS if ADMISSION_CONTROL_ENABLED else {},
+            generations_per_endpoint=ADMISSION_GENERATIONS_PER_ENDPOINT,
+            max_loop_lag=ADMISSION_MAX_LOOP_LAG_SECONDS,
+            defer_timeout=ADMISSION_DEFER_SECONDS,
+            retry_after=ADMISSION_RETRY_AFTER_SECONDS
+        )
         self.active_requests: Dict[str, asyncio.Future] = {}
-        self.chat_manager = ChatManager()
-        self.video_events: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self.chat_manager = ChatManager(shared_state)
         self.event_history_limit = 50
+        self.video_events = VideoEventLogs(max_events=self.event_history_limit)
+        # Prompts of the next clips, written by the LLM while the current clips render
+        self.clip_prompts = ClipPromptPrefetcher(
+            self._generate_clip_prompt,
+            wait_timeout=CLIP_PROMPT_WAIT_SECONDS,
+            max_videos=CLIP_PROMPT_MAX_VIDEOS
+        )
         # Cache for user roles to avoid repeated API calls
         self.user_role_cache: Dict[str, Dict[str, Any]] = {}
         # Cache expiration time (10 minutes)
         self.cache_expiration = 600
+        # Cache of search results, served round-robin for popular queries
+        self.search_cache = SearchCache(
+            pool_size=SEARCH_CACHE_POOL_SIZE,
+            max_queries=SEARCH_CACHE_MAX_QUERIES,
+            ttl=SEARCH_CACHE_TTL_SECONDS,
+            similarity_index=SimilarityIndex(
+                threshold=SEARCH_CACHE_SIMILARITY_THRESHOLD,
+                max_entries=SEARCH_CACHE_MAX_QUERIES,
+                sample_rate=SEARCH_CACHE_SIMILARITY_SAMPLE_RATE
+            ) if SEARCH_CACHE_SIMILARITY_ENABLED else None
+        )
+        # Number of concurrent search attempts to race, adapted to the failure rate of each model
+        self.search_race_width = AdaptiveRaceWidth(
+            max_width=SEARCH_RACE_MAX_WIDTH,
+            target_failure=SEARCH_RACE_TARGET_FAILURE
+        )
+        # Cache of captions, shared by all the viewers rendering the same card
+        self.caption_cache = AsyncTTLCache(
+            max_entries=CAPTION_CACHE_MAX_ENTRIES,
+            ttl=CAPTION_CACHE_TTL_SECONDS,
+            disk_dir=CAPTION_CACHE_DIR or None,
+            max_disk_entries=CAPTION_CACHE_MAX_DISK_ENTRIES
+        )
+        # First clips of search results, started before the client asks for them
+        self.warm_starts = WarmStartCache(
+            ttl=WARM_START_TTL_SECONDS,
+            max_entries=WARM_START_MAX_ENTRIES,
+            max_in_flight=WARM_START_MAX_IN_FLIGHT
+        )
+        # Recently generated clips, and the ffmpeg workers deriving thumbnails from them
+        self.recent_clips = AsyncTTLCache(
+            max_entries=THUMBNAIL_SOURCE_CLIPS,
+            ttl=THUMBNAIL_SOURCE_TTL_SECONDS
+        )
+        self.thumbnail_deriver = ThumbnailDeriver(
+            max_workers=THUMBNAIL_DERIVE_WORKERS,
+            output_format=THUMBNAIL_DERIVE_FORMAT
+        )
+        self.thumbnail_endpoint_fallbacks = 0
+        # Thumbnails waiting for an endpoint of their lane
+        self.thumbnail_queue_depth = 0
+        self.thumbnail_queue_stats = {'queued': 0, 'rejected': 0, 'timeouts': 0, 'total_wait': 0.0}
+        # Server-side state of the simulated stories, referenced by clients with a story handle
+        self.story_states = StoryStateStore(
+            max_stories=STORY_STATE_MAX_STORIES,
+            ttl=STORY_STATE_TTL_SECONDS
+        )
+        # One server-side simulation per video for the viewers who opted in
+        self.shared_stories = SharedStoryManager(self, interval=SHARED_STORY_INTERVAL_SECONDS)
+        # One clip generation per shared stream, pushed to all its viewers
+        self.shared_streams = SharedStreamManager(
+            self,
+            clip_interval=SHARED_STREAM_CLIP_INTERVAL_SECONDS,
+            replay_size=SHARED_STREAM_REPLAY_CLIPS
+        )
+        self.background_tasks: List[asyncio.Task] = []
+        # Short-lived tasks we don't wait for (eg. story condensation)
+        self.pending_tasks: Set[asyncio.Task] = set()
+
+    async def start_background_tasks(self):
+        """Start the long-running maintenance tasks of the API (called on app startup)"""
+        if shared_state is not None:
+            # Mirror the endpoints held by the other workers before serving
+            await self.endpoint_manager.sync()
+        if SEARCH_CACHE_ENABLED:
+            self.background_tasks.append(asyncio.create_task(self._refill_search_cache()))
+        if ADMISSION_CONTROL_ENABLED:
+            self.background_tasks.append(asyncio.create_task(self.admission.monitor_loop_lag()))
+
+    async def stop_background_tasks(self):
+        """Stop the long-running maintenance tasks of the API (called on app shutdown)"""
+        self.clip_prompts.stop()
+        tasks = self.background_tasks + list(self.pending_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.background_tasks = []
+
+    def get_cache_stats(self, detailed: bool = False) -> Dict[str, Any]:
+        """
+        Get statistics about the API caches.
+        Detailed stats may contain user content and are only meant for the protected metrics endpoint.
+        """
+        return {
+            'search': self.search_cache.get_stats(include_samples=detailed),
+            'search_race': self.search_race_width.get_stats(),
+            'captions': self.caption_cache.get_stats(),
+            'clip_prompts': self.clip_prompts.get_stats(),
+            'warm_starts': self.warm_starts.get_stats(),
+            'thumbnails': {
+                **self.thumbnail_deriver.get_stats(),
+                'source_clips': len(self.recent_clips.entries),
+                'endpoint_fallbacks': self.thumbnail_endpoint_fallbacks,
+                'dedicated_endpoints': len(self.endpoint_manager.thumbnail_endpoint_ids),
+                'queue_depth': self.thumbnail_queue_depth,
+                'queued': self.thumbnail_queue_stats['queued'],
+                'queue_rejected': self.thumbnail_queue_stats['rejected'],
+                'queue_timeouts': self.thumbnail_queue_stats['timeouts'],
+                'avg_queue_wait': self.thumbnail_queue_stats['total_wait'] / self.thumbnail_queue_stats['queued']
+                                  if self.thumbnail_queue_stats['queued'] else 0.0
+            },
+            'stories': len(self.story_states),
+            'shared_stories': self.shared_stories.get_stats(),
+            'shared_streams': self.shared_streams.get_stats()
+        }
 
     def _add_event(self, video_id: str, event: Dict[str, Any]):
         """Add an event to the video's history and maintain the size limit"""
-        events = self.video_events[video_id]
-        events.append(event)
-        if len(events) > self.event_history_limit:
-            events.pop(0)
+        self.video_events.append(video_id, event)
     
     async def validate_user_token(self, token: str) -> UserRole:
         """
@@ -141,86 +278,20 @@ class VideoGenerationAPI:
                 return await response.read()
 
     async def search_video(self, query: str, attempt_count: int = 0, llm_config: Optional[dict] = None) -> Optional[dict]:
-        """Generate a single search result using HF text generation"""
-        # Maximum number of attempts to generate a description without placeholder tags
-        max_attempts = 2
-        current_attempt = attempt_count
-        # Use a random temperature between 0.68 and 0.72 to generate more diverse results
-        # and prevent duplicate results from successive calls with the same prompt
-        temperature = random.uniform(0.68, 0.72)
+        """Get a single search result, from the search cache when possible"""
+        cacheable = SEARCH_CACHE_ENABLED and self._is_cacheable_llm_config(llm_config)
 
-        while current_attempt <= max_attempts:
-            prompt = SEARCH_VIDEO_PROMPT_TEMPLATE.format(
-                current_attempt=current_attempt,
-                query=query
-            )
+        if cacheable:
+            cached_result = self.search_cache.get(query)
+            if cached_result:
+                return cached_result
 
-            try:
-                raw_yaml_str = await generate_text(
-                    prompt,
-                    llm_config=llm_config,
-                    max_new_tokens=200,
-                    temperature=temperature
-                )
-
-                raw_yaml_str = raw_yaml_str.strip()
-        
-                #logger.info(f"search_video(): raw_yaml_str = {raw_yaml_str}")
+        result = await self._generate_search_result(query, attempt_count, llm_config)
 
-                # All pre-processing is now handled in sanitize_yaml_response
-                sanitized_yaml = sanitize_yaml_response(raw_yaml_str)
-
-                try:
-                    result = yaml.safe_load(sanitized_yaml)
-                except yaml.YAMLError as e:
-                    logger.error(f"YAML parsing failed: {str(e)}")
-                    result = None
-                
-                if not result or not isinstance(result, dict):
-                    logger.error(f"Invalid result format: {result}")
-                    current_attempt += 1
-                    temperature = random.uniform(0.68, 0.72)  # Try with different random temperature on next attempt
-                    continue
-
-                # Extract fields with defaults
-                title = str(result.get('title', '')).strip() or 'Untitled Video'
-                description = str(result.get('description', '')).strip() or 'No description available'
-                
-                # Check if the description still contains placeholder tags like <LOCATION>, <GENDER>, etc.
-                if re.search(r'<[A-Z_]+>', description):
-                    #logger.warning(f"Description still contains placeholder tags: {description}")
-                    if current_attempt < max_attempts:
-                        # Try again with a different random temperature
-                        current_attempt += 1
-                        temperature = random.uniform(0.68, 0.72)
-                        continue
-                    else:
-                        # If we've reached max attempts, use the title as description
-                        description = title
-
-                # Return valid result with all required fields
-                return {
-                    'id': str(uuid.uuid4()),
-                    'title': title,
-                    'description': description,
-                    'thumbnailUrl': '',
-                    'videoUrl': '',
-
-                    # not really used yet, maybe one day if we pre-generate or store content
-                    'isLatent': True,
-
-                    'useFixedSeed': "webcam" in description.lower(),
-
-                    'seed': generate_seed(),
-                    'views': 0,
-                    'tags': []
-                }
-
-            except Exception as e:
-                logger.error(f"Search video generation failed: {str(e)}")
-                current_attempt += 1
-                temperature = random.uniform(0.68, 0.72)  # Try with different random temperature on next attempt
-        
+        if result:
+            if cacheable:
+                self.search_cache.add(query, result)
+            return result
 
         # List of video types to randomly choose from
         video_types = ["documentary", "movie screencap, movie scene", "POV, gopro footage", "music video", "videogame gameplay", "creepy found footage"]
@@ -241,12 +312,182 @@ class VideoGenerationAPI:
             'tags': []
         }
 
+    @staticmethod
+    def _is_cacheable_llm_config(llm_config: Optional[dict]) -> bool:
+        """
+        Only results of the built-in provider without custom rules are shared between users,
+        anything else depends on the user's own provider, model or game master prompt
+        """
+        if not llm_config:
+            return True
+        game_master_prompt = (llm_config.get('game_master_prompt') or '').strip()
+        return is_builtin_llm_config(llm_config) and not game_master_prompt
+
+    async def _refill_search_cache(self):
+        """Background task topping up the result pools of the hottest queries"""
+        while True:
+            await asyncio.sleep(SEARCH_CACHE_REFILL_INTERVAL_SECONDS)
+            try:
+                for query in self.search_cache.get_refill_candidates(SEARCH_CACHE_REFILL_QUERIES):
+                    result = await self._generate_search_result(query)
+                    if result:
+                        self.search_cache.add(query, result)
+                        self.search_cache.refills += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error refilling search cache: {str(e)}")
+
+    @staticmethod
+    def _get_model_key(llm_config: Optional[dict], task: Optional[str] = None) -> str:
+        """Get a key identifying the provider and model used for a given LLM config and task"""
+        if is_builtin_llm_config(llm_config):
+            return f"built-in/{get_task_route(task).get('model') or TEXT_MODEL}"
+        return f"{llm_config.get('provider')}/{llm_config.get('model', '')}"
+
+    async def _search_attempt(self, query: str, attempt: int, temperature: float,
+                              llm_config: Optional[dict] = None) -> Tuple[str, Optional[dict]]:
+        """
+        Run a single search generation attempt.
+
+        Returns a tuple (status, fields) where status is one of:
+        - 'ok': the title and description are valid
+        - 'placeholder': the description still contains placeholder tags like <LOCATION>
+        - 'invalid': the generation failed (fields is None)
+        """
+        prompt = SEARCH_VIDEO_PROMPT_TEMPLATE.format(
+            current_attempt=attempt,
+            query=query
+        )
+        model_key = self._get_model_key(llm_config, task='search')
+
+        try:
+            raw_yaml_str = await generate_text(
+                prompt,
+                llm_config=llm_config,
+                temperature=temperature,
+                task='search'
+            )
+
+            #logger.info(f"search_video(): raw_yaml_str = {raw_yaml_str}")
+
+            # Extract the fields straight from the raw text (code fences, nested titles etc. are handled there)
+            result = parse_search_response(raw_yaml_str)
+
+            # Extract fields with defaults
+            fields = {
+                'title': str(result.get('title', '')).strip() or 'Untitled Video',
+                'description': str(result.get('description', '')).strip() or 'No description available'
+            }
+
+            # Check if the description still contains placeholder tags like <LOCATION>, <GENDER>, etc.
+            if re.search(r'<[A-Z_]+>', fields['description']):
+                #logger.warning(f"Description still contains placeholder tags: {description}")
+                self.search_race_width.record(model_key, success=False)
+                return 'placeholder', fields
+
+            self.search_race_width.record(model_key, success=True)
+            return 'ok', fields
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Search video generation failed: {str(e)}")
+            self.search_race_width.record(model_key, success=False)
+            return 'invalid', None
+
+    async def _generate_search_result(self, query: str, attempt_count: int = 0, llm_config: Optional[dict] = None) -> Optional[dict]:
+        """
+        Generate a single search result using HF text generation, or None if all attempts failed.
+
+        Attempts are raced in rounds: each round launches as many concurrent attempts
+        (at different temperatures) as the observed failure rate of the model calls for,
+        and returns the first valid one.
+        """
+        # Maximum number of attempts to generate a description without placeholder tags
+        max_attempts = 2
+        current_attempt = attempt_count
+        model_key = self._get_model_key(llm_config, task='search')
+        placeholder_fields = None
+
+        while current_attempt <= max_attempts:
+            remaining = max_attempts - current_attempt + 1
+            width = min(remaining, self.search_race_width.get_width(model_key)) if SEARCH_RACE_ENABLED else 1
+
+            # Use a random temperature around 0.7 to generate more diverse results
+            # and prevent duplicate results from successive calls with the same prompt,
+            # raced attempts are spread apart so they don't all fail the same way
+            attempts = [
+                self._search_attempt(
+                    query,
+                    current_attempt + i,
+                    random.uniform(0.68, 0.72) + SEARCH_RACE_TEMPERATURE_SPREAD * (i - (width - 1) / 2),
+                    llm_config
+                )
+                for i in range(width)
+            ]
+            current_attempt += width
+
+            winner, rejected = await race_first(attempts, lambda outcome: outcome[0] == 'ok')
+            if winner:
+                fields = winner[1]
+                break
+
+            for outcome in rejected:
+                if isinstance(outcome, tuple) and outcome[0] == 'placeholder' and not placeholder_fields:
+                    placeholder_fields = outcome[1]
+        else:
+            if not placeholder_fields:
+                return None
+            # If we've reached max attempts, use the title as description
+            fields = {
+                'title': placeholder_fields['title'],
+                'description': placeholder_fields['title']
+            }
+
+        title = fields['title']
+        description = fields['description']
+
+        # Return valid result with all required fields
+        return {
+            'id': str(uuid.uuid4()),
+            'title': title,
+            'description': description,
+            'thumbnailUrl': '',
+            'videoUrl': '',
+
+            # not really used yet, maybe one day if we pre-generate or store content
+            'isLatent': True,
+
+            'useFixedSeed': "webcam" in description.lower(),
+
+            'seed': generate_seed(),
+            'views': 0,
+            'tags': []
+        }
+
     # The generate_thumbnail function has been removed because we now use
     # generate_video_thumbnail for all thumbnails, which generates a video clip
     # instead of a static image
 
     async def generate_caption(self, title: str, description: str, llm_config: Optional[dict] = None) -> str:
-        """Generate detailed caption using HF text generation"""
+        """Generate detailed caption using HF text generation (cached)"""
+        if not CAPTION_CACHE_ENABLED:
+            return await self._generate_caption(title, description, llm_config)
+
+        cache_key = make_cache_key(
+            title,
+            description,
+            self._get_model_key(llm_config, task='caption'),
+            (llm_config or {}).get('game_master_prompt', '')
+        )
+        return await self.caption_cache.get_or_compute(
+            cache_key,
+            lambda: self._generate_caption(title, description, llm_config)
+        )
+
+    async def _generate_caption(self, title: str, description: str, llm_config: Optional[dict] = None) -> str:
+        """Generate a caption with the LLM, returns an empty string on failure"""
         try:
             prompt = GENERATE_CAPTION_PROMPT_TEMPLATE.format(
                 title=title,
@@ -256,8 +497,8 @@ class VideoGenerationAPI:
             response = await generate_text(
                 prompt,
                 llm_config=llm_config,
-                max_new_tokens=180,
-                temperature=0.7
+                temperature=0.7,
+                task='caption'
             )
      
             if "Caption: " in response:
@@ -276,9 +517,15 @@ class VideoGenerationAPI:
             
     async def simulate(self, original_title: str, original_description: str, 
                          current_description: str, condensed_history: str, 
-                         evolution_count: int = 0, chat_messages: str = '', llm_config: Optional[dict] = None) -> dict:
+                         evolution_count: int = 0, chat_messages: str = '', llm_config: Optional[dict] = None,
+                         story_id: Optional[str] = None, video_id: str = '') -> dict:
         """
         Simulate a video by evolving its description to create a dynamic narrative.
+
+        The story is kept server-side: when a known story_id is given the other
+        story fields are ignored, otherwise a new story is created from them.
+        Callers without a story_id keep their own history: their story only lives for
+        this call, and their condensed history is returned unchanged.
         
         Args:
             original_title: The original video title
@@ -287,50 +534,78 @@ class VideoGenerationAPI:
             condensed_history: A condensed summary of previous scene developments
             evolution_count: How many times the simulation has already evolved
             chat_messages: Chat messages from users to incorporate into the simulation
+            story_id: Optional handle of a server-side story returned by a previous call
+            video_id: The id of the simulated video
             
         Returns:
-            A dictionary containing the evolved description and updated condensed history
+            A dictionary containing the evolved description, the history and the story handle
         """
+        story = self.story_states.get(story_id)
+        transient = story is None and not story_id
+        if story is None:
+            new_story = self.story_states.build if transient else self.story_states.create
+            story = new_story(
+                video_id, original_title, original_description,
+                current_description, condensed_history, evolution_count
+            )
+
         try:
+            history = story.get_history()
+
             # Determine if this is the first simulation
-            is_first_simulation = evolution_count == 0 or not condensed_history
+            is_first_simulation = story.evolution_count == 0 or not history
             
             #logger.info(f"simulate(): is_first_simulation={is_first_simulation}")
-                
-            # Create an appropriate prompt based on whether this is the first simulation
+
+            def build_prompt(history: str, chat_section: str) -> str:
+                # Create an appropriate prompt based on whether this is the first simulation
+                if is_first_simulation:
+                    return SIMULATE_VIDEO_FIRST_PROMPT_TEMPLATE.format(
+                        original_title=story.original_title,
+                        original_description=story.original_description,
+                        chat_section=chat_section
+                    )
+                return SIMULATE_VIDEO_CONTINUE_PROMPT_TEMPLATE.format(
+                    original_title=story.original_title,
+                    original_description=story.original_description,
+                    condensed_history=history,
+                    current_description=story.current_description,
+                    chat_section=chat_section
+                )
+
+            # Enforce the prompt token budget: the history is only cut if the prompt
+            # doesn't fit even without chat, then the chat gets what is left
+            prompt_tokens = estimate_tokens(build_prompt(history, ''))
+            if prompt_tokens > STORY_PROMPT_TOKEN_BUDGET:
+                history = truncate_to_tokens(
+                    history,
+                    estimate_tokens(history) - (prompt_tokens - STORY_PROMPT_TOKEN_BUDGET)
+                )
+                prompt_tokens = estimate_tokens(build_prompt(history, ''))
+
             chat_section = ""
-            if chat_messages:
-                #logger.info(f"CHAT_DEBUG: Server received chat messages for simulation: {chat_messages}")
-                chat_section = f"""
+            chat_header = """
 People are watching this content right now and have shared their thoughts. Like a game master, please take their feedbacks as input to adjust the story and/or the scene (eg if they as you to make the character in the story move somplace, do things.. you MUST change the story and scene description accordingly, but also keep previous elements consistant, eg if a new character, location, clothing item.. is introduced then keep it etc). Here are their messages:
 
-{chat_messages}
 """
+            chat_messages = fit_chat_messages(
+                chat_messages,
+                STORY_PROMPT_TOKEN_BUDGET - prompt_tokens - estimate_tokens(chat_header)
+            )
+            if chat_messages:
+                #logger.info(f"CHAT_DEBUG: Server received chat messages for simulation: {chat_messages}")
+                chat_section = f"{chat_header}{chat_messages}\n"
             #else:
             #    logger.info("CHAT_DEBUG: Server simulation called with no chat messages")
-   
 
-            if is_first_simulation:
-                prompt = SIMULATE_VIDEO_FIRST_PROMPT_TEMPLATE.format(
-                    original_title=original_title,
-                    original_description=original_description,
-                    chat_section=chat_section
-                )
-            else:
-                prompt = SIMULATE_VIDEO_CONTINUE_PROMPT_TEMPLATE.format(
-                    original_title=original_title,
-                    original_description=original_description,
-                    condensed_history=condensed_history,
-                    current_description=current_description,
-                    chat_section=chat_section
-                )
+            prompt = build_prompt(history, chat_section)
 
             # Generate the evolved description using the helper method
             response = await generate_text(
                 prompt,
                 llm_config=llm_config,
-                max_new_tokens=240,
-                temperature=0.60
+                temperature=0.60,
+                task='simulate'
             )
 
             # print("RAW RESPONSE: ", response)
@@ -340,32 +615,67 @@ People are watching this content right now and have shared their thoughts. Like
             
             # If response is empty, use fallback
             if not evolved_description:
-                evolved_description = current_description
+                evolved_description = story.current_description
                 logger.warning(f"Empty response, using current description as fallback")
+            else:
+                story.current_description = evolved_description
+                story.recent_scenes.append(evolved_description)
+                story.evolution_count += 1
+
+                # Condense the recent scenes in the background, so simulate latency stays flat
+                if not transient and len(story.recent_scenes) > STORY_CONDENSE_EVERY and not story.condensing:
+                    story.condensing = True
+                    task = asyncio.create_task(self._condense_story(story, llm_config))
+                    self.pending_tasks.add(task)
+                    task.add_done_callback(self.pending_tasks.discard)
             
-            # Pass the condensed history through unchanged
             return {
                 "evolved_description": evolved_description,
-                "condensed_history": condensed_history
+                "condensed_history": condensed_history if transient else story.get_history(),
+                "story_id": None if transient else story.story_id
             }
             
         except Exception as e:
             logger.error(f"Error simulating video: {str(e)}")
             return {
-                "evolved_description": current_description,
-                "condensed_history": condensed_history
+                "evolved_description": story.current_description,
+                "condensed_history": condensed_history if transient else story.get_history(),
+                "story_id": None if transient else story.story_id
             }
 
+    async def _condense_story(self, story: StoryState, llm_config: Optional[dict] = None):
+        """Merge the recent scenes of a story (except the current one) into its condensed history"""
+        scenes = story.recent_scenes[:-1]
+        try:
+            prompt = CONDENSE_STORY_PROMPT_TEMPLATE.format(
+                original_title=story.original_title,
+                condensed_history=story.condensed_history or "(nothing yet)",
+                new_scenes="\n".join(f"- {scene}" for scene in scenes),
+                max_words=STORY_HISTORY_TOKEN_BUDGET * 3 // 4
+            )
+            summary = await generate_text(
+                prompt,
+                llm_config=llm_config,
+                temperature=0.3,
+                task='condense'
+            )
+            summary = summary.strip()
+            if summary:
+                story.condensed_history = truncate_to_tokens(summary, STORY_HISTORY_TOKEN_BUDGET)
+                # Scenes evolved while we were condensing are kept for the next round
+                story.recent_scenes = story.recent_scenes[len(scenes):]
+        except Exception as e:
+            logger.error(f"Error condensing story {story.story_id}: {str(e)}")
+        finally:
+            story.condensing = False
+
     async def _generate_clip_prompt(self, video_id: str, title: str, description: str) -> str:
         """Generate a new prompt for the next clip based on event history"""
-        events = self.video_events.get(video_id, [])
-        events_json = "\n".join(json.dumps(event) for event in events)
-        
         prompt = GENERATE_CLIP_PROMPT_TEMPLATE.format(
             title=title,
             description=description,
-            event_count=len(events),
-            events_json=events_json
+            event_count=self.video_events.count(video_id),
+            events_json=self.video_events.get_json_lines(video_id)
         )
 
         try:
@@ -373,8 +683,8 @@ People are watching this content right now and have shared their thoughts. Like
             response = await generate_text(
                 prompt,
                 llm_config=None,  # Use default config
-                max_new_tokens=200,
-                temperature=0.7
+                temperature=0.7,
+                task='clip_prompt'
             )
             
             # Clean up the response
@@ -386,8 +696,8 @@ People are watching this content right now and have shared their thoughts. Like
             
         except Exception as e:
             logger.error(f"Error generating clip prompt: {str(e)}")
-            # Fallback to original description if prompt generation fails
-            return description
+            # The clip will fall back to the static caption
+            return ""
 
     async def generate_video_thumbnail(self, title: str, description: str, video_prompt_prefix: str, options: dict, user_role: UserRole = 'anon') -> str:
         """
@@ -412,6 +722,17 @@ People are watching this content right now and have shared their thoughts. Like
             "request_id": request_id
         })
         
+        # Derive the thumbnail from a clip of the same video and seed if one was generated recently
+        # (without an explicit seed, the most recent clip of the video will do)
+        if THUMBNAIL_DERIVE_ENABLED and self.thumbnail_deriver.available:
+            source_clip = self.recent_clips.get(self._get_source_clip_key(title, description, options.get('seed')))
+            if source_clip:
+                thumbnail = await self.thumbnail_deriver.derive(source_clip)
+                if thumbnail:
+                    logger.info(f"[{request_id}] Derived thumbnail from a recent clip")
+                    return thumbnail
+            self.thumbnail_endpoint_fallbacks += 1
+
         # Use a shorter prompt for thumbnails
         prompt = f"{clip_caption}, {POSITIVE_PROMPT_SUFFIX}"
         logger.info(f"[{request_id}] Using prompt: '{prompt}'")
@@ -435,13 +756,8 @@ People are watching this content right now and have shared their thoughts. Like
         # Add thumbnail-specific tag to help debugging and metrics
         options['thumbnail'] = True
         
-        # Check for available endpoints before attempting generation
-        available_endpoints = sum(1 for ep in self.endpoint_manager.endpoints 
-                               if not ep.busy and time.time() > ep.error_until)
-        logger.info(f"[{request_id}] Available endpoints: {available_endpoints}/{len(self.endpoint_manager.endpoints)}")
-        
-        if available_endpoints == 0:
-            logger.error(f"[{request_id}] No available endpoints for thumbnail generation")
+        # Wait in the thumbnail lane's short queue for an endpoint, instead of failing right away
+        if not await self._wait_for_thumbnail_endpoint(request_id):
             return ""
         
         # Use the same logic as regular video generation but with thumbnail settings
@@ -480,14 +796,43 @@ People are watching this content right now and have shared their thoughts. Like
                 logger.error(f"[{request_id}] Traceback: {traceback.format_exc()}")
             return ""  # Return empty string instead of raising to avoid crashes
     
+    async def _wait_for_thumbnail_endpoint(self, request_id: str) -> bool:
+        """Wait for a free endpoint of the thumbnail lane, returns False if the queue is full or the wait timed out"""
+        if self.endpoint_manager.count_free_endpoints('thumbnail'):
+            return True
+
+        if self.thumbnail_queue_depth >= THUMBNAIL_QUEUE_MAX_SIZE:
+            logger.error(f"[{request_id}] Thumbnail queue is full ({self.thumbnail_queue_depth} waiting)")
+            self.thumbnail_queue_stats['rejected'] += 1
+            return False
+
+        self.thumbnail_queue_depth += 1
+        self.thumbnail_queue_stats['queued'] += 1
+        start_time = time.time()
+        try:
+            available = await self.endpoint_manager.wait_for_free_endpoint('thumbnail', THUMBNAIL_QUEUE_TIMEOUT_SECONDS)
+        finally:
+            self.thumbnail_queue_depth -= 1
+            self.thumbnail_queue_stats['total_wait'] += time.time() - start_time
+
+        if not available:
+            logger.error(f"[{request_id}] No available endpoints for thumbnail generation after {THUMBNAIL_QUEUE_TIMEOUT_SECONDS}s")
+            self.thumbnail_queue_stats['timeouts'] += 1
+        return available
+
     async def generate_video(self, title: str, description: str, video_prompt_prefix: str, options: dict, user_role: UserRole = 'anon') -> str:
         """Generate video using available space from pool"""
         video_id = options.get('video_id', str(uuid.uuid4()))
         
-        # Generate a new prompt based on event history
-        #clip_caption = await self._generate_clip_prompt(video_id, title, description)
         clip_caption = f"{video_prompt_prefix} - {title.strip()} - {description.strip()}"
 
+        # Use the prompt generated from the event history while the previous clip rendered, if it is ready
+        # (prompts are only prefetched for clips of a known video, since they follow its history)
+        if CLIP_PROMPT_ENABLED and 'video_id' in options:
+            clip_prompt = await self.clip_prompts.get_prompt(video_id, title, description)
+            if clip_prompt:
+                clip_caption = f"{video_prompt_prefix} - {clip_prompt}"
+
         # Add the new clip to event history
         self._add_event(video_id, {
             "time": datetime.datetime.utcnow().isoformat() + "Z",
@@ -495,6 +840,33 @@ People are watching this content right now and have shared their thoughts. Like
             "caption": clip_caption
         })
 
+        request = self._get_clip_request(clip_caption, options, user_role)
+
+        # The first clip of a search result may have been started before the client asked for it
+        video_data = None
+        if WARM_START_ENABLED:
+            video_data = await self.warm_starts.take(self._get_clip_request_key(request))
+
+        if not video_data:
+            # Generate the video with standard settings
+            # historically we used _generate_video_content_with_inference_endpoints,
+            # which offers better performance and relability, but costs were spinning out of control
+            video_data = await generate_video_content_with_inference_endpoints(self.endpoint_manager, **request)
+
+        # Keep the clip around so the thumbnail of the video can be derived from it
+        if video_data and THUMBNAIL_DERIVE_ENABLED:
+            self.recent_clips.set(self._get_source_clip_key(title, description, request['seed']), video_data)
+            self.recent_clips.set(self._get_source_clip_key(title, description, None), video_data)
+
+        return video_data
+
+    @staticmethod
+    def _get_source_clip_key(title: str, description: str, seed: Optional[int]) -> str:
+        """Get the key of the clips a thumbnail may be derived from"""
+        return make_cache_key(title.strip(), description.strip(), seed)
+
+    def _get_clip_request(self, clip_caption: str, options: dict, user_role: UserRole) -> Dict[str, Any]:
+        """Get the parameters of the generation of a clip"""
         # Use the generated caption as the prompt
         prompt = f"{clip_caption}, {POSITIVE_PROMPT_SUFFIX}"
         
@@ -521,23 +893,63 @@ People are watching this content right now and have shared their thoughts. Like
             # logger.info(f"generate_video()  Orientation: {orientation}, using original dimensions width={width}, height={height}, steps={num_inference_steps}, fps={frame_rate} | role: {user_role}")
             pass
         
-        # Generate the video with standard settings
-        # historically we used _generate_video_content_with_inference_endpoints,
-        # which offers better performance and relability, but costs were spinning out of control
-        return await generate_video_content_with_inference_endpoints(
-            self.endpoint_manager,
-            prompt=prompt,
-            negative_prompt=options.get('negative_prompt', NEGATIVE_PROMPT),
-            width=width,
-            height=height,
-            num_frames=num_frames,
-            num_inference_steps=num_inference_steps,
-            frame_rate=frame_rate,
-            seed=options.get('seed', 42),
-            options=options,
-            user_role=user_role
+        return {
+            'prompt': prompt,
+            'negative_prompt': options.get('negative_prompt', NEGATIVE_PROMPT),
+            'width': width,
+            'height': height,
+            'num_frames': num_frames,
+            'num_inference_steps': num_inference_steps,
+            'frame_rate': frame_rate,
+            'seed': options.get('seed', 42),
+            'options': options,
+            'user_role': user_role
+        }
+
+    @staticmethod
+    def _get_clip_request_key(request: Dict[str, Any]) -> str:
+        """Get a key identifying the output of a clip generation (what the endpoint receives)"""
+        return make_cache_key(
+            request['prompt'],
+            request['negative_prompt'],
+            request['width'],
+            request['height'],
+            request['num_frames'],
+            request['num_inference_steps'],
+            request['frame_rate'],
+            request['seed'],
+            request['options'].get('guidance_scale', GUIDANCE_SCALE)
         )
 
+    def warm_start_search_result(self, result: dict, video_prompt_prefix: str = '',
+                                 options: Optional[dict] = None, user_role: UserRole = 'anon') -> bool:
+        """
+        Start generating the first clip of a search result in the background, if endpoints are idle,
+        so the client's following generate_video request gets it sooner.
+
+        The prompt prefix and generation options should be the ones the client will use,
+        otherwise the request won't match and the generation is wasted.
+        Returns whether a generation was started.
+        """
+        if self.endpoint_manager.count_free_endpoints('clip') < WARM_START_MIN_FREE_ENDPOINTS:
+            self.warm_starts.skipped += 1
+            return False
+
+        options = {**(options or {}), 'seed': result.get('seed', 42)}
+        # The first clip has no history to build an LLM prompt from
+        options.pop('video_id', None)
+        clip_caption = f"{video_prompt_prefix} - {result.get('title', '').strip()} - {result.get('description', '').strip()}"
+        request = self._get_clip_request(clip_caption, options, user_role)
+
+        key = self._get_clip_request_key(request)
+        if not self.warm_starts.can_start(key):
+            return False
+
+        self.warm_starts.put(key, asyncio.create_task(
+            generate_video_content_with_inference_endpoints(self.endpoint_manager, **request)
+        ))
+        return True
+
     async def handle_chat_message(self, data: dict, ws: web.WebSocketResponse) -> dict:
         """Process and broadcast a chat message"""
         video_id = data.get('videoId')
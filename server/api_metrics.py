@@ -10,8 +10,11 @@ logger = logging.getLogger(__name__)
 class MetricsTracker:
     """
     Tracks usage metrics across the API server.
+    In the multi-process mode, the rate limit counters are shared by the workers.
     """
-    def __init__(self):
+    def __init__(self, shared_state=None):
+        self.shared_state = shared_state
+        
         # Total metrics since server start
         self.total_requests = {
             'chat': 0,
@@ -73,6 +76,9 @@ class MetricsTracker:
         # Server start time
         self.start_time = time.time()
         
+        # Users forgotten by prune
+        self.pruned_users = 0
+        
     async def record_request(self, user_id: str, ip: str, request_type: str, role: str):
         """Record a request for metrics and rate limiting"""
         async with self.lock:
@@ -101,6 +107,16 @@ class MetricsTracker:
             for minute in list(self.time_buckets[user_id].keys()):
                 if minute < cutoff:
                     del self.time_buckets[user_id][minute]
+        
+        if self.shared_state is not None:
+            # Only the current and previous minutes are used for rate limiting
+            await self.shared_state.request(
+                'incr', key=self._get_rate_key(user_id, current_minute, request_type), ttl=120
+            )
+    
+    @staticmethod
+    def _get_rate_key(user_id: str, minute: int, request_type: str) -> str:
+        return f"rate:{user_id}:{minute}:{request_type}"
     
     def register_session(self, user_id: str, ip: str):
         """Register a new session for an IP address"""
@@ -113,35 +129,56 @@ class MetricsTracker:
             if not self.ip_sessions[ip]:
                 del self.ip_sessions[ip]
     
+    def prune(self, retention: float = 3600) -> int:
+        """Forget the users disconnected and inactive for more than retention seconds, returns their number"""
+        connected = set().union(*self.ip_sessions.values())
+        cutoff = time.time() - retention
+        stale = [
+            user_id for user_id, user_data in self.user_metrics.items()
+            if user_data['last_active'] < cutoff and user_id not in connected
+        ]
+        for user_id in stale:
+            del self.user_metrics[user_id]
+        for user_id in [user_id for user_id in self.time_buckets if user_id not in self.user_metrics]:
+            del self.time_buckets[user_id]
+        self.pruned_users += len(stale)
+        return len(stale)
+    
     def get_session_count_for_ip(self, ip: str) -> int:
         """Get the number of active sessions for an IP address"""
         return len(self.ip_sessions.get(ip, set()))
     
     async def is_rate_limited(self, user_id: str, request_type: str, role: str) -> bool:
         """Check if a user is currently rate limited for a request type"""
-        async with self.lock:
-            current_minute = int(time.time() / 60)
-            prev_minute = current_minute - 1
-            
-            # Count requests in current and previous minute
-            current_count = self.time_buckets[user_id][current_minute][request_type]
-            prev_count = self.time_buckets[user_id][prev_minute][request_type]
-            
-            # Calculate requests per minute rate (weighted average)
-            # Weight current minute more as it's more recent
-            rate = (current_count * 0.7) + (prev_count * 0.3)
-            
-            # Get rate limit based on user role
-            limit = self.rate_limits.get(role, self.rate_limits['anon']).get(
-                request_type, self.rate_limits['anon']['other'])
-            
-            # Check if rate exceeds limit
-            return rate >= limit
+        current_minute = int(time.time() / 60)
+        prev_minute = current_minute - 1
+        
+        # Count requests in current and previous minute (across all the workers if shared)
+        if self.shared_state is not None:
+            current_count, prev_count = await self.shared_state.request('get', keys=[
+                self._get_rate_key(user_id, current_minute, request_type),
+                self._get_rate_key(user_id, prev_minute, request_type)
+            ])
+        else:
+            async with self.lock:
+                current_count = self.time_buckets[user_id][current_minute][request_type]
+                prev_count = self.time_buckets[user_id][prev_minute][request_type]
+        
+        # Calculate requests per minute rate (weighted average)
+        # Weight current minute more as it's more recent
+        rate = (current_count * 0.7) + (prev_count * 0.3)
+        
+        # Get rate limit based on user role
+        limit = self.rate_limits.get(role, self.rate_limits['anon']).get(
+            request_type, self.rate_limits['anon']['other'])
+        
+        # Check if rate exceeds limit
+        return rate >= limit
     
     def get_metrics(self) -> Dict:
         """Get a snapshot of current metrics"""
         active_users = {
-            'total': len(self.user_metrics),
+            'total': len(self.user_metrics) + self.pruned_users,
             'anon': 0,
             'normal': 0,
             'pro': 0,
@@ -1,6 +1,9 @@
 import asyncio
 import logging
-from typing import Dict, Set
+import secrets
+import sys
+from collections import deque
+from typing import Deque, Dict, Optional
 from aiohttp import web, WSMsgType
 import json
 import time
@@ -8,13 +11,68 @@ import datetime
 from .api_core import VideoGenerationAPI
 from .logging_utils import get_logger
 from .config_utils import get_game_master_prompt
+from .dispatcher import ActionSpec, DispatchMetrics, SessionDispatcher, error_response
+from .ws_codec import send_message
+from .api_config import (
+    SHARED_STORY_ENABLED,
+    SHARED_STORY_MAX_PER_SESSION,
+    SHARED_STREAM_ENABLED,
+    SHARED_STREAM_MAX_PER_SESSION,
+    WARM_START_ENABLED,
+    THUMBNAIL_BATCH_MAX_CARDS,
+    THUMBNAIL_BATCH_CONCURRENCY,
+    SESSION_LANE_CONCURRENCY,
+    SESSION_MAX_CONCURRENT_REQUESTS,
+    SESSION_RESUME_ENABLED,
+    SESSION_RESUME_GRACE_SECONDS,
+    SESSION_RESUME_BUFFER_MESSAGES,
+    DISPATCH_METRICS_WINDOW_SECONDS,
+    VIDEO_ROUND_ROBIN_ENDPOINT_URLS
+)
 
 logger = get_logger(__name__)
 
+# How each WebSocket action is dispatched (lower priorities go first when a session is saturated)
+SESSION_ACTIONS: Dict[str, ActionSpec] = {
+    'heartbeat': ActionSpec('_handle_heartbeat', lane='control', inline=True),
+    'get_user_role': ActionSpec('_handle_get_user_role', lane='control', inline=True),
+    'join_chat': ActionSpec('_handle_chat', lane='chat', request_type='chat', error_prefix='Chat error'),
+    'chat_message': ActionSpec('_handle_chat', lane='chat', request_type='chat', error_prefix='Chat error'),
+    'leave_chat': ActionSpec('_handle_chat', lane='chat', request_type='chat', error_prefix='Chat error'),
+    'subscribe_story': ActionSpec('_handle_subscribe_story', lane='subscription', request_type='simulation',
+                                  priority=1, admission=True),
+    'unsubscribe_story': ActionSpec('_handle_unsubscribe_story', lane='subscription', priority=1),
+    'subscribe_stream': ActionSpec('_handle_subscribe_stream', lane='subscription', request_type='video',
+                                   priority=1, admission=True),
+    'unsubscribe_stream': ActionSpec('_handle_unsubscribe_stream', lane='subscription', priority=1),
+    'search': ActionSpec('_handle_search', lane='search', request_type='search', priority=2),
+    'simulate': ActionSpec('_handle_simulate', lane='simulation', request_type='simulation', priority=2),
+    'generate_caption': ActionSpec('_handle_generate_caption', lane='caption', priority=2),
+    'generate_video_thumbnail': ActionSpec('_handle_generate_video_thumbnail', lane='thumbnail', priority=3,
+                                           admission=True),
+    'generate_video_thumbnails': ActionSpec('_handle_generate_video_thumbnails', lane='thumbnail', priority=3,
+                                            admission=True),
+    # Deprecated thumbnail actions
+    'generate_thumbnail': ActionSpec('_handle_deprecated_thumbnail', lane='thumbnail', priority=3, admission=True),
+    'old_generate_thumbnail': ActionSpec('_handle_deprecated_thumbnail', lane='thumbnail', priority=3,
+                                         admission=True),
+    'generate_video': ActionSpec('_handle_generate_video', lane='video', request_type='video',
+                                 priority=4, admission=True, error_prefix='Video generation error'),
+}
+
+# Dispatch latency of each action, across all the sessions
+dispatch_metrics = DispatchMetrics(window=DISPATCH_METRICS_WINDOW_SECONDS)
+
+def _estimate_payload_size(payload: dict) -> int:
+    """Rough size in bytes of a message, dominated by its strings (clips and thumbnails are data URIs)"""
+    return sys.getsizeof(payload) + sum(
+        sys.getsizeof(value) for value in payload.values() if isinstance(value, (str, bytes))
+    )
+
 class UserSession:
     """
     Represents a user's session with the API.
-    Each WebSocket connection gets its own session with separate queues and rate limits.
+    Each WebSocket connection gets its own session with its own dispatcher and rate limits.
     """
     def __init__(self, user_id: str, user_role: str, ws: web.WebSocketResponse, shared_api):
         self.user_id = user_id
@@ -22,11 +80,10 @@ class UserSession:
         self.ws = ws
         self.shared_api = shared_api  # For shared resources like endpoint manager
         
-        # Create separate queues for this user session
-        self.chat_queue = asyncio.Queue()
-        self.video_queue = asyncio.Queue()
-        self.search_queue = asyncio.Queue()
-        self.simulation_queue = asyncio.Queue()  # New queue for description evolution
+        self.dispatcher = SessionDispatcher(
+            self, SESSION_ACTIONS, self._get_lane_limits(), SESSION_MAX_CONCURRENT_REQUESTS,
+            self.send, dispatch_metrics, admission=shared_api.admission
+        )
         
         # Track request counts and rate limits
         self.request_counts = {
@@ -44,545 +101,591 @@ class UserSession:
             'simulation': time.time()  # New timestamp for simulation requests
         }
         
-        # Session creation time
+        # Session creation time, and time of the last message of the client
         self.created_at = time.time()
+        self.last_activity = self.created_at
         
-        self.background_tasks = []
+        # A client which loses its connection can resume the session with this token within a grace
+        # period, its requests keep running meanwhile and their results are buffered
+        self.resume_token = secrets.token_urlsafe(24) if SESSION_RESUME_ENABLED else None
+        self.detached_at: Optional[float] = None
+        self.resume_buffer: Deque[dict] = deque(maxlen=SESSION_RESUME_BUFFER_MESSAGES)
+        self.dropped_results = 0
+
+    def _get_lane_limits(self) -> Dict[str, int]:
+        """Get the concurrency limit of each lane, the video one depending on the user role"""
+        max_concurrent = len(VIDEO_ROUND_ROBIN_ENDPOINT_URLS)
+        if self.user_role == 'anon':
+            max_concurrent = min(2, max_concurrent)  # Limit anonymous users
+        elif self.user_role == 'normal':
+            max_concurrent = min(4, max_concurrent)  # Standard users
+        # Pro and admin can use all endpoints
+        return {**SESSION_LANE_CONCURRENCY, 'video': max(1, max_concurrent)}
         
     async def start(self):
-        """Start all the queue processors for this session"""
-        # Start background tasks for handling different request types
-        logger.info(f"Creating background tasks for user {self.user_id}")
-        self.background_tasks = [
-            asyncio.create_task(self._process_chat_queue()),
-            asyncio.create_task(self._process_video_queue()),
-            asyncio.create_task(self._process_search_queue()),
-            asyncio.create_task(self._process_simulation_queue())  # New worker for simulation requests
-        ]
-        logger.info(f"Started session for user {self.user_id} with role {self.user_role}, created {len(self.background_tasks)} background tasks")
+        """Start the session (requests get their tasks as they arrive)"""
+        logger.info(f"Started session for user {self.user_id} with role {self.user_role}")
+
+    @staticmethod
+    def get_request_type(action: str) -> str:
+        """Get the request type of an action, used for the rate limits"""
+        spec = SESSION_ACTIONS.get(action)
+        return spec.request_type if spec else 'other'
+
+    async def dispatch(self, data: dict) -> None:
+        """Dispatch a request to the handler of its action"""
+        await self.dispatcher.dispatch(data)
+
+    async def send(self, payload: dict) -> None:
+        """Send a message to the user, with the codec of its connection (or buffer it while detached)"""
+        if self.detached_at is not None:
+            if len(self.resume_buffer) == self.resume_buffer.maxlen:
+                self.dropped_results += 1
+            self.resume_buffer.append(payload)
+            return
+        await send_message(self.ws, payload)
+
+    async def detach(self) -> None:
+        """Keep the session running without a connection, buffering its results until it is resumed"""
+        self.detached_at = time.time()
+        # Chat rooms, shared stories and streams are pushed live, the client joins them again when it resumes
+        self.shared_api.chat_manager.leave_all(self.ws)
+        await self.shared_api.shared_stories.unsubscribe_all(self.ws)
+        await self.shared_api.shared_streams.unsubscribe_all(self.ws)
+
+    async def attach(self, ws: web.WebSocketResponse) -> int:
+        """Resume the session on a new connection, sending the results buffered meanwhile"""
+        self.ws = ws
+        self.detached_at = None
+        self.last_activity = time.time()
+        buffered = list(self.resume_buffer)
+        self.resume_buffer.clear()
+        for payload in buffered:
+            await self.send(payload)
+        return len(buffered)
+
+    def record_request(self, request_type: str) -> None:
+        """Update the request counts once a request has been handled"""
+        if request_type in self.request_counts:
+            self.request_counts[request_type] += 1
+            self.last_request_times[request_type] = time.time()
         
+    def estimate_memory(self) -> int:
+        """Rough size in bytes of what the session holds: its own objects, and its queued and buffered messages"""
+        size = sum(sys.getsizeof(obj) for obj in (
+            self, self.__dict__, self.dispatcher, self.dispatcher.__dict__, self.resume_buffer
+        ))
+        size += sum(_estimate_payload_size(payload) for payload in self.resume_buffer)
+        size += sum(
+            _estimate_payload_size(request[3]) for queue in self.dispatcher.pending.values() for request in queue
+        )
+        outbox = getattr(self.ws, 'outbox', None)
+        if outbox is not None:
+            size += outbox.bytes
+        return size
+
     async def stop(self):
         """Stop all background tasks for this session"""
-        for task in self.background_tasks:
-            task.cancel()
-        
+        self.shared_api.chat_manager.leave_all(self.ws)
+        await self.shared_api.shared_stories.unsubscribe_all(self.ws)
+        await self.shared_api.shared_streams.unsubscribe_all(self.ws)
+
         try:
-            # Wait for tasks to complete cancellation
-            await asyncio.gather(*self.background_tasks, return_exceptions=True)
+            # Drop the queued requests and wait for the running ones to be cancelled
+            await self.dispatcher.stop()
         except asyncio.CancelledError:
             pass
         
         logger.info(f"Stopped session for user {self.user_id}")
+
+    async def _handle_heartbeat(self, data: dict) -> dict:
+        # Include user role info in heartbeat response
+        return {
+            'action': 'heartbeat',
+            'requestId': data.get('requestId'),
+            'success': True,
+            'user_role': self.user_role
+        }
+
+    async def _handle_get_user_role(self, data: dict) -> dict:
+        return {
+            'action': 'get_user_role',
+            'requestId': data.get('requestId'),
+            'success': True,
+            'user_role': self.user_role
+        }
         
-    async def _process_chat_queue(self):
-        """High priority queue for chat operations"""
-        while True:
-            data = await self.chat_queue.get()
-            try:
-                if data['action'] == 'join_chat':
-                    result = await self.shared_api.handle_join_chat(data, self.ws)
-                elif data['action'] == 'chat_message':
-                    result = await self.shared_api.handle_chat_message(data, self.ws)
-                elif data['action'] == 'leave_chat':
-                    result = await self.shared_api.handle_leave_chat(data, self.ws)
-                # Redirect thumbnail requests to process_generic_request for consistent handling
-                elif data['action'] == 'generate_video_thumbnail':
-                    # Pass to the generic request handler to maintain consistent logic
-                    await self.process_generic_request(data)
-                    # Skip normal response handling since process_generic_request already sends a response
-                    self.chat_queue.task_done()
-                    continue
-                else:
-                    raise ValueError(f"Unknown chat action: {data['action']}")
-                    
-                await self.ws.send_json(result)
-                
-                # Update metrics
-                self.request_counts['chat'] += 1
-                self.last_request_times['chat'] = time.time()
-                
-            except Exception as e:
-                logger.error(f"Error processing chat request for user {self.user_id}: {e}")
-                try:
-                    await self.ws.send_json({
-                        'action': data['action'],
-                        'requestId': data.get('requestId'),
-                        'success': False,
-                        'error': f'Chat error: {str(e)}'
-                    })
-                except Exception as send_error:
-                    logger.error(f"Error sending error response: {send_error}")
-            finally:
-                self.chat_queue.task_done()
-
-    async def _process_video_queue(self):
-        """Process multiple video generation requests in parallel for this user"""
-        try:
-            try:
-                from .api_config import VIDEO_ROUND_ROBIN_ENDPOINT_URLS
-            except ImportError:
-                try:
-                    from server.api_config import VIDEO_ROUND_ROBIN_ENDPOINT_URLS
-                except ImportError:
-                    logger.error(f"Failed to import VIDEO_ROUND_ROBIN_ENDPOINT_URLS for user {self.user_id}")
-                    return
-            
-            active_tasks = set()
-            # Set a per-user concurrent limit based on role
-            max_concurrent = len(VIDEO_ROUND_ROBIN_ENDPOINT_URLS)
-            if self.user_role == 'anon':
-                max_concurrent = min(2, max_concurrent)  # Limit anonymous users
-            elif self.user_role == 'normal':
-                max_concurrent = min(4, max_concurrent)  # Standard users
-            # Pro and admin can use all endpoints
-
-            async def process_single_request(data):
-                request_id = data.get('requestId', 'unknown')
-                try:
-                    title = data.get('title', '')
-                    description = data.get('description', '')
-                    video_prompt_prefix = data.get('video_prompt_prefix', '')
-                    options = data.get('options', {})
-                    
-                    #logger.info(f"Starting video generation for user {self.user_id}: title='{title[:50]}...', role={self.user_role}")
-                    start_time = time.time()
-                    
-                    # Pass the user role to generate_video
-                    video_data = await self.shared_api.generate_video(
-                        title, description, video_prompt_prefix, options, self.user_role
-                    )
-                    
-                    generation_time = time.time() - start_time
-                    logger.info(f"generated clip in {generation_time:.2f}s (len: {len(video_data) if video_data else 0})")
-                    
-                    result = {
-                        'action': 'generate_video',
-                        'requestId': data.get('requestId'),
-                        'success': True,
-                        'video': video_data,
-                    }
-                    
-                    #logger.info(f"Sending video generation response to user {self.user_id}")
-                    await self.ws.send_json(result)
-                    
-                    # Update metrics
-                    self.request_counts['video'] += 1
-                    self.last_request_times['video'] = time.time()
-                    
-                except Exception as e:
-                    logger.error(f"Error processing video request for user {self.user_id}: {e}")
-                    try:
-                        logger.info(f"Sending error response to user {self.user_id}")
-                        await self.ws.send_json({
-                            'action': 'generate_video',
-                            'requestId': data.get('requestId'),
-                            'success': False,
-                            'error': f'Video generation error: {str(e)}'
-                        })
-                    except Exception as send_error:
-                        logger.error(f"Error sending error response: {send_error}")
-                finally:
-                    active_tasks.discard(asyncio.current_task())
-
-            logger.info(f"Video queue processor started for user {self.user_id} with max_concurrent={max_concurrent}")
-            
-            while True:
-                # Clean up completed tasks
-                active_tasks = {task for task in active_tasks if not task.done()}
-                
-                # Log queue processing activity every few iterations
-                if hasattr(self, '_queue_debug_counter'):
-                    self._queue_debug_counter += 1
-                else:
-                    self._queue_debug_counter = 1
-                    
-                if self._queue_debug_counter % 50 == 0:  # Log every 5 seconds (50 * 0.1s)
-                    queue_size = self.video_queue.qsize()
-                    # let's hide this log, it is too verbose
-                    #logger.info(f"Video queue processor heartbeat for user {self.user_id}: queue_size={queue_size}, active_tasks={len(active_tasks)}/{max_concurrent}")
-                
-                # Start new tasks if we have capacity
-                while len(active_tasks) < max_concurrent:
-                    try:
-                        # Use try_get to avoid blocking if queue is empty
-                        data = await asyncio.wait_for(self.video_queue.get(), timeout=0.1)
-                        
-                        request_id = data.get('requestId', 'unknown')
-                        #logger.info(f"[{request_id}] Picked up video request from queue for user {self.user_id}, creating task (active: {len(active_tasks)}/{max_concurrent})")
-                        
-                        # Create and start new task
-                        task = asyncio.create_task(process_single_request(data))
-                        active_tasks.add(task)
-                        
-                    except asyncio.TimeoutError:
-                        # No items in queue, break inner loop
-                        break
-                    except Exception as e:
-                        logger.error(f"Error creating video generation task for user {self.user_id}: {e}")
-                        break
-
-                # Wait a short time before checking queue again
-                await asyncio.sleep(0.1)
-
-                # Handle any completed tasks' errors
-                for task in list(active_tasks):
-                    if task.done():
-                        try:
-                            await task
-                        except Exception as e:
-                            logger.error(f"Task failed with error for user {self.user_id}: {e}")
-                        active_tasks.discard(task)
-                        
-        except Exception as e:
-            logger.error(f"Video queue processor crashed for user {self.user_id}: {e}")
-            import traceback
-            logger.error(f"Video queue processor traceback: {traceback.format_exc()}")
-            raise  # Re-raise to ensure the error is visible
-
-    async def _process_search_queue(self):
-        """Medium priority queue for search operations"""
-        while True:
-            try:
-                data = await self.search_queue.get()
-                request_id = data.get('requestId')
-                query = data.get('query', '').strip()
-                attempt_count = data.get('attemptCount', 0)
-                llm_config = data.get('llm_config')
+    async def _handle_chat(self, data: dict) -> dict:
+        if data['action'] == 'join_chat':
+            return await self.shared_api.handle_join_chat(data, self.ws)
+        elif data['action'] == 'chat_message':
+            return await self.shared_api.handle_chat_message(data, self.ws)
+        return await self.shared_api.handle_leave_chat(data, self.ws)
 
-                # logger.info(f"Processing search request for user {self.user_id}, attempt={attempt_count}")
+    async def _handle_generate_video(self, data: dict) -> dict:
+        title = data.get('title', '')
+        description = data.get('description', '')
+        video_prompt_prefix = data.get('video_prompt_prefix', '')
+        options = data.get('options', {})
+        
+        #logger.info(f"Starting video generation for user {self.user_id}: title='{title[:50]}...', role={self.user_role}")
+        start_time = time.time()
+        
+        # Pass the user role to generate_video
+        video_data = await self.shared_api.generate_video(
+            title, description, video_prompt_prefix, options, self.user_role
+        )
+        
+        generation_time = time.time() - start_time
+        logger.info(f"generated clip in {generation_time:.2f}s (len: {len(video_data) if video_data else 0})")
+        
+        return {
+            'action': 'generate_video',
+            'requestId': data.get('requestId'),
+            'success': True,
+            'video': video_data,
+        }
 
-                if not query:
-                    logger.warning(f"Empty query received in request from user {self.user_id}: {data}")
-                    result = {
-                        'action': 'search',
-                        'requestId': request_id,
-                        'success': False,
-                        'error': 'No search query provided'
-                    }
-                else:
-                    try:
-                        search_result = await self.shared_api.search_video(
-                            query,
-                            attempt_count=attempt_count,
-                            llm_config=llm_config
-                        )
-                        
-                        if search_result:
-                            # logger.info(f"Search successful for user {self.user_id}, query '{query}'")
-                            result = {
-                                'action': 'search',
-                                'requestId': request_id,
-                                'success': True,
-                                'result': search_result
-                            }
-                        else:
-                            # logger.warning(f"No results found for user {self.user_id}, query '{query}'")
-                            result = {
-                                'action': 'search',
-                                'requestId': request_id,
-                                'success': False,
-                                'error': 'No results found'
-                            }
-                    except Exception as e:
-                        logger.error(f"Search error for user {self.user_id}, (attempt {attempt_count}): {str(e)}")
-                        result = {
-                            'action': 'search',
-                            'requestId': request_id,
-                            'success': False,
-                            'error': f'Search error: {str(e)}'
-                        }
-
-                await self.ws.send_json(result)
-                
-                # Update metrics
-                self.request_counts['search'] += 1
-                self.last_request_times['search'] = time.time()
-                
-            except Exception as e:
-                logger.error(f"Error in search queue processor for user {self.user_id}: {str(e)}")
-                try:
-                    error_response = {
-                        'action': 'search',
-                        'requestId': data.get('requestId') if 'data' in locals() else None,
-                        'success': False,
-                        'error': f'Internal server error: {str(e)}'
-                    }
-                    await self.ws.send_json(error_response)
-                except Exception as send_error:
-                    logger.error(f"Error sending error response: {send_error}")
-            finally:
-                if 'search_queue' in self.__dict__:
-                    self.search_queue.task_done()
-                    
-    async def _process_simulation_queue(self):
-        """Dedicated queue for video simulation requests"""
-        while True:
+    async def _handle_search(self, data: dict) -> None:
+        request_id = data.get('requestId')
+        query = data.get('query', '').strip()
+        attempt_count = data.get('attemptCount', 0)
+        llm_config = data.get('llm_config')
+
+        # logger.info(f"Processing search request for user {self.user_id}, attempt={attempt_count}")
+
+        if not query:
+            logger.warning(f"Empty query received in request from user {self.user_id}: {data}")
+            result = error_response(data, 'No search query provided')
+        else:
             try:
-                data = await self.simulation_queue.get()
-                request_id = data.get('requestId')
-                
-                # Extract parameters from the request
-                video_id = data.get('video_id', '')
-                original_title = data.get('original_title', '')
-                original_description = data.get('original_description', '')
-                current_description = data.get('current_description', '')
-                condensed_history = data.get('condensed_history', '')
-                evolution_count = data.get('evolution_count', 0)
-                chat_messages = data.get('chat_messages', '')
-                llm_config = data.get('llm_config')
-                
-                # logger.info(f"Processing video simulation for user {self.user_id}, video_id={video_id}, evolution_count={evolution_count}")
+                search_result = await self.shared_api.search_video(
+                    query,
+                    attempt_count=attempt_count,
+                    llm_config=llm_config
+                )
                 
-                # Validate required parameters
-                if not original_title or not original_description or not current_description:
+                if search_result:
+                    # logger.info(f"Search successful for user {self.user_id}, query '{query}'")
                     result = {
-                        'action': 'simulate',
+                        'action': 'search',
                         'requestId': request_id,
-                        'success': False,
-                        'error': 'Missing required parameters'
+                        'success': True,
+                        'result': search_result
                     }
                 else:
-                    try:
-                        # Call the simulate method in the API
-                        simulation_result = await self.shared_api.simulate(
-                            original_title=original_title,
-                            original_description=original_description,
-                            current_description=current_description,
-                            condensed_history=condensed_history,
-                            evolution_count=evolution_count,
-                            chat_messages=chat_messages,
-                            llm_config=llm_config
-                        )
-                        
-                        result = {
-                            'action': 'simulate',
-                            'requestId': request_id,
-                            'success': True,
-                            'evolved_description': simulation_result['evolved_description'],
-                            'condensed_history': simulation_result['condensed_history']
-                        }
-                    except Exception as e:
-                        logger.error(f"Error simulating video for user {self.user_id}, video_id={video_id}: {str(e)}")
-                        result = {
-                            'action': 'simulate',
-                            'requestId': request_id,
-                            'success': False,
-                            'error': f'Simulation error: {str(e)}'
-                        }
-                
-                await self.ws.send_json(result)
-                
-                # Update metrics
-                self.request_counts['simulation'] += 1
-                self.last_request_times['simulation'] = time.time()
-                
+                    # logger.warning(f"No results found for user {self.user_id}, query '{query}'")
+                    result = error_response(data, 'No results found')
             except Exception as e:
-                logger.error(f"Error in simulation queue processor for user {self.user_id}: {str(e)}")
-                try:
-                    error_response = {
-                        'action': 'simulate',
-                        'requestId': data.get('requestId') if 'data' in locals() else None,
-                        'success': False,
-                        'error': f'Internal server error: {str(e)}'
-                    }
-                    await self.ws.send_json(error_response)
-                except Exception as send_error:
-                    logger.error(f"Error sending error response: {send_error}")
-            finally:
-                if 'simulation_queue' in self.__dict__:
-                    self.simulation_queue.task_done()
+                logger.error(f"Search error for user {self.user_id}, (attempt {attempt_count}): {str(e)}")
+                result = error_response(data, f'Search error: {str(e)}')
+
+        await self.send(result)
+
+        # Start the first clip of the result before the client asks for it (using the
+        # prompt prefix and options the client says it will use, if it did)
+        if WARM_START_ENABLED and result.get('success'):
+            warm_start = data.get('warm_start') or {}
+            self.shared_api.warm_start_search_result(
+                result['result'],
+                video_prompt_prefix=warm_start.get('video_prompt_prefix', ''),
+                options=warm_start.get('options'),
+                user_role=self.user_role
+            )
                     
-    async def process_generic_request(self, data: dict) -> None:
-        """Handle general requests that don't fit into specialized queues"""
+    async def _handle_simulate(self, data: dict) -> dict:
+        request_id = data.get('requestId')
+        
+        # Extract parameters from the request
+        video_id = data.get('video_id', '')
+        original_title = data.get('original_title', '')
+        original_description = data.get('original_description', '')
+        current_description = data.get('current_description', '')
+        condensed_history = data.get('condensed_history', '')
+        evolution_count = data.get('evolution_count', 0)
+        chat_messages = data.get('chat_messages', '')
+        llm_config = data.get('llm_config')
+        story_id = data.get('story_id')
+        
+        # logger.info(f"Processing video simulation for user {self.user_id}, video_id={video_id}, evolution_count={evolution_count}")
+        
+        # Validate required parameters (a known story handle replaces the story fields)
+        has_story = self.shared_api.story_states.get(story_id) is not None
+        if not has_story and (not original_title or not original_description or not current_description):
+            return error_response(data, 'Missing required parameters')
+
         try:
-            request_id = data.get('requestId')
-            action = data.get('action')
-            
-            def error_response(message: str):
-                return {
-                    'action': action,
-                    'requestId': request_id,
-                    'success': False,
-                    'error': message
-                }
-
-            if action == 'heartbeat':
-                # Include user role info in heartbeat response
-                await self.ws.send_json({
-                    'action': 'heartbeat',
-                    'requestId': request_id,
-                    'success': True,
-                    'user_role': self.user_role
-                })
+            # Call the simulate method in the API
+            simulation_result = await self.shared_api.simulate(
+                original_title=original_title,
+                original_description=original_description,
+                current_description=current_description,
+                condensed_history=condensed_history,
+                evolution_count=evolution_count,
+                chat_messages=chat_messages,
+                llm_config=llm_config,
+                story_id=story_id,
+                video_id=video_id
+            )
+        except Exception as e:
+            logger.error(f"Error simulating video for user {self.user_id}, video_id={video_id}: {str(e)}")
+            return error_response(data, f'Simulation error: {str(e)}')
             
-            elif action == 'get_user_role':
-                # Return the user role information
-                await self.ws.send_json({
-                    'action': 'get_user_role',
-                    'requestId': request_id,
-                    'success': True,
-                    'user_role': self.user_role
-                })
+        return {
+            'action': 'simulate',
+            'requestId': request_id,
+            'success': True,
+            'evolved_description': simulation_result['evolved_description'],
+            'condensed_history': simulation_result['condensed_history'],
+            'story_id': simulation_result['story_id']
+        }
+
+    async def _handle_generate_caption(self, data: dict) -> dict:
+        # The client may send the parameters at the top level of the message
+        params = data.get('params') or data
+        title = params.get('title')
+        description = params.get('description')
+        llm_config = params.get('llm_config')
+        
+        if not title or not description:
+            return error_response(data, 'Missing title or description')
             
-            elif action == 'generate_caption':
-                params = data.get('params', {})
-                title = params.get('title')
-                description = params.get('description')
-                llm_config = params.get('llm_config')
-                
-                if not title or not description:
-                    await self.ws.send_json(error_response('Missing title or description'))
-                    return
+        caption = await self.shared_api.generate_caption(title, description, llm_config=llm_config)
+        return {
+            'action': data['action'],
+            'requestId': data.get('requestId'),
+            'success': True,
+            'caption': caption
+        }
+
+    async def _handle_subscribe_story(self, data: dict) -> dict:
+        video_id = data.get('video_id', '')
+        original_title = data.get('original_title', '')
+        original_description = data.get('original_description', '')
+
+        if not SHARED_STORY_ENABLED:
+            return error_response(data, 'Shared stories are disabled')
+        if not video_id or not original_title or not original_description:
+            return error_response(data, 'Missing video_id, original_title or original_description')
+
+        # Each shared story keeps calling the LLM, so a session may only start a few of them
+        shared_stories = self.shared_api.shared_stories
+        max_stories = SHARED_STORY_MAX_PER_SESSION.get(self.user_role, SHARED_STORY_MAX_PER_SESSION['anon'])
+        existing = shared_stories.stories.get(video_id)
+        already_subscribed = existing is not None and self.ws in existing.subscribers
+        if (max_stories is not None and not already_subscribed
+                and shared_stories.count_subscriptions(self.ws) >= max_stories):
+            return error_response(data, f'Too many shared stories, unsubscribe from one first (max {max_stories})')
+
+        story = await shared_stories.subscribe(
+            video_id, self.ws, original_title, original_description, self.user_role
+        )
+        return {
+            'action': data['action'],
+            'requestId': data.get('requestId'),
+            'success': True,
+            **story
+        }
+
+    async def _handle_subscribe_stream(self, data: dict) -> dict:
+        video_id = data.get('video_id', '')
+        title = data.get('title', '')
+        description = data.get('description', '')
+        video_prompt_prefix = data.get('video_prompt_prefix', '')
+        options = data.get('options', {})
+
+        if not SHARED_STREAM_ENABLED:
+            return error_response(data, 'Shared streams are disabled')
+        if not video_id or not title or not description:
+            return error_response(data, 'Missing video_id, title or description')
+
+        # Each shared stream keeps an endpoint busy, so a session may only start a few of them
+        shared_streams = self.shared_api.shared_streams
+        max_streams = SHARED_STREAM_MAX_PER_SESSION.get(self.user_role, SHARED_STREAM_MAX_PER_SESSION['anon'])
+        existing = shared_streams.streams.get(video_id)
+        already_subscribed = existing is not None and self.ws in existing.subscribers
+        if (max_streams is not None and not already_subscribed
+                and shared_streams.count_subscriptions(self.ws) >= max_streams):
+            return error_response(data, f'Too many shared streams, unsubscribe from one first (max {max_streams})')
+
+        stream = await shared_streams.subscribe(
+            video_id, self.ws, title, description, video_prompt_prefix, options, self.user_role
+        )
+        return {
+            'action': data['action'],
+            'requestId': data.get('requestId'),
+            'success': True,
+            **stream
+        }
+
+    async def _handle_unsubscribe_stream(self, data: dict) -> dict:
+        await self.shared_api.shared_streams.unsubscribe(data.get('video_id', ''), self.ws)
+        return {
+            'action': data['action'],
+            'requestId': data.get('requestId'),
+            'success': True
+        }
+
+    async def _handle_unsubscribe_story(self, data: dict) -> dict:
+        await self.shared_api.shared_stories.unsubscribe(data.get('video_id', ''), self.ws)
+        return {
+            'action': data['action'],
+            'requestId': data.get('requestId'),
+            'success': True
+        }
                     
-                caption = await self.shared_api.generate_caption(title, description, llm_config=llm_config)
-                await self.ws.send_json({
-                    'action': action,
-                    'requestId': request_id,
-                    'success': True,
-                    'caption': caption
-                })
-                
-            # evolve_description is now handled by the dedicated simulation queue processor
-                
-            elif action == 'generate_video_thumbnail':
-                title = data.get('title', '') or data.get('params', {}).get('title', '')
-                description = data.get('description', '') or data.get('params', {}).get('description', '')
-                video_prompt_prefix = data.get('video_prompt_prefix', '') or data.get('params', {}).get('video_prompt_prefix', '')
-                options = data.get('options', {}) or data.get('params', {}).get('options', {})
-                
-                if not title:
-                    await self.ws.send_json(error_response('Missing title for thumbnail generation'))
-                    return
-                
-                # Ensure the options include the thumbnail flag
-                options['thumbnail'] = True
-                
-                # Prioritize thumbnail generation with higher priority
-                options['priority'] = 'high'
-                
-                # Add small size settings if not already specified
-                if 'width' not in options:
-                    options['width'] = 512  # Default thumbnail width
-                if 'height' not in options:
-                    options['height'] = 288  # Default 16:9 aspect ratio
-                if 'num_frames' not in options:
-                    options['num_frames'] = 25  # 1 second @ 25fps
-                
-                # Let the API know this is a thumbnail for a specific video
-                options['video_id'] = data.get('video_id', f"thumbnail-{request_id}")
-                
-                logger.info(f"Generating thumbnail for video {options['video_id']} for user {self.user_id}")
-                
+    @staticmethod
+    def _get_thumbnail_options(options: dict, video_id: str) -> dict:
+        """Get the generation options of a thumbnail, with small size settings if not already specified"""
+        options = dict(options)
+
+        # Ensure the options include the thumbnail flag
+        options['thumbnail'] = True
+        
+        # Prioritize thumbnail generation with higher priority
+        options['priority'] = 'high'
+        
+        if 'width' not in options:
+            options['width'] = 512  # Default thumbnail width
+        if 'height' not in options:
+            options['height'] = 288  # Default 16:9 aspect ratio
+        if 'num_frames' not in options:
+            options['num_frames'] = 25  # 1 second @ 25fps
+        
+        # Let the API know this is a thumbnail for a specific video
+        options['video_id'] = video_id
+        return options
+
+    async def _handle_generate_video_thumbnail(self, data: dict) -> dict:
+        request_id = data.get('requestId')
+        title = data.get('title', '') or data.get('params', {}).get('title', '')
+        description = data.get('description', '') or data.get('params', {}).get('description', '')
+        video_prompt_prefix = data.get('video_prompt_prefix', '') or data.get('params', {}).get('video_prompt_prefix', '')
+        options = data.get('options', {}) or data.get('params', {}).get('options', {})
+        
+        if not title:
+            return error_response(data, 'Missing title for thumbnail generation')
+        
+        options = self._get_thumbnail_options(options, data.get('video_id', f"thumbnail-{request_id}"))
+        
+        logger.info(f"Generating thumbnail for video {options['video_id']} for user {self.user_id}")
+        
+        try:
+            # Generate the thumbnail
+            thumbnail_data = await self.shared_api.generate_video_thumbnail(
+                title, description, video_prompt_prefix, options, self.user_role
+            )
+        except Exception as e:
+            logger.error(f"Error generating thumbnail: {str(e)}")
+            return error_response(data, f"Thumbnail generation failed: {str(e)}")
+            
+        # Respond with appropriate format based on the parameter names used in the request
+        if 'thumbnailUrl' in data or 'thumbnailUrl' in data.get('params', {}):
+            # Legacy format using thumbnailUrl
+            return {
+                'action': data['action'],
+                'requestId': request_id,
+                'success': True,
+                'thumbnailUrl': thumbnail_data or "",
+            }
+        # New format using thumbnail
+        return {
+            'action': data['action'],
+            'requestId': request_id,
+            'success': True,
+            'thumbnail': thumbnail_data,
+        }
+
+    async def _handle_generate_video_thumbnails(self, data: dict) -> Optional[dict]:
+        cards = data.get('cards') or data.get('params', {}).get('cards') or []
+        video_prompt_prefix = data.get('video_prompt_prefix', '') or data.get('params', {}).get('video_prompt_prefix', '')
+        options = data.get('options', {}) or data.get('params', {}).get('options', {})
+
+        if not isinstance(cards, list) or not cards:
+            return error_response(data, 'Missing cards for thumbnail generation')
+        if len(cards) > THUMBNAIL_BATCH_MAX_CARDS:
+            return error_response(data, f'Too many cards (max {THUMBNAIL_BATCH_MAX_CARDS})')
+
+        await self._generate_thumbnails(data.get('requestId'), cards, video_prompt_prefix, options)
+        return None
+
+    async def _generate_thumbnails(self, request_id: str, cards: list, video_prompt_prefix: str, options: dict) -> None:
+        """
+        Generate the thumbnails of a page of cards, sending each one as soon as it is ready,
+        then a final response once they are all done
+        """
+        semaphore = asyncio.Semaphore(THUMBNAIL_BATCH_CONCURRENCY)
+
+        async def generate_card_thumbnail(index: int, card: dict) -> bool:
+            video_id = card.get('video_id') or card.get('id') or f"thumbnail-{request_id}-{index}"
+            thumbnail = ''
+            error = None
+            if not card.get('title'):
+                error = 'Missing title for thumbnail generation'
+            else:
+                card_options = self._get_thumbnail_options({**options, **(card.get('options') or {})}, video_id)
+                if 'seed' in card and 'seed' not in card_options:
+                    card_options['seed'] = card['seed']
                 try:
-                    # Generate the thumbnail
-                    thumbnail_data = await self.shared_api.generate_video_thumbnail(
-                        title, description, video_prompt_prefix, options, self.user_role
-                    )
-                    
-                    # Respond with appropriate format based on the parameter names used in the request
-                    if 'thumbnailUrl' in data or 'thumbnailUrl' in data.get('params', {}):
-                        # Legacy format using thumbnailUrl
-                        await self.ws.send_json({
-                            'action': action,
-                            'requestId': request_id,
-                            'success': True,
-                            'thumbnailUrl': thumbnail_data or "",
-                        })
-                    else:
-                        # New format using thumbnail
-                        await self.ws.send_json({
-                            'action': action,
-                            'requestId': request_id,
-                            'success': True,
-                            'thumbnail': thumbnail_data,
-                        })
+                    async with semaphore:
+                        thumbnail = await self.shared_api.generate_video_thumbnail(
+                            card['title'], card.get('description', ''),
+                            card.get('video_prompt_prefix', video_prompt_prefix),
+                            card_options, self.user_role
+                        )
                 except Exception as e:
-                    logger.error(f"Error generating thumbnail: {str(e)}")
-                    await self.ws.send_json(error_response(f"Thumbnail generation failed: {str(e)}"))
-                
-            # Handle deprecated thumbnail actions
-            elif action == 'generate_thumbnail' or action == 'old_generate_thumbnail':
-                # Redirect to video thumbnail generation
-                logger.warning(f"Deprecated thumbnail action '{action}' used, redirecting to generate_video_thumbnail")
-                
-                # Extract parameters
-                title = data.get('title', '') or data.get('params', {}).get('title', '')
-                description = data.get('description', '') or data.get('params', {}).get('description', '')
-                
-                if not title or not description:
-                    await self.ws.send_json(error_response('Missing title or description'))
-                    return
-                
-                # Create a new request with the correct action
-                new_request = {
-                    'action': 'generate_video_thumbnail',
-                    'requestId': request_id,
-                    'title': title,
-                    'description': description,
-                    'options': {
-                        'width': 512,
-                        'height': 288,
-                        'thumbnail': True,
-                        'video_id': f"thumbnail-{request_id}"
-                    }
-                }
-                
-                # Process with the new action
-                await self.process_generic_request(new_request)
-                
-            else:
-                await self.ws.send_json(error_response(f'Unknown action: {action}'))
-                
+                    logger.error(f"Error generating thumbnail for video {video_id}: {str(e)}")
+                    error = f"Thumbnail generation failed: {str(e)}"
+
+            message = {
+                'action': 'video_thumbnail',
+                'broadcast': True,
+                'requestId': request_id,
+                'index': index,
+                'video_id': video_id,
+                'success': bool(thumbnail),
+                'thumbnail': thumbnail
+            }
+            if not thumbnail:
+                message['error'] = error or 'No endpoint available for thumbnail generation'
+            await self.send(message)
+            return bool(thumbnail)
+
+        try:
+            results = await asyncio.gather(*(
+                generate_card_thumbnail(index, card if isinstance(card, dict) else {})
+                for index, card in enumerate(cards)
+            ), return_exceptions=True)
+            await self.send({
+                'action': 'generate_video_thumbnails',
+                'requestId': request_id,
+                'success': True,
+                'count': len(cards),
+                'generated': sum(1 for result in results if result is True)
+            })
         except Exception as e:
-            logger.error(f"Error processing generic request for user {self.user_id}: {str(e)}")
-            try:
-                await self.ws.send_json({
-                    'action': data.get('action'),
-                    'requestId': data.get('requestId'),
-                    'success': False,
-                    'error': f'Internal server error: {str(e)}'
-                })
-            except Exception as send_error:
-                logger.error(f"Error sending error response: {send_error}")
+            logger.error(f"Error sending thumbnails to user {self.user_id}: {str(e)}")
+
+    async def _handle_deprecated_thumbnail(self, data: dict) -> dict:
+        # Redirect to video thumbnail generation
+        action = data['action']
+        logger.warning(f"Deprecated thumbnail action '{action}' used, redirecting to generate_video_thumbnail")
+        
+        # Extract parameters
+        title = data.get('title', '') or data.get('params', {}).get('title', '')
+        description = data.get('description', '') or data.get('params', {}).get('description', '')
+        
+        if not title or not description:
+            return error_response(data, 'Missing title or description')
+        
+        # Process as a request with the correct action
+        request_id = data.get('requestId')
+        return await self._handle_generate_video_thumbnail({
+            'action': 'generate_video_thumbnail',
+            'requestId': request_id,
+            'title': title,
+            'description': description,
+            'options': {
+                'width': 512,
+                'height': 288,
+                'thumbnail': True,
+                'video_id': f"thumbnail-{request_id}"
+            }
+        })
 
 class SessionManager:
     """
     Manages all active user sessions and shared resources.
+
+    Registering and unregistering a session are plain dict operations, which are atomic
+    on the event loop, so they don't need a lock. A session is unregistered before it is
+    stopped, so connects and disconnects never wait for the teardown of another session.
     """
     def __init__(self):
-        self.sessions = {}
+        self.sessions: Dict[str, UserSession] = {}
         self.shared_api = VideoGenerationAPI()  # Single instance for shared resources
-        self.session_lock = asyncio.Lock()
+        # Sessions unregistered but still being stopped
+        self.closing_sessions = 0
+        # Detached sessions: resume token -> user id, and the tasks deleting them after the grace period
+        self.resume_tokens: Dict[str, str] = {}
+        self.expiry_tasks: Dict[str, asyncio.Task] = {}
+        self.resumed_sessions = 0
+        self.expired_sessions = 0
     
     async def create_session(self, user_id: str, user_role: str, ws: web.WebSocketResponse) -> UserSession:
         """Create a new user session"""
-        async with self.session_lock:
-            # Create a new session for this user
-            session = UserSession(user_id, user_role, ws, self.shared_api)
-            await session.start()
-            self.sessions[user_id] = session
-            return session
+        session = UserSession(user_id, user_role, ws, self.shared_api)
+        self.sessions[user_id] = session
+        if session.resume_token:
+            self.resume_tokens[session.resume_token] = user_id
+        await session.start()
+        return session
+
+    def get_resumable_session(self, resume_token: str, user_role: str) -> Optional[UserSession]:
+        """Get the detached session of a resume token, if it is still in its grace period"""
+        session = self.sessions.get(self.resume_tokens.get(resume_token, ''))
+        if session is None or session.detached_at is None or session.user_role != user_role:
+            return None
+        return session
+
+    async def resume_session(self, resume_token: str, user_role: str, ws: web.WebSocketResponse) -> Optional[UserSession]:
+        """Attach a detached session to a new connection, or return None if it can't be resumed anymore"""
+        session = self.get_resumable_session(resume_token, user_role)
+        if session is None:
+            return None
+        expiry = self.expiry_tasks.pop(session.user_id, None)
+        if expiry is not None:
+            expiry.cancel()
+        flushed = await session.attach(ws)
+        self.resumed_sessions += 1
+        logger.info(f"Resumed session of user {session.user_id} ({flushed} buffered results sent)")
+        return session
+
+    async def release_session(self, user_id: str, ws: web.WebSocketResponse) -> None:
+        """
+        Release the session of a closed connection: it is detached for the grace period
+        if it can be resumed, deleted otherwise
+        """
+        session = self.sessions.get(user_id)
+        if session is None or session.ws is not ws or session.detached_at is not None:
+            # Already resumed on another connection, or already released
+            return
+        if not session.resume_token or SESSION_RESUME_GRACE_SECONDS <= 0:
+            await self.delete_session(user_id)
+            return
+        await session.detach()
+        self.expiry_tasks[user_id] = asyncio.create_task(self._expire_session(user_id))
+
+    async def _expire_session(self, user_id: str) -> None:
+        await asyncio.sleep(SESSION_RESUME_GRACE_SECONDS)
+        self.expired_sessions += 1
+        await self.delete_session(user_id)
     
     async def delete_session(self, user_id: str) -> None:
         """Delete a user session and clean up resources"""
-        async with self.session_lock:
-            if user_id in self.sessions:
-                session = self.sessions[user_id]
-                await session.stop()
-                del self.sessions[user_id]
-                logger.info(f"Deleted session for user {user_id}")
+        session = self.sessions.pop(user_id, None)
+        if session is None:
+            return
+        self.resume_tokens.pop(session.resume_token, None)
+        expiry = self.expiry_tasks.pop(user_id, None)
+        if expiry is not None and expiry is not asyncio.current_task():
+            expiry.cancel()
+        self.closing_sessions += 1
+        try:
+            await session.stop()
+        finally:
+            self.closing_sessions -= 1
+        logger.info(f"Deleted session for user {user_id}")
     
-    def get_session(self, user_id: str) -> UserSession:
+    def get_session(self, user_id: str) -> Optional[UserSession]:
         """Get a user session if it exists"""
         return self.sessions.get(user_id)
     
     async def close_all_sessions(self) -> None:
         """Close all active sessions (used during shutdown)"""
-        async with self.session_lock:
-            for user_id, session in list(self.sessions.items()):
-                await session.stop()
-            self.sessions.clear()
-            logger.info("Closed all active sessions")
+        user_ids = list(self.sessions)
+        await asyncio.gather(*(self.delete_session(user_id) for user_id in user_ids), return_exceptions=True)
+        logger.info("Closed all active sessions")
     
     @property
     def session_count(self) -> int:
@@ -604,7 +707,14 @@ class SessionManager:
                 'video': 0,
                 'search': 0,
                 'simulation': 0
-            }
+            },
+            'closing_sessions': self.closing_sessions,
+            'detached_sessions': len(self.expiry_tasks),
+            'resumed_sessions': self.resumed_sessions,
+            'expired_sessions': self.expired_sessions,
+            'dropped_results': 0,
+            'pending_requests': 0,
+            'running_requests': 0
         }
         
         for session in self.sessions.values():
@@ -613,5 +723,9 @@ class SessionManager:
             stats['requests']['video'] += session.request_counts['video']
             stats['requests']['search'] += session.request_counts['search']
             stats['requests']['simulation'] += session.request_counts['simulation']
+            stats['dropped_results'] += session.dropped_results
+            dispatcher_stats = session.dispatcher.get_stats()
+            stats['pending_requests'] += dispatcher_stats['pending']
+            stats['running_requests'] += dispatcher_stats['running']
             
         return stats
\ No newline at end of file
@@ -0,0 +1,179 @@
+"""
+Generic asynchronous caches.
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(*parts: Any) -> str:
+    """Hash any JSON-serializable parts into a compact cache key"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _retrieve_exception(task: asyncio.Task) -> None:
+    """Nobody may be waiting for a failed computation anymore, don't let asyncio complain about it"""
+    if not task.cancelled():
+        task.exception()
+
+
+class AsyncTTLCache:
+    """
+    Bounded LRU cache with a time-to-live, single-flight deduplication of concurrent
+    computations of the same key, and an optional disk tier (one JSON file per entry).
+
+    Only truthy values are cached, so failed computations returning "" or None are retried.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 600,
+                 disk_dir: Optional[str] = None, max_disk_entries: int = 10000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.max_disk_entries = max_disk_entries
+        self.entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self.in_flight: Dict[str, asyncio.Task] = {}
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+        # Statistics
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.disk_writes = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        """Get a value from memory, or None if missing or expired"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        stored_at, value = entry
+        if time.time() - stored_at > self.ttl:
+            del self.entries[key]
+            self.expirations += 1
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, stored_at: Optional[float] = None) -> None:
+        """Store a value in memory, evicting the least recently used entries if full"""
+        self.entries[key] = (stored_at or time.time(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: str) -> Optional[Any]:
+        """Remove a value from memory and return it (if it hasn't expired)"""
+        value = self.get(key)
+        self.entries.pop(key, None)
+        return value
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _read_disk(self, key: str) -> Optional[Tuple[float, Any]]:
+        path = self._disk_path(key)
+        try:
+            stored_at = os.path.getmtime(path)
+            if time.time() - stored_at > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                return stored_at, json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"Failed to read cache entry {path}: {e}")
+            return None
+
+    def _write_disk(self, key: str, value: Any) -> None:
+        path = self._disk_path(key)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(value, f)
+            os.replace(tmp_path, path)
+            self.disk_writes += 1
+            # Prune the oldest files from time to time
+            if self.disk_writes % 100 == 0:
+                self._prune_disk()
+        except Exception as e:
+            logger.error(f"Failed to write cache entry {path}: {e}")
+
+    def _prune_disk(self) -> None:
+        files = [os.path.join(self.disk_dir, name) for name in os.listdir(self.disk_dir) if name.endswith('.json')]
+        if len(files) <= self.max_disk_entries:
+            return
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - self.max_disk_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Get a value from the cache, or compute it. Concurrent calls for the same key
+        share a single computation, which runs in a task of the cache: a caller which is
+        cancelled (eg. its session ended) doesn't cancel it for the others.
+        """
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        task = self.in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.create_task(self._compute(key, compute))
+            task.add_done_callback(_retrieve_exception)
+            self.in_flight[key] = task
+        return await asyncio.shield(task)
+
+    async def _compute(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            if self.disk_dir:
+                entry = await asyncio.to_thread(self._read_disk, key)
+                if entry is not None:
+                    stored_at, value = entry
+                    self.disk_hits += 1
+                    self.set(key, value, stored_at)
+                    return value
+
+            self.misses += 1
+            value = await compute()
+            if value:
+                self.set(key, value)
+                if self.disk_dir:
+                    await asyncio.to_thread(self._write_disk, key, value)
+            return value
+        finally:
+            del self.in_flight[key]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get cache statistics"""
+        lookups = self.hits + self.disk_hits + self.misses + self.coalesced
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_rate': (self.hits + self.disk_hits + self.coalesced) / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'disk_enabled': bool(self.disk_dir)
+        }
@@ -4,18 +4,47 @@ Chat-related functionality for video interactions.
 import datetime
 import logging
 from collections import defaultdict
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
 from aiohttp import web
 from .models import ChatRoom
+from .ws_codec import BroadcastMessage, send_message
 
 logger = logging.getLogger(__name__)
 
 
 class ChatManager:
-    """Manages multiple chat rooms for different videos."""
+    """
+    Manages multiple chat rooms for different videos.
+    In the multi-process mode, the messages are also published to the rooms of the other workers.
+    """
     
-    def __init__(self):
+    def __init__(self, shared_state=None):
         self.chat_rooms = defaultdict(ChatRoom)
+        self.shared_state = shared_state
+        if shared_state is not None:
+            shared_state.subscribe('chat', self._handle_remote_message)
+
+    async def _broadcast(self, room: ChatRoom, message_data: dict, ws: Optional[web.WebSocketResponse] = None) -> None:
+        """Send a message to the clients of a room (except its sender)"""
+        # Encoded once per codec, however many clients are in the room
+        broadcast = BroadcastMessage({
+            'action': 'chat_message',
+            'broadcast': True,
+            **message_data
+        })
+        for client in list(room.connected_clients):
+            if client != ws:
+                try:
+                    await send_message(client, broadcast)
+                except Exception as e:
+                    logger.error(f"Failed to broadcast to client: {e}")
+                    room.connected_clients.discard(client)
+
+    async def _handle_remote_message(self, payload: dict) -> None:
+        """Add a message posted on another worker to the room, and send it to the clients of this worker"""
+        room = self.chat_rooms[payload['video_id']]
+        room.add_message(payload['message'])
+        await self._broadcast(room, payload['message'])
 
     async def handle_chat_message(self, data: dict, ws: web.WebSocketResponse) -> dict:
         """Process and broadcast a chat message"""
@@ -33,18 +62,13 @@ class ChatManager:
         room = self.chat_rooms[video_id]
         message_data = {k: v for k, v in data.items() if k != '_ws'}
         room.add_message(message_data)
+        await self._broadcast(room, message_data, ws)
         
-        for client in room.connected_clients:
-            if client != ws:
-                try:
-                    await client.send_json({
-                        'action': 'chat_message',
-                        'broadcast': True,
-                        **message_data
-                    })
-                except Exception as e:
-                    logger.error(f"Failed to broadcast to client: {e}")
-                    room.connected_clients.remove(client)
+        if self.shared_state is not None:
+            try:
+                await self.shared_state.publish('chat', {'video_id': video_id, 'message': message_data})
+            except Exception as e:
+                logger.error(f"Failed to publish chat message to the other workers: {e}")
         
         return {
             'action': 'chat_message',
@@ -77,6 +101,13 @@ class ChatManager:
             'messages': recent_messages
         }
 
+    def leave_all(self, ws: web.WebSocketResponse) -> int:
+        """Remove a client from every chat room (when its session ends), returns the number of rooms it left"""
+        rooms = [room for room in self.chat_rooms.values() if ws in room.connected_clients]
+        for room in rooms:
+            room.connected_clients.discard(ws)
+        return len(rooms)
+
     async def handle_leave_chat(self, data: dict, ws: web.WebSocketResponse) -> dict:
         """Handle a request to leave a chat room"""
         video_id = data.get('videoId')
@@ -0,0 +1,145 @@
+"""
+Per-video event logs and prefetching of LLM clip prompts.
+"""
+import json
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class VideoEventLogs:
+    """
+    Bounded event history of each video, stored as JSON lines serialized once when appended,
+    so building an LLM prompt from it doesn't re-serialize the whole history.
+    """
+
+    def __init__(self, max_events: int = 50, max_videos: int = 5000):
+        self.max_events = max_events
+        self.max_videos = max_videos
+        self.logs: "OrderedDict[str, Deque[str]]" = OrderedDict()
+
+    def append(self, video_id: str, event: Dict[str, Any]) -> None:
+        """Add an event to the history of a video, dropping its oldest event if full"""
+        log = self.logs.get(video_id)
+        if log is None:
+            log = deque(maxlen=self.max_events)
+            self.logs[video_id] = log
+            while len(self.logs) > self.max_videos:
+                self.logs.popitem(last=False)
+        else:
+            self.logs.move_to_end(video_id)
+        log.append(json.dumps(event))
+
+    def get_json_lines(self, video_id: str) -> str:
+        """Get the history of a video as JSON lines"""
+        return "\n".join(self.logs.get(video_id, ()))
+
+    def count(self, video_id: str) -> int:
+        """Get the number of events in the history of a video"""
+        return len(self.logs.get(video_id, ()))
+
+    def __len__(self) -> int:
+        return len(self.logs)
+
+
+@dataclass
+class PendingClipPrompt:
+    """A clip prompt being generated for the next clip of a video."""
+    title: str
+    description: str
+    task: asyncio.Task
+
+
+class ClipPromptPrefetcher:
+    """
+    Generates the prompt of the next clip of a video while the current clip renders.
+
+    There is at most one prompt generation in flight per video. A clip whose prompt isn't
+    ready after wait_timeout uses the static caption instead, so prompts never add to the time-to-clip.
+    """
+
+    def __init__(self, generate: Callable[[str, str, str], Awaitable[str]],
+                 wait_timeout: float = 0.0, max_videos: int = 1000):
+        self.generate = generate
+        self.wait_timeout = wait_timeout
+        self.max_videos = max_videos
+        self.pending: "OrderedDict[str, PendingClipPrompt]" = OrderedDict()
+
+        # Statistics
+        self.hits = 0
+        self.not_ready = 0
+        self.stale = 0
+        self.failures = 0
+
+    def _prefetch(self, video_id: str, title: str, description: str) -> None:
+        # The task only starts at the caller's next await, so the event
+        # of the clip being generated makes it into the history
+        task = asyncio.create_task(self.generate(video_id, title, description))
+        self.pending[video_id] = PendingClipPrompt(title=title, description=description, task=task)
+        self.pending.move_to_end(video_id)
+        while len(self.pending) > self.max_videos:
+            _, evicted = self.pending.popitem(last=False)
+            evicted.task.cancel()
+
+    async def get_prompt(self, video_id: str, title: str, description: str) -> Optional[str]:
+        """
+        Get the prefetched prompt of a video's next clip (or None if it isn't ready yet),
+        and start generating the prompt of the clip after it.
+        """
+        pending = self.pending.get(video_id)
+
+        if pending is None:
+            self._prefetch(video_id, title, description)
+            self.not_ready += 1
+            return None
+
+        if pending.title != title or pending.description != description:
+            # The story has moved on since the prompt was requested
+            self.stale += 1
+            pending.task.cancel()
+            self._prefetch(video_id, title, description)
+            return None
+
+        if not pending.task.done() and self.wait_timeout > 0:
+            await asyncio.wait({pending.task}, timeout=self.wait_timeout)
+
+        if not pending.task.done():
+            # Let it finish for a later clip instead of piling up LLM calls
+            self.not_ready += 1
+            return None
+
+        self._prefetch(video_id, title, description)
+
+        if pending.task.cancelled() or pending.task.exception() is not None:
+            self.failures += 1
+            return None
+
+        prompt = pending.task.result()
+        if not prompt:
+            self.failures += 1
+            return None
+
+        self.hits += 1
+        return prompt
+
+    def stop(self) -> None:
+        """Cancel all the prompt generations in flight"""
+        for pending in self.pending.values():
+            pending.task.cancel()
+        self.pending.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get the number of clips which used a prefetched prompt or the static caption"""
+        clips = self.hits + self.not_ready + self.stale + self.failures
+        return {
+            'videos': len(self.pending),
+            'hits': self.hits,
+            'not_ready': self.not_ready,
+            'stale': self.stale,
+            'failures': self.failures,
+            'hit_rate': self.hits / clips if clips else 0.0
+        }
@@ -0,0 +1,236 @@
+"""
+Table-driven dispatch of the WebSocket requests of a session: each action declares
+its handler, lane, request type and priority, and each lane has a concurrency limit.
+"""
+import time
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Deque, Dict, Set, Tuple
+
+from .llm_metrics import RollingHistogram
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the dispatch latency buckets (the last bucket is unbounded)
+DISPATCH_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+
+@dataclass(frozen=True)
+class ActionSpec:
+    """How the requests of a WebSocket action are dispatched."""
+    # name of the session method handling the request, which returns the response to send (if any)
+    handler: str
+    # the requests of a lane share its concurrency limit, and run in order within the lane
+    lane: str
+    # used for the rate limits and the request counts
+    request_type: str = 'other'
+    # once a session runs its maximum number of requests, the lowest priority goes next
+    priority: int = 0
+    # cheap handlers are run directly by the reader of the WebSocket
+    inline: bool = False
+    # generation requests go through the admission control, and may be shed under load
+    admission: bool = False
+    error_prefix: str = 'Internal server error'
+
+
+def error_response(data: dict, message: str) -> Dict[str, Any]:
+    """Build the error response of a request"""
+    return {
+        'action': data.get('action'),
+        'requestId': data.get('requestId'),
+        'success': False,
+        'error': message
+    }
+
+
+def busy_response(data: dict, retry_after: int) -> Dict[str, Any]:
+    """Build the response of a request shed by the admission control"""
+    return {
+        **error_response(data, f'Server is busy, please retry in {retry_after} seconds'),
+        'busy': True,
+        'retry_after': retry_after
+    }
+
+
+class ActionStats:
+    """Dispatch metrics of one action."""
+
+    def __init__(self, window: float):
+        self.dispatched = 0
+        self.errors = 0
+        self.cancelled = 0
+        self.shed = 0
+        # from the reception of a request to the start of its handler
+        self.wait = RollingHistogram(DISPATCH_LATENCY_BUCKETS, window)
+        self.duration = RollingHistogram(DISPATCH_LATENCY_BUCKETS, window)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'dispatched': self.dispatched,
+            'errors': self.errors,
+            'cancelled': self.cancelled,
+            'shed': self.shed,
+            'wait': self.wait.get_stats(),
+            'duration': self.duration.get_stats()
+        }
+
+
+class DispatchMetrics:
+    """Dispatch metrics of every action, shared by all the sessions."""
+
+    def __init__(self, window: float = 3600):
+        self.window = window
+        self.actions: Dict[str, ActionStats] = {}
+        self.unknown_actions = 0
+
+    def get_action_stats(self, action: str) -> ActionStats:
+        stats = self.actions.get(action)
+        if stats is None:
+            stats = ActionStats(self.window)
+            self.actions[action] = stats
+        return stats
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'unknown_actions': self.unknown_actions,
+            'actions': {action: stats.get_stats() for action, stats in sorted(self.actions.items())}
+        }
+
+
+# (priority, sequence number, spec, request, reception time)
+PendingRequest = Tuple[int, int, ActionSpec, dict, float]
+
+
+class SessionDispatcher:
+    """
+    Dispatches the requests of a session to the handlers of its action table.
+
+    Requests get a task of their own when their lane has a free slot (and the session is below
+    max_concurrent), otherwise they wait in their lane. Slots are handed over as requests complete,
+    so an idle session has no task at all.
+    """
+
+    def __init__(self, owner: Any, actions: Dict[str, ActionSpec], lane_limits: Dict[str, int],
+                 max_concurrent: int, send: Callable[[dict], Awaitable[Any]], metrics: DispatchMetrics,
+                 admission: Any = None):
+        self.owner = owner
+        self.actions = actions
+        self.lane_limits = lane_limits
+        self.max_concurrent = max_concurrent
+        self.send = send
+        self.metrics = metrics
+        # Admission controller of the generation requests (if enabled)
+        self.admission = admission
+        self.pending: Dict[str, Deque[PendingRequest]] = {}
+        self.running: Dict[str, int] = {}
+        self.total_running = 0
+        self.tasks: Set[asyncio.Task] = set()
+        self.sequence = 0
+        self.closed = False
+
+    async def dispatch(self, data: dict) -> None:
+        """Run a request or queue it in its lane (only inline handlers are awaited)"""
+        spec = self.actions.get(data.get('action'))
+        if spec is None:
+            self.metrics.unknown_actions += 1
+            await self.send(error_response(data, f"Unknown action: {data.get('action')}"))
+            return
+
+        if spec.inline:
+            await self._run(spec, data, time.time())
+            return
+
+        self.sequence += 1
+        self.pending.setdefault(spec.lane, deque()).append(
+            (spec.priority, self.sequence, spec, data, time.time())
+        )
+        self._pump()
+
+    def _pump(self) -> None:
+        """Start the pending requests which have a free slot, by priority"""
+        while not self.closed and self.total_running < self.max_concurrent:
+            best_lane = None
+            best_head = None
+            for lane, queue in self.pending.items():
+                if self.running.get(lane, 0) >= self.lane_limits.get(lane, 1):
+                    continue
+                head = queue[0]
+                if best_head is None or head[:2] < best_head[:2]:
+                    best_lane, best_head = lane, head
+            if best_lane is None:
+                return
+
+            queue = self.pending[best_lane]
+            queue.popleft()
+            if not queue:
+                del self.pending[best_lane]
+
+            _, _, spec, data, received_at = best_head
+            self.running[best_lane] = self.running.get(best_lane, 0) + 1
+            self.total_running += 1
+            task = asyncio.create_task(self._run(spec, data, received_at))
+            self.tasks.add(task)
+            # A callback rather than a finally block, as it also runs for tasks cancelled before starting
+            task.add_done_callback(lambda t, lane=best_lane: self._release(t, lane))
+
+    def _release(self, task: asyncio.Task, lane: str) -> None:
+        self.tasks.discard(task)
+        self.total_running -= 1
+        self.running[lane] -= 1
+        if not self.running[lane]:
+            del self.running[lane]
+        self._pump()
+
+    async def _run(self, spec: ActionSpec, data: dict, received_at: float) -> None:
+        action = data.get('action')
+        stats = self.metrics.get_action_stats(action)
+
+        if spec.admission and self.admission is not None:
+            retry_after = await self.admission.admit_request(self.owner.user_role)
+            if retry_after is not None:
+                stats.shed += 1
+                try:
+                    await self.send(busy_response(data, retry_after))
+                except Exception as e:
+                    logger.error(f"Error sending busy response: {e}")
+                return
+
+        started_at = time.time()
+        stats.dispatched += 1
+        stats.wait.observe(started_at - received_at)
+        try:
+            handler = getattr(self.owner, spec.handler)
+            result = await handler(data)
+            if result is not None:
+                await self.send(result)
+            self.owner.record_request(spec.request_type)
+        except asyncio.CancelledError:
+            stats.cancelled += 1
+            raise
+        except Exception as e:
+            stats.errors += 1
+            logger.error(f"Error processing {action} request: {e}")
+            try:
+                await self.send(error_response(data, f"{spec.error_prefix}: {str(e)}"))
+            except Exception as send_error:
+                logger.error(f"Error sending error response: {send_error}")
+        finally:
+            stats.duration.observe(time.time() - started_at)
+
+    async def stop(self) -> None:
+        """Drop the pending requests and cancel the running ones"""
+        self.closed = True
+        self.pending.clear()
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'pending': sum(len(queue) for queue in self.pending.values()),
+            'running': self.total_running,
+            'lanes': dict(self.running)
+        }
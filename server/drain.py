@@ -0,0 +1,156 @@
+"""
+Graceful drain before a deploy or a shutdown: the running requests complete and send their
+results, then the clients are told to reconnect (to another instance, or to this one once restarted).
+"""
+import time
+import asyncio
+import logging
+from typing import Any, Callable, Dict, Optional
+
+from aiohttp import WSCloseCode
+
+from .ws_codec import send_message
+
+logger = logging.getLogger(__name__)
+
+# Time given to the reconnect hints to be sent, and to the connections to close
+HINT_FLUSH_SECONDS = 1.0
+CLOSE_TIMEOUT_SECONDS = 5.0
+
+
+class DrainController:
+    """
+    Drains the server in three steps:
+    - 'draining': new sessions and generation requests are rejected, the running requests
+      (and endpoint calls) get until the deadline to complete
+    - 'flushing': the results still queued for the clients are sent, until the deadline
+    - 'drained': every client got a reconnect hint and its connection was closed
+
+    The requests still running at the deadline are abandoned, they are cancelled with their sessions.
+    """
+
+    def __init__(self, session_manager, timeout: float = 25.0, reconnect_after: int = 5,
+                 poll_interval: float = 0.25, on_drained: Optional[Callable[[], Any]] = None):
+        self.session_manager = session_manager
+        self.timeout = timeout
+        self.reconnect_after = reconnect_after
+        self.poll_interval = poll_interval
+        # Called once drained, unless the server is already shutting down
+        self.on_drained = on_drained
+        self.exit_when_drained = True
+        self.task: Optional[asyncio.Task] = None
+
+        self.state = 'serving'
+        self.reason: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+        # Statistics
+        self.abandoned_requests = 0
+        self.reconnect_hints_sent = 0
+
+    def start(self, reason: str, exit_when_drained: bool = True) -> asyncio.Task:
+        """Start draining the server (if not already draining), returns the drain task"""
+        if not exit_when_drained:
+            self.exit_when_drained = False
+        if self.task is None:
+            self.state = 'draining'
+            self.reason = reason
+            self.started_at = time.time()
+            self.session_manager.shared_api.admission.draining = True
+            logger.warning(f"Draining the server ({reason}), "
+                           f"running requests have {self.timeout}s to complete")
+            self.task = asyncio.create_task(self._drain())
+        return self.task
+
+    def _get_progress(self) -> Dict[str, int]:
+        """Get what is left to drain"""
+        progress = {
+            'sessions': 0,
+            'running_requests': 0,
+            'pending_requests': 0,
+            'in_flight_generations': self.session_manager.shared_api.endpoint_manager.in_flight,
+            'queued_messages': 0
+        }
+        for session in list(self.session_manager.sessions.values()):
+            progress['sessions'] += 1
+            dispatcher_stats = session.dispatcher.get_stats()
+            progress['running_requests'] += dispatcher_stats['running']
+            progress['pending_requests'] += dispatcher_stats['pending']
+            outbox = getattr(session.ws, 'outbox', None)
+            if session.detached_at is None and outbox is not None and not outbox.is_empty():
+                # counting the message being sent
+                progress['queued_messages'] += max(1, outbox.size)
+        return progress
+
+    async def _wait_until(self, drained: Callable[[Dict[str, int]], bool], deadline: float) -> bool:
+        """Poll the progress until a condition is met, returns False if the deadline is reached first"""
+        while not drained(self._get_progress()):
+            if time.time() >= deadline:
+                return False
+            await asyncio.sleep(self.poll_interval)
+        return True
+
+    async def _drain(self) -> None:
+        deadline = self.started_at + self.timeout
+
+        # Pending generation requests are rejected as they come up, the others complete
+        completed = await self._wait_until(
+            lambda progress: not (progress['running_requests'] or progress['pending_requests']
+                                  or progress['in_flight_generations']),
+            deadline
+        )
+        if not completed:
+            self.abandoned_requests = self._get_progress()['running_requests']
+            logger.warning(f"Drain deadline reached, abandoning {self.abandoned_requests} running requests")
+
+        self.state = 'flushing'
+        await self._wait_until(lambda progress: not progress['queued_messages'], deadline)
+
+        connections = [
+            session.ws for session in list(self.session_manager.sessions.values())
+            if session.detached_at is None
+        ]
+        hint = {
+            'action': 'reconnect',
+            'reason': self.reason,
+            'retry_after': self.reconnect_after
+        }
+        for ws in connections:
+            try:
+                await send_message(ws, hint)
+                self.reconnect_hints_sent += 1
+            except Exception as e:
+                logger.error(f"Error sending reconnect hint: {e}")
+        await self._wait_until(lambda progress: not progress['queued_messages'], time.time() + HINT_FLUSH_SECONDS)
+
+        try:
+            await asyncio.wait_for(asyncio.gather(*(
+                ws.close(code=WSCloseCode.SERVICE_RESTART, message=b'Server restarting') for ws in connections
+            ), return_exceptions=True), timeout=CLOSE_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning("Timed out closing the connections of the drained server")
+
+        self.state = 'drained'
+        self.finished_at = time.time()
+        logger.warning(f"Server drained in {self.finished_at - self.started_at:.1f}s "
+                       f"({len(connections)} clients told to reconnect)")
+
+        if self.exit_when_drained and self.on_drained is not None:
+            self.on_drained()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get the state of the drain and what is left to drain"""
+        stats = {
+            'state': self.state,
+            'reason': self.reason,
+            'deadline_seconds': self.timeout
+        }
+        if self.started_at is not None:
+            stats.update({
+                'elapsed': (self.finished_at or time.time()) - self.started_at,
+                'abandoned_requests': self.abandoned_requests,
+                'reconnect_hints_sent': self.reconnect_hints_sent,
+                **self._get_progress()
+            })
+        return stats
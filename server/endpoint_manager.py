@@ -2,13 +2,14 @@
 Endpoint management for video generation services.
 """
 import time
+import asyncio
 import datetime
 import logging
 from asyncio import Lock
 from contextlib import asynccontextmanager
-from typing import List
+from typing import Any, Dict, List
 from .models import Endpoint
-from .api_config import VIDEO_ROUND_ROBIN_ENDPOINT_URLS
+from .api_config import VIDEO_ROUND_ROBIN_ENDPOINT_URLS, THUMBNAIL_LANE_ENDPOINTS
 
 logger = logging.getLogger(__name__)
 
@@ -19,8 +20,12 @@ class EndpointManager:
     def __init__(self):
         self.endpoints: List[Endpoint] = []
         self.lock = Lock()
+        # Notified whenever an endpoint is released
+        self.released = asyncio.Condition()
         self.initialize_endpoints()
         self.last_used_index = -1  # Track the last used endpoint for round-robin
+        # Generations holding an endpoint (several may share a busy one)
+        self.in_flight = 0
 
     def initialize_endpoints(self):
         """Initialize the list of endpoints"""
@@ -28,17 +33,59 @@ class EndpointManager:
             endpoint = Endpoint(id=i + 1, url=url)
             self.endpoints.append(endpoint)
 
-    def _get_next_free_endpoint(self):
+        # The last endpoints are dedicated to thumbnails (unless that would leave none for clips)
+        self.thumbnail_endpoint_ids = set()
+        if 0 < THUMBNAIL_LANE_ENDPOINTS < len(self.endpoints):
+            self.thumbnail_endpoint_ids = {ep.id for ep in self.endpoints[-THUMBNAIL_LANE_ENDPOINTS:]}
+
+    def _get_lane_endpoints(self, lane: str) -> List[Endpoint]:
+        """
+        Get the endpoints a lane may use: clips can't use the endpoints dedicated
+        to thumbnails, thumbnails can use any endpoint but prefer their own ones
+        """
+        if lane == 'thumbnail':
+            return sorted(self.endpoints, key=lambda ep: ep.id not in self.thumbnail_endpoint_ids)
+        return [ep for ep in self.endpoints if ep.id not in self.thumbnail_endpoint_ids]
+
+    def count_free_endpoints(self, lane: str = 'clip') -> int:
+        """Count the endpoints of a lane which are neither busy nor in error"""
+        current_time = time.time()
+        return sum(
+            1 for ep in self._get_lane_endpoints(lane)
+            if not ep.busy and current_time > ep.error_until
+        )
+
+    async def wait_for_free_endpoint(self, lane: str = 'clip', timeout: float = 5.0) -> bool:
+        """Wait until an endpoint of a lane is free, returns False if none was within the timeout"""
+        deadline = time.time() + timeout
+        async with self.released:
+            while not self.count_free_endpoints(lane):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                try:
+                    # Wake up regularly since endpoints also recover from their error state
+                    await asyncio.wait_for(self.released.wait(), timeout=min(remaining, 1.0))
+                except asyncio.TimeoutError:
+                    pass
+        return True
+
+    def _get_next_free_endpoint(self, lane: str = 'clip'):
         """Get the next available non-busy endpoint, or oldest endpoint if all are busy"""
         current_time = time.time()
+        endpoints = self._get_lane_endpoints(lane)
         
         # First priority: Get any non-busy and non-error endpoint
         free_endpoints = [
-            ep for ep in self.endpoints 
+            ep for ep in endpoints 
             if not ep.busy and current_time > ep.error_until
         ]
         
         if free_endpoints:
+            if lane == 'thumbnail':
+                # Dedicated endpoints first
+                dedicated = [ep for ep in free_endpoints if ep.id in self.thumbnail_endpoint_ids]
+                free_endpoints = dedicated or free_endpoints
             # Return the least recently used free endpoint
             return min(free_endpoints, key=lambda ep: ep.last_used)
         
@@ -50,18 +97,44 @@ class EndpointManager:
             next_index = (next_index + 1) % len(self.endpoints)
             tried_count += 1
             
-            # If endpoint is not in error state, use it
-            if current_time > self.endpoints[next_index].error_until:
+            # If endpoint is not in error state and belongs to the lane, use it
+            endpoint = self.endpoints[next_index]
+            if current_time > endpoint.error_until and endpoint in endpoints:
                 self.last_used_index = next_index
-                return self.endpoints[next_index]
+                return endpoint
         
         # If all endpoints are in error state, use the one with earliest error expiry
         self.last_used_index = next_index
-        return min(self.endpoints, key=lambda ep: ep.error_until)
+        return min(endpoints, key=lambda ep: ep.error_until)
+
+    def get_in_flight_generations(self) -> int:
+        """Count the generations holding an endpoint (those of all the workers in the multi-process mode)"""
+        return self.in_flight
+
+    async def acquire(self, lane: str = 'clip') -> Endpoint:
+        """Pick the next endpoint of a lane and mark it as busy"""
+        async with self.lock:
+            # Get the next available endpoint using our selection strategy
+            endpoint = self._get_next_free_endpoint(lane)
+            
+            # Mark it as busy
+            endpoint.busy = True
+            endpoint.last_used = time.time()
+            self.in_flight += 1
+            return endpoint
+
+    async def release(self, endpoint: Endpoint) -> None:
+        """Release an endpoint picked by acquire"""
+        self.in_flight -= 1
+        async with self.lock:
+            endpoint.busy = False
+            endpoint.last_used = time.time()
+        async with self.released:
+            self.released.notify_all()
 
     @asynccontextmanager
-    async def get_endpoint(self, max_wait_time: int = 10):
-        """Get the next available endpoint using a context manager"""
+    async def get_endpoint(self, max_wait_time: int = 10, lane: str = 'clip'):
+        """Get the next available endpoint of a lane ('clip' or 'thumbnail') using a context manager"""
         start_time = time.time()
         endpoint = None
         
@@ -70,22 +143,14 @@ class EndpointManager:
                 if time.time() - start_time > max_wait_time:
                     raise TimeoutError(f"Could not acquire an endpoint within {max_wait_time} seconds")
 
-                async with self.lock:
-                    # Get the next available endpoint using our selection strategy
-                    endpoint = self._get_next_free_endpoint()
-                    
-                    # Mark it as busy
-                    endpoint.busy = True
-                    endpoint.last_used = time.time()
-                    break
+                endpoint = await self.acquire(lane)
+                break
 
             yield endpoint
 
         finally:
             if endpoint:
-                async with self.lock:
-                    endpoint.busy = False
-                    endpoint.last_used = time.time()
+                await self.release(endpoint)
     
     async def mark_endpoint_error(self, endpoint: Endpoint, is_timeout: bool = False):
         """Mark an endpoint as being in error state with exponential backoff"""
@@ -106,4 +171,65 @@ class EndpointManager:
             logger.warning(
                 f"Endpoint {endpoint.id} marked as in error state (count: {endpoint.error_count}, "
                 f"unavailable until: {datetime.datetime.fromtimestamp(endpoint.error_until).strftime('%H:%M:%S')})"
-            )
\ No newline at end of file
+            )
+
+
+class SharedEndpointManager(EndpointManager):
+    """
+    Endpoint manager of a worker process in the multi-process mode: the endpoints are picked,
+    released and put in error state by the shared state server, so the workers share their busy
+    and error states. The local endpoints mirror the shared ones, which the server pushes whenever they change.
+    """
+
+    def __init__(self, shared_state):
+        super().__init__()
+        self.shared_state = shared_state
+        # Generations holding an endpoint across all the workers (in_flight only counts this worker's)
+        self.shared_in_flight = 0
+        shared_state.subscribe('endpoints', self._handle_remote_update)
+
+    def _update_endpoints(self, snapshot: Dict[str, Any]) -> None:
+        endpoints = {ep.id: ep for ep in self.endpoints}
+        for state in snapshot['endpoints']:
+            endpoint = endpoints.get(state['id'])
+            if endpoint is not None:
+                endpoint.busy = state['busy']
+                endpoint.last_used = state['last_used']
+                endpoint.error_count = state['error_count']
+                endpoint.error_until = state['error_until']
+        self.shared_in_flight = snapshot['in_flight']
+
+    async def _handle_remote_update(self, snapshot: Dict[str, Any]) -> None:
+        """Mirror the endpoints changed by another worker"""
+        self._update_endpoints(snapshot)
+        async with self.released:
+            self.released.notify_all()
+
+    async def sync(self) -> None:
+        """Mirror the current state of the shared endpoints (once connected to the server)"""
+        self._update_endpoints(await self.shared_state.request('get_endpoints'))
+
+    def get_in_flight_generations(self) -> int:
+        return self.shared_in_flight
+
+    async def acquire(self, lane: str = 'clip') -> Endpoint:
+        result = await self.shared_state.request('acquire_endpoint', lane=lane)
+        self._update_endpoints(result)
+        self.in_flight += 1
+        return next(ep for ep in self.endpoints if ep.id == result['endpoint_id'])
+
+    async def release(self, endpoint: Endpoint) -> None:
+        self.in_flight -= 1
+        try:
+            result = await self.shared_state.request('release_endpoint', endpoint_id=endpoint.id)
+            self._update_endpoints(result)
+        except Exception as e:
+            # The server releases the endpoints of a worker when it loses its connection
+            logger.error(f"Error releasing endpoint {endpoint.id}: {e}")
+            endpoint.busy = False
+        async with self.released:
+            self.released.notify_all()
+
+    async def mark_endpoint_error(self, endpoint: Endpoint, is_timeout: bool = False):
+        result = await self.shared_state.request('endpoint_error', endpoint_id=endpoint.id, is_timeout=is_timeout)
+        self._update_endpoints(result)
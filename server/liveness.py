@@ -0,0 +1,80 @@
+"""
+Liveness of the sessions: the server pings the WebSockets (aiohttp heartbeat), and reaps the sessions
+of the connections which stopped answering, or stopped sending anything, with everything they hold.
+"""
+import time
+import asyncio
+import logging
+from typing import Any, Dict
+
+from aiohttp import WSCloseCode
+
+logger = logging.getLogger(__name__)
+
+
+class SessionReaper:
+    """
+    Reaps the sessions without any message from their client for idle_timeout seconds, and the usage
+    metrics of the users gone for metrics_retention seconds, every interval seconds.
+
+    Connections which miss a pong are closed by aiohttp, their sessions are then released like any
+    other (detached for the resume grace period if they can be resumed, deleted otherwise).
+    """
+
+    def __init__(self, session_manager, metrics_tracker, idle_timeout: float = 300.0, interval: float = 30.0,
+                 metrics_retention: float = 3600.0):
+        self.session_manager = session_manager
+        self.metrics_tracker = metrics_tracker
+        self.idle_timeout = idle_timeout
+        self.interval = interval
+        self.metrics_retention = metrics_retention
+
+        # Statistics
+        self.reaped = {'idle': 0, 'missed_pong': 0}
+        self.reclaimed_bytes = 0
+        self.pruned_metrics_users = 0
+
+    def record_missed_pong(self, session) -> None:
+        """Account for a session whose connection was closed after a missed pong"""
+        self.reaped['missed_pong'] += 1
+        self.reclaimed_bytes += session.estimate_memory()
+
+    async def run(self) -> None:
+        """Reap the idle sessions and prune the metrics periodically (runs as a background task)"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reap_idle_sessions()
+                self.pruned_metrics_users += self.metrics_tracker.prune(self.metrics_retention)
+            except Exception as e:
+                logger.error(f"Error reaping sessions: {e}")
+
+    async def reap_idle_sessions(self) -> int:
+        """Delete the attached sessions idle for too long and close their connections, returns their number"""
+        if self.idle_timeout <= 0:
+            return 0
+        cutoff = time.time() - self.idle_timeout
+        idle_sessions = [
+            session for session in list(self.session_manager.sessions.values())
+            if session.detached_at is None and session.last_activity < cutoff
+        ]
+        for session in idle_sessions:
+            self.reclaimed_bytes += session.estimate_memory()
+            await self.session_manager.delete_session(session.user_id)
+        self.reaped['idle'] += len(idle_sessions)
+
+        # A half-open connection may not answer the close handshake, so don't wait for it one by one
+        await asyncio.gather(*(
+            session.ws.close(code=WSCloseCode.GOING_AWAY, message=b'Idle timeout') for session in idle_sessions
+        ), return_exceptions=True)
+        if idle_sessions:
+            logger.info(f"Reaped {len(idle_sessions)} idle sessions")
+        return len(idle_sessions)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'idle_timeout': self.idle_timeout,
+            'reaped_sessions': dict(self.reaped),
+            'reclaimed_bytes': self.reclaimed_bytes,
+            'pruned_metrics_users': self.pruned_metrics_users
+        }
@@ -0,0 +1,184 @@
+"""
+Accounting of the LLM calls: rolling histograms of latency, time to first token
+and token counts per (provider, model, task), along with retries, fallbacks and errors.
+"""
+import time
+import logging
+from collections import defaultdict, deque
+from typing import Any, Deque, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets (the last bucket is unbounded)
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+
+class RollingHistogram:
+    """
+    Bucketed histogram over a rolling time window, made of per-slot (eg. per minute)
+    histograms which are dropped once older than the window.
+    """
+
+    def __init__(self, bounds: Sequence[float], window: float = 3600, slot: float = 60):
+        self.bounds = tuple(bounds)
+        self.window = window
+        self.slot = slot
+        # (slot index, bucket counts, sum, max)
+        self.slots: Deque[List[Any]] = deque()
+
+    def _prune(self, now: float) -> None:
+        oldest = int((now - self.window) / self.slot)
+        while self.slots and self.slots[0][0] < oldest:
+            self.slots.popleft()
+
+    def observe(self, value: float, now: Optional[float] = None) -> None:
+        """Add a value to the histogram"""
+        now = now or time.time()
+        index = int(now / self.slot)
+        if not self.slots or self.slots[-1][0] != index:
+            self.slots.append([index, [0] * (len(self.bounds) + 1), 0.0, 0.0])
+            self._prune(now)
+        current = self.slots[-1]
+        bucket = 0
+        while bucket < len(self.bounds) and value > self.bounds[bucket]:
+            bucket += 1
+        current[1][bucket] += 1
+        current[2] += value
+        current[3] = max(current[3], value)
+
+    def _quantile(self, counts: List[int], total: int, maximum: float, q: float) -> float:
+        """Estimate a quantile as the upper bound of the bucket containing it"""
+        rank = q * total
+        seen = 0
+        for bucket, count in enumerate(counts):
+            seen += count
+            if seen >= rank and count:
+                return self.bounds[bucket] if bucket < len(self.bounds) else maximum
+        return maximum
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get the count, average, estimated percentiles and buckets over the window"""
+        self._prune(time.time())
+        counts = [0] * (len(self.bounds) + 1)
+        total_sum = 0.0
+        maximum = 0.0
+        for _, slot_counts, slot_sum, slot_max in self.slots:
+            for bucket, count in enumerate(slot_counts):
+                counts[bucket] += count
+            total_sum += slot_sum
+            maximum = max(maximum, slot_max)
+        total = sum(counts)
+        if not total:
+            return {'count': 0}
+
+        buckets = {f"le_{bound}": count for bound, count in zip(self.bounds, counts)}
+        buckets['inf'] = counts[-1]
+        return {
+            'count': total,
+            'avg': total_sum / total,
+            'p50': self._quantile(counts, total, maximum, 0.5),
+            'p95': self._quantile(counts, total, maximum, 0.95),
+            'p99': self._quantile(counts, total, maximum, 0.99),
+            'max': maximum,
+            'buckets': buckets
+        }
+
+
+class LLMCallSeries:
+    """Metrics of the LLM calls of one (provider, model, task)."""
+
+    def __init__(self, window: float):
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        self.retries = 0
+        self.fallbacks = 0
+        self.error_classes: Dict[str, int] = defaultdict(int)
+        self.latency = RollingHistogram(LATENCY_BUCKETS, window)
+        self.time_to_first_token = RollingHistogram(LATENCY_BUCKETS, window)
+        self.prompt_tokens = RollingHistogram(TOKEN_BUCKETS, window)
+        self.completion_tokens = RollingHistogram(TOKEN_BUCKETS, window)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'cancelled': self.cancelled,
+            'retries': self.retries,
+            'fallbacks': self.fallbacks,
+            'fallback_rate': self.fallbacks / self.calls if self.calls else 0.0,
+            'error_classes': dict(self.error_classes),
+            'latency': self.latency.get_stats(),
+            'time_to_first_token': self.time_to_first_token.get_stats(),
+            'prompt_tokens': self.prompt_tokens.get_stats(),
+            'completion_tokens': self.completion_tokens.get_stats()
+        }
+
+
+class LLMMetrics:
+    """
+    Metrics of the LLM calls per (provider, model, task).
+
+    User-provided configs can name any model, so past max_series the
+    new providers and models are grouped under 'other'.
+    """
+
+    def __init__(self, window: float = 3600, max_series: int = 200):
+        self.window = window
+        self.max_series = max_series
+        self.series: Dict[Tuple[str, str, str], LLMCallSeries] = {}
+
+    def _get_series(self, provider: str, model: str, task: str) -> LLMCallSeries:
+        key = (provider, model, task)
+        series = self.series.get(key)
+        if series is None:
+            if len(self.series) >= self.max_series:
+                key = ('other', 'other', task)
+                series = self.series.get(key)
+            if series is None:
+                series = LLMCallSeries(self.window)
+                self.series[key] = series
+        return series
+
+    def record(self, provider: str, model: str, task: str, latency: float, outcome: str = 'success',
+               time_to_first_token: Optional[float] = None, prompt_tokens: int = 0,
+               completion_tokens: int = 0, retries: int = 0, fallback: bool = False,
+               error_class: Optional[str] = None) -> None:
+        """
+        Record a call with its outcome ('success', 'error', 'timeout' or 'cancelled').
+        Retries count the extra attempts made within the call (failovers, API fallbacks).
+        """
+        series = self._get_series(provider, model, task)
+        series.calls += 1
+        series.retries += retries
+        if fallback:
+            series.fallbacks += 1
+
+        if outcome == 'cancelled':
+            # eg. the losers of a search race, their latency would be meaningless
+            series.cancelled += 1
+            return
+        if outcome == 'timeout':
+            series.timeouts += 1
+        elif outcome == 'error':
+            series.errors += 1
+            series.error_classes[error_class or 'Exception'] += 1
+
+        series.latency.observe(latency)
+        series.prompt_tokens.observe(prompt_tokens)
+        if outcome == 'success':
+            series.completion_tokens.observe(completion_tokens)
+            if time_to_first_token is not None:
+                series.time_to_first_token.observe(time_to_first_token)
+
+    def get_stats(self) -> List[Dict[str, Any]]:
+        """Get the metrics of every (provider, model, task), busiest first"""
+        return [
+            {'provider': provider, 'model': model, 'task': task, **series.get_stats()}
+            for (provider, model, task), series in sorted(
+                self.series.items(), key=lambda item: item[1].calls, reverse=True
+            )
+        ]
@@ -3,13 +3,32 @@ LLM-related utilities, templates, and text generation functions.
 """
 import asyncio
 import logging
-from typing import Optional, Dict, Any
+import time
+from typing import Optional, Dict, Any, List, Tuple
 from huggingface_hub import InferenceClient
-from .api_config import HF_TOKEN, TEXT_MODEL
+from .api_config import (
+    HF_TOKEN,
+    TEXT_MODEL,
+    LLM_TASK_ROUTES,
+    LLM_PROVIDERS,
+    LLM_PROVIDER_ATTEMPT_TIMEOUT,
+    LLM_PROVIDER_EWMA_ALPHA,
+    LLM_PROVIDER_LATENCY_SLACK,
+    LLM_CIRCUIT_FAILURE_THRESHOLD,
+    LLM_CIRCUIT_RESET_SECONDS,
+    LLM_METRICS_WINDOW_SECONDS,
+    LLM_STREAMING_ENABLED
+)
+from .llm_metrics import LLMMetrics
+from .story_state import estimate_tokens
 
 logger = logging.getLogger(__name__)
 
 
+class LLMConfigurationError(ValueError):
+    """The LLM can't be called because of the server or user configuration (eg. a missing token)"""
+
+
 # LLM prompt templates
 SEARCH_VIDEO_PROMPT_TEMPLATE = """# Instruction
 Your response MUST be a YAML object containing a title and description, consistent with what we can find on a video sharing platform.
@@ -93,6 +112,22 @@ Remember to obey to what users said in the chat history!!
 
 Now, you must write down the new scene description (don't write a long story! write a synthetic description!):"""
 
+CONDENSE_STORY_PROMPT_TEMPLATE = """You are keeping track of the story of a video titled: "{original_title}"
+
+Summary of the story so far:
+{condensed_history}
+
+New scenes since that summary (oldest first):
+{new_scenes}
+
+Instructions:
+1. Write an updated summary of the whole story, merging the new scenes into the summary.
+2. Keep the characters, locations, costumes, objects and visual style which are still relevant, and what viewers asked for.
+3. Drop details which no longer matter.
+4. Return ONLY the summary text, in English, about {max_words} words.
+
+Updated summary:"""
+
 GENERATE_CLIP_PROMPT_TEMPLATE = """# Context and task
 Please write the caption for a new clip.
 
@@ -143,7 +178,7 @@ def get_inference_client(llm_config: Optional[dict] = None) -> InferenceClient:
                 token=HF_TOKEN
             )
         else:
-            raise ValueError("Built-in provider is not available. Server HF_TOKEN is not configured.")
+            raise LLMConfigurationError("Built-in provider is not available. Server HF_TOKEN is not configured.")
         
     provider = llm_config.get('provider', '').lower()
     #logger.info(f"provider = {provider}")
@@ -156,7 +191,7 @@ def get_inference_client(llm_config: Optional[dict] = None) -> InferenceClient:
                 token=HF_TOKEN
             )
         else:
-            raise ValueError("Built-in provider is not available. Server HF_TOKEN is not configured.")
+            raise LLMConfigurationError("Built-in provider is not available. Server HF_TOKEN is not configured.")
 
     model = llm_config.get('model', '')
     user_hf_token = llm_config.get('hf_token', '')  # User's HF token
@@ -170,7 +205,7 @@ def get_inference_client(llm_config: Optional[dict] = None) -> InferenceClient:
                 token=user_hf_token
             )
         else:
-            raise ValueError(f"No Hugging Face API key provided for provider '{provider}'. Please provide your Hugging Face API key.")
+            raise LLMConfigurationError(f"No Hugging Face API key provided for provider '{provider}'. Please provide your Hugging Face API key.")
 
     except ValueError:
         # Re-raise ValueError for missing API keys
@@ -181,65 +216,342 @@ def get_inference_client(llm_config: Optional[dict] = None) -> InferenceClient:
         raise
 
 
+def is_builtin_llm_config(llm_config: Optional[dict] = None) -> bool:
+    """Check whether an LLM config uses the server's built-in provider"""
+    if not llm_config:
+        return True
+    provider = (llm_config.get('provider') or '').lower()
+    return provider in ('', 'built-in')
+
+
+def get_task_route(task: Optional[str]) -> Dict[str, Any]:
+    """Get the routing settings (model, max_new_tokens, timeout) of a task"""
+    return LLM_TASK_ROUTES.get(task or '', {})
+
+
+llm_metrics = LLMMetrics(window=LLM_METRICS_WINDOW_SECONDS)
+
+
+class LLMProviderState:
+    """
+    Health of one built-in LLM provider: EWMA latency and a circuit breaker.
+
+    The circuit opens after `failure_threshold` consecutive failures, stays open
+    for an exponentially growing cool-down, then lets a single probe call through
+    (half-open) which either closes it again or re-opens it.
+    """
+
+    def __init__(self, provider: str, model: str):
+        self.provider = provider
+        self.model = model
+        self.name = f"{provider}:{model}" if model else provider
+        self.ewma_latency: Optional[float] = None
+        self.consecutive_failures = 0
+        self.circuit = 'closed'
+        self.open_count = 0
+        self.open_until = 0.0
+        self.probe_in_flight = False
+        self.calls = 0
+        self.failures = 0
+        self.client: Optional[InferenceClient] = None
+
+    def is_available(self) -> bool:
+        """Check whether a call may be sent to this provider right now"""
+        if self.circuit == 'closed':
+            return True
+        if self.circuit == 'open' and time.time() >= self.open_until:
+            self.circuit = 'half_open'
+        return self.circuit == 'half_open' and not self.probe_in_flight
+
+    def get_client(self) -> InferenceClient:
+        """Get (and cache) the client of this provider, using the server's HF token"""
+        if not HF_TOKEN:
+            raise LLMConfigurationError("Built-in provider is not available. Server HF_TOKEN is not configured.")
+        if self.client is None:
+            if self.provider == 'built-in':
+                self.client = InferenceClient(model=TEXT_MODEL, token=HF_TOKEN)
+            else:
+                self.client = InferenceClient(provider=self.provider, model=self.model or None, token=HF_TOKEN)
+        return self.client
+
+    def record_success(self, latency: float) -> None:
+        self.calls += 1
+        if self.ewma_latency is None:
+            self.ewma_latency = latency
+        else:
+            self.ewma_latency = (1 - LLM_PROVIDER_EWMA_ALPHA) * self.ewma_latency + LLM_PROVIDER_EWMA_ALPHA * latency
+        self.consecutive_failures = 0
+        self.circuit = 'closed'
+        self.open_count = 0
+        self.probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self.calls += 1
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.probe_in_flight = False
+        if self.circuit == 'half_open' or self.consecutive_failures >= LLM_CIRCUIT_FAILURE_THRESHOLD:
+            self.open_count += 1
+            cooldown = min(LLM_CIRCUIT_RESET_SECONDS * (2 ** (self.open_count - 1)), 600)
+            self.circuit = 'open'
+            self.open_until = time.time() + cooldown
+            logger.warning(f"LLM provider {self.name} circuit opened for {cooldown}s after {self.consecutive_failures} failures")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'circuit': self.circuit,
+            'open_until': self.open_until if self.circuit == 'open' else None,
+            'ewma_latency': self.ewma_latency,
+            'calls': self.calls,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures
+        }
+
+
+class LLMProviderRouter:
+    """
+    Sends built-in LLM calls to an ordered list of providers, failing over to the
+    next one on errors or when the per-call deadline is exceeded.
+
+    Providers are tried in their configured order, except that a provider whose EWMA
+    latency is more than LLM_PROVIDER_LATENCY_SLACK times the fastest one is moved back.
+    """
+
+    def __init__(self, providers: List[str]):
+        self.states: List[LLMProviderState] = []
+        for entry in providers or ['built-in']:
+            provider, _, model = entry.partition(':')
+            self.states.append(LLMProviderState(provider.strip(), model.strip()))
+
+    def get_candidates(self) -> List[LLMProviderState]:
+        """Get the providers to try, in order"""
+        available = [state for state in self.states if state.is_available()]
+        if not available:
+            # Everything is open: try the one closest to its probe anyway
+            return sorted(self.states, key=lambda state: state.open_until)
+
+        latencies = [state.ewma_latency for state in available if state.ewma_latency is not None]
+        if latencies:
+            fastest = min(latencies)
+            available.sort(key=lambda state: (
+                state.ewma_latency is not None and state.ewma_latency > fastest * LLM_PROVIDER_LATENCY_SLACK
+            ))
+        return available
+
+    async def generate(self, prompt: str, route: Dict[str, Any], max_new_tokens: int,
+                       temperature: float, timeout: Optional[float],
+                       call_info: Optional[Dict[str, Any]] = None) -> Tuple[str, LLMProviderState, bool]:
+        """
+        Generate text with the first provider which answers in time.
+
+        Returns a tuple (text, provider state, whether it wasn't served by the primary provider).
+        Raises the last error (or asyncio.TimeoutError) if every provider failed.
+        The provider, model and number of attempts are written to call_info, if given.
+        """
+        if call_info is None:
+            call_info = {}
+        deadline = time.time() + timeout if timeout else None
+        candidates = self.get_candidates()
+        last_error: Optional[BaseException] = None
+
+        for index, state in enumerate(candidates):
+            remaining = deadline - time.time() if deadline else None
+            if remaining is not None and remaining <= 0:
+                break
+
+            # Each attempt gets its own deadline so a hanging provider leaves time to fail over,
+            # the last (or only) provider gets the rest of the task deadline as there is nothing to fail over to
+            attempt_timeout = remaining
+            if index < len(candidates) - 1:
+                attempt_timeout = min(LLM_PROVIDER_ATTEMPT_TIMEOUT, remaining or LLM_PROVIDER_ATTEMPT_TIMEOUT)
+
+            model = state.model or route.get('model') or TEXT_MODEL
+            call_info['provider'] = state.name
+            call_info['model'] = model
+            call_info['attempts'] = call_info.get('attempts', 0) + 1
+            if state.circuit == 'half_open':
+                state.probe_in_flight = True
+
+            start_time = time.time()
+            try:
+                client = state.get_client()
+                text = await asyncio.wait_for(
+                    _generate_text_with_client(client, prompt, model, max_new_tokens, temperature, call_info),
+                    timeout=attempt_timeout
+                )
+            except LLMConfigurationError:
+                # Configuration errors (eg. missing token) won't be fixed by another provider,
+                # any other error (including a ValueError from the client or a provider) fails over
+                state.probe_in_flight = False
+                raise
+            except asyncio.CancelledError:
+                state.probe_in_flight = False
+                raise
+            except Exception as e:
+                state.record_failure()
+                last_error = e
+                logger.warning(f"LLM provider {state.name} failed ({type(e).__name__}: {e}), failing over")
+                continue
+
+            state.record_success(time.time() - start_time)
+            return text, state, state is not self.states[0]
+
+        if last_error is None or isinstance(last_error, asyncio.TimeoutError):
+            raise asyncio.TimeoutError(f"No LLM provider answered within {timeout}s")
+        raise last_error
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {state.name: state.get_stats() for state in self.states}
+
+
+llm_provider_router = LLMProviderRouter(LLM_PROVIDERS)
+
+
 async def generate_text(prompt: str, llm_config: Optional[dict] = None, 
-                       max_new_tokens: int = 200, temperature: float = 0.7,
-                       model_override: Optional[str] = None) -> str:
+                       max_new_tokens: Optional[int] = None, temperature: float = 0.7,
+                       model_override: Optional[str] = None, task: Optional[str] = None) -> str:
     """
     Helper method to generate text using the appropriate client and configuration.
     Tries chat_completion first (modern standard), falls back to text_generation.
+    Calls to the built-in provider fail over across the providers of LLM_PROVIDERS.
     
     Args:
         prompt: The prompt to generate text from
         llm_config: Optional LLM configuration dict
-        max_new_tokens: Maximum number of new tokens to generate
+        max_new_tokens: Maximum number of new tokens to generate (defaults to the task's budget)
         temperature: Temperature for generation
         model_override: Optional model to use instead of the one in llm_config
+        task: Optional task name ('search', 'caption', 'simulate', 'clip_prompt') used
+              to pick the model, token budget and timeout from LLM_TASK_ROUTES
         
     Returns:
         Generated text string
     """
+    route = get_task_route(task)
+    if max_new_tokens is None:
+        max_new_tokens = route.get('max_new_tokens', 200)
+    timeout = route.get('timeout')
+
     # Add game master prompt if provided
     if llm_config and llm_config.get('game_master_prompt'):
         game_master_prompt = llm_config['game_master_prompt'].strip()
         if game_master_prompt:
             prompt = f"Important contextual rules: {game_master_prompt}\n\n{prompt}"
-    
-    # Get the appropriate client
-    client = get_inference_client(llm_config)
-    
-    # Determine the model to use
-    if model_override:
-        model_to_use = model_override
-    elif llm_config:
-        model_to_use = llm_config.get('model', TEXT_MODEL)
-    else:
-        model_to_use = TEXT_MODEL
-    
-    # Try chat_completion first (modern standard, more widely supported)
+
+    start_time = time.time()
+    # filled by the router and the client helper: provider, model, attempts, retries, time to first token
+    call_info: Dict[str, Any] = {}
+    response = ''
+    fallback = False
+    outcome = 'success'
+    error_class = None
+
     try:
-        messages = [{"role": "user", "content": prompt}]
-        
-        if llm_config and llm_config.get('provider') != 'huggingface':
-            # For third-party providers
-            completion = await asyncio.get_event_loop().run_in_executor(
-                None,
-                lambda: client.chat.completions.create(
-                    messages=messages,
-                    max_tokens=max_new_tokens,
-                    temperature=temperature
-                )
+        if is_builtin_llm_config(llm_config) and not model_override:
+            call_info['provider'] = 'built-in'
+            call_info['model'] = route.get('model') or TEXT_MODEL
+            response, state, fallback = await llm_provider_router.generate(
+                prompt, route, max_new_tokens, temperature, timeout, call_info
             )
+            return response
+
+        # Determine the model to use
+        if model_override:
+            model_to_use = model_override
         else:
-            # For HuggingFace models, specify the model
-            completion = await asyncio.get_event_loop().run_in_executor(
-                None,
-                lambda: client.chat.completions.create(
-                    model=model_to_use,
+            model_to_use = llm_config.get('model', TEXT_MODEL)
+        call_info['provider'] = (llm_config or {}).get('provider') or 'built-in'
+        call_info['model'] = model_to_use
+
+        # Get the appropriate client
+        client = get_inference_client(llm_config)
+
+        # The model is passed explicitly for HuggingFace models,
+        # third-party providers use the model their client was created with
+        specify_model = model_override or llm_config.get('provider') == 'huggingface'
+
+        response = await asyncio.wait_for(
+            _generate_text_with_client(
+                client, prompt, model_to_use if specify_model else None,
+                max_new_tokens, temperature, call_info
+            ),
+            timeout=timeout or None
+        )
+        return response
+    except asyncio.TimeoutError:
+        outcome = 'timeout'
+        logger.error(f"LLM call for task '{task}' timed out after {timeout}s")
+        raise
+    except asyncio.CancelledError:
+        outcome = 'cancelled'
+        raise
+    except Exception as e:
+        outcome = 'error'
+        error_class = type(e).__name__
+        raise
+    finally:
+        llm_metrics.record(
+            call_info.get('provider', 'unknown'),
+            call_info.get('model', 'unknown'),
+            task or 'other',
+            time.time() - start_time,
+            outcome=outcome,
+            time_to_first_token=call_info.get('time_to_first_token'),
+            prompt_tokens=estimate_tokens(prompt),
+            completion_tokens=estimate_tokens(response or ''),
+            retries=max(0, call_info.get('attempts', 1) - 1) + call_info.get('api_fallbacks', 0),
+            fallback=fallback,
+            error_class=error_class
+        )
+
+
+async def _generate_text_with_client(client: InferenceClient, prompt: str, model: Optional[str],
+                                     max_new_tokens: int, temperature: float,
+                                     call_info: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Generate text with an existing client, trying chat_completion first and
+    falling back to text_generation for models which don't support chat.
+    The model is only passed to the client calls when given.
+
+    When streaming is enabled, the time to the first token is written to call_info (if given).
+    """
+    if call_info is None:
+        call_info = {}
+    model_kwargs = {'model': model} if model else {}
+
+    # Try chat_completion first (modern standard, more widely supported)
+    try:
+        messages = [{"role": "user", "content": prompt}]
+        attempt_start = time.time()
+
+        if LLM_STREAMING_ENABLED:
+            def stream_completion() -> str:
+                parts = []
+                for chunk in client.chat.completions.create(
                     messages=messages,
                     max_tokens=max_new_tokens,
-                    temperature=temperature
-                )
+                    temperature=temperature,
+                    stream=True,
+                    **model_kwargs
+                ):
+                    content = chunk.choices[0].delta.content if chunk.choices else None
+                    if content:
+                        if not parts:
+                            call_info['time_to_first_token'] = time.time() - attempt_start
+                        parts.append(content)
+                return ''.join(parts)
+
+            return await asyncio.get_event_loop().run_in_executor(None, stream_completion)
+
+        completion = await asyncio.get_event_loop().run_in_executor(
+            None,
+            lambda: client.chat.completions.create(
+                messages=messages,
+                max_tokens=max_new_tokens,
+                temperature=temperature,
+                **model_kwargs
             )
+        )
         
         # Extract the generated text from the chat completion response
         return completion.choices[0].message.content
@@ -251,30 +563,19 @@ async def generate_text(prompt: str, llm_config: Optional[dict] = None,
             "conversational" in error_message or
             "chat" in error_message):
             logger.info(f"chat_completion not supported, falling back to text_generation: {e}")
+            call_info['api_fallbacks'] = call_info.get('api_fallbacks', 0) + 1
             
             # Fall back to text_generation API
             try:
-                if llm_config and llm_config.get('provider') != 'huggingface':
-                    # For third-party providers
-                    response = await asyncio.get_event_loop().run_in_executor(
-                        None,
-                        lambda: client.text_generation(
-                            prompt,
-                            max_new_tokens=max_new_tokens,
-                            temperature=temperature
-                        )
-                    )
-                else:
-                    # For HuggingFace models, specify the model
-                    response = await asyncio.get_event_loop().run_in_executor(
-                        None,
-                        lambda: client.text_generation(
-                            prompt,
-                            model=model_to_use,
-                            max_new_tokens=max_new_tokens,
-                            temperature=temperature
-                        )
+                response = await asyncio.get_event_loop().run_in_executor(
+                    None,
+                    lambda: client.text_generation(
+                        prompt,
+                        max_new_tokens=max_new_tokens,
+                        temperature=temperature,
+                        **model_kwargs
                     )
+                )
                 return response
                 
             except Exception as text_error:
@@ -283,4 +584,4 @@ async def generate_text(prompt: str, llm_config: Optional[dict] = None,
         else:
             # Re-raise the original error if it's not a task compatibility issue
             logger.error(f"chat_completion failed with non-compatibility error: {e}")
-            raise e
\ No newline at end of file
+            raise e
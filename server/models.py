@@ -26,10 +26,13 @@ class ChatRoom:
         self.messages: List[Dict[str, Any]] = []
         self.connected_clients: Set[Any] = set()
         self.max_history: int = 100
+        # Total number of messages ever posted (the history itself is bounded)
+        self.message_count: int = 0
 
     def add_message(self, message: Dict[str, Any]) -> None:
         """Add a message to the chat room history."""
         self.messages.append(message)
+        self.message_count += 1
         if len(self.messages) > self.max_history:
             self.messages.pop(0)
 
@@ -0,0 +1,207 @@
+"""
+Outbound queue of a WebSocket connection: a single writer task sends the messages,
+control messages ahead of bulk ones (clips, thumbnails), and slow consumers are dealt with
+by a policy instead of letting their messages pile up in memory.
+"""
+import time
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, Optional, Tuple, Union
+
+from aiohttp import WSCloseCode
+
+from .dispatcher import DISPATCH_LATENCY_BUCKETS
+from .llm_metrics import RollingHistogram
+from .ws_codec import BroadcastMessage, WebSocketCodec
+
+logger = logging.getLogger(__name__)
+
+CONTROL, BULK = 0, 1
+
+# Actions of the multi-megabyte messages, sent after the control ones
+BULK_ACTIONS = {'generate_video', 'generate_video_thumbnail', 'video_thumbnail', 'stream_clip'}
+# Pushed messages which a slow consumer can do without (a newer one makes them stale)
+DROPPABLE_ACTIONS = {'stream_clip', 'video_thumbnail', 'shared_story_update'}
+# Pushed messages where only the latest one of a video matters
+COALESCED_ACTIONS = {'stream_clip', 'shared_story_update'}
+
+# Slow consumer policies, each one falling back to the next one if it can't free enough room
+SLOW_CONSUMER_POLICIES = ('coalesce', 'drop_stale', 'disconnect')
+
+QUEUE_DEPTH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+@dataclass
+class OutboundMessage:
+    """An encoded message waiting to be sent."""
+    data: Union[str, bytes]
+    binary: bool
+    droppable: bool
+    coalesce_key: Optional[Tuple[str, Any]]
+    enqueued_at: float
+
+
+class OutboundMetrics:
+    """Metrics of the outbound queues of all the connections."""
+
+    def __init__(self, window: float = 3600):
+        self.sent = 0
+        self.bytes_sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.send_timeouts = 0
+        self.disconnects = 0
+        # from the enqueuing of a message to the end of its sending
+        self.send_latency = RollingHistogram(DISPATCH_LATENCY_BUCKETS, window)
+        # depth of the queue when a message is enqueued
+        self.queue_depth = RollingHistogram(QUEUE_DEPTH_BUCKETS, window)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'sent': self.sent,
+            'bytes_sent': self.bytes_sent,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'send_timeouts': self.send_timeouts,
+            'slow_consumer_disconnects': self.disconnects,
+            'send_latency': self.send_latency.get_stats(),
+            'queue_depth': self.queue_depth.get_stats()
+        }
+
+
+class OutboundQueue:
+    """
+    Bounded outbound queue of a connection, with two priority classes.
+
+    When the queue exceeds max_messages or max_bytes, the policy 'coalesce' replaces the queued
+    messages superseded by the new one, 'drop_stale' drops the oldest droppable messages, and
+    'disconnect' closes the connection. The writer task only runs while there is something to send.
+    """
+
+    def __init__(self, ws, metrics: OutboundMetrics, max_messages: int = 256, max_bytes: int = 16 * 1024 * 1024,
+                 policy: str = 'drop_stale', send_timeout: float = 30.0):
+        self.ws = ws
+        self.metrics = metrics
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policies = SLOW_CONSUMER_POLICIES[SLOW_CONSUMER_POLICIES.index(policy):]
+        self.send_timeout = send_timeout
+        self.queues: Tuple[Deque[OutboundMessage], Deque[OutboundMessage]] = (deque(), deque())
+        self.size = 0
+        self.bytes = 0
+        self.writer: Optional[asyncio.Task] = None
+        self.disconnect_task: Optional[asyncio.Task] = None
+        self.closed = False
+
+    def put(self, payload: Union[Dict[str, Any], BroadcastMessage], codec: WebSocketCodec) -> None:
+        """Encode a message and queue it for the writer"""
+        if self.closed:
+            raise ConnectionResetError('Connection closed')
+
+        if isinstance(payload, BroadcastMessage):
+            message, data = payload.payload, payload.encode(codec)
+        else:
+            message, data = payload, codec.encode(payload)
+        action = message.get('action')
+        item = OutboundMessage(
+            data=data,
+            binary=codec.binary,
+            droppable=action in DROPPABLE_ACTIONS,
+            coalesce_key=(action, message.get('video_id')) if action in COALESCED_ACTIONS else None,
+            enqueued_at=time.time()
+        )
+
+        if self.size and not self._has_room(item) and not self._make_room(item):
+            self.metrics.disconnects += 1
+            logger.warning(f"Disconnecting slow consumer ({self.size} messages, {self.bytes} bytes queued)")
+            self.close()
+            self.disconnect_task = asyncio.create_task(self._disconnect())
+            raise ConnectionResetError('Slow consumer disconnected')
+
+        self.metrics.queue_depth.observe(self.size)
+        self.queues[BULK if action in BULK_ACTIONS else CONTROL].append(item)
+        self.size += 1
+        self.bytes += len(data)
+
+        if self.writer is None:
+            self.writer = asyncio.create_task(self._write())
+
+    def is_empty(self) -> bool:
+        """Check whether every queued message has been sent"""
+        return not self.size and self.writer is None
+
+    def _has_room(self, item: OutboundMessage) -> bool:
+        return self.size < self.max_messages and self.bytes + len(item.data) <= self.max_bytes
+
+    def _remove(self, predicate) -> bool:
+        """Remove the oldest queued message matching a predicate"""
+        for queue in self.queues:
+            for queued in queue:
+                if predicate(queued):
+                    queue.remove(queued)
+                    self.size -= 1
+                    self.bytes -= len(queued.data)
+                    return True
+        return False
+
+    def _make_room(self, item: OutboundMessage) -> bool:
+        """Apply the slow consumer policies until there is room for a message"""
+        for policy in self.policies:
+            if policy == 'coalesce' and item.coalesce_key is not None:
+                while not self._has_room(item) and self._remove(lambda queued: queued.coalesce_key == item.coalesce_key):
+                    self.metrics.coalesced += 1
+            elif policy == 'drop_stale':
+                while not self._has_room(item) and self._remove(lambda queued: queued.droppable):
+                    self.metrics.dropped += 1
+            if self._has_room(item):
+                return True
+        return False
+
+    async def _write(self) -> None:
+        try:
+            while not self.closed and self.size:
+                queue = self.queues[CONTROL] or self.queues[BULK]
+                item = queue.popleft()
+                self.size -= 1
+                self.bytes -= len(item.data)
+
+                send = self.ws.send_bytes if item.binary else self.ws.send_str
+                try:
+                    await asyncio.wait_for(send(item.data), timeout=self.send_timeout)
+                except asyncio.TimeoutError:
+                    self.metrics.send_timeouts += 1
+                    self.metrics.disconnects += 1
+                    logger.warning(f"Disconnecting slow consumer (send blocked for {self.send_timeout}s)")
+                    self.close()
+                    await self._disconnect()
+                    return
+                except Exception as e:
+                    logger.error(f"Error sending message: {e}")
+                    self.close()
+                    return
+
+                self.metrics.sent += 1
+                self.metrics.bytes_sent += len(item.data)
+                self.metrics.send_latency.observe(time.time() - item.enqueued_at)
+        finally:
+            if self.writer is asyncio.current_task():
+                self.writer = None
+
+    async def _disconnect(self) -> None:
+        try:
+            await self.ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=b'Slow consumer')
+        except Exception as e:
+            logger.error(f"Error closing the connection of a slow consumer: {e}")
+
+    def close(self) -> None:
+        """Drop the queued messages and stop the writer"""
+        self.closed = True
+        for queue in self.queues:
+            queue.clear()
+        self.size = 0
+        self.bytes = 0
+        if self.writer is not None and self.writer is not asyncio.current_task():
+            self.writer.cancel()
+        self.writer = None
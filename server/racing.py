@@ -0,0 +1,91 @@
+"""
+Utilities to race several concurrent LLM attempts and keep the first acceptable one.
+"""
+import math
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveRaceWidth:
+    """
+    Tracks the failure rate of attempts per model (as an EWMA) and derives
+    how many attempts should be raced so that all of them failing stays unlikely.
+
+    A model that almost never fails gets a width of 1 (no extra tokens spent),
+    a flaky one gets up to `max_width` concurrent attempts. A model starts with no
+    failure, so it is only raced once it has actually been seen failing.
+    """
+
+    def __init__(self, max_width: int = 3, target_failure: float = 0.1,
+                 alpha: float = 0.1, initial_failure_rate: float = 0.0):
+        self.max_width = max(1, max_width)
+        self.target_failure = target_failure
+        self.alpha = alpha
+        self.initial_failure_rate = initial_failure_rate
+        self.failure_rates: Dict[str, float] = {}
+        self.attempts: Dict[str, int] = {}
+
+    def record(self, model: str, success: bool) -> None:
+        """Record the outcome of a single attempt"""
+        rate = self.failure_rates.get(model, self.initial_failure_rate)
+        self.failure_rates[model] = (1 - self.alpha) * rate + self.alpha * (0.0 if success else 1.0)
+        self.attempts[model] = self.attempts.get(model, 0) + 1
+
+    def get_width(self, model: str) -> int:
+        """Get the number of attempts to race for a model"""
+        rate = self.failure_rates.get(model, self.initial_failure_rate)
+        if rate <= self.target_failure:
+            return 1
+        if rate >= 0.99:
+            return self.max_width
+        # smallest K such that rate^K <= target_failure
+        width = math.ceil(math.log(self.target_failure) / math.log(rate))
+        return max(1, min(self.max_width, width))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get the failure rate and current race width per model"""
+        return {
+            model: {
+                'failure_rate': round(rate, 3),
+                'attempts': self.attempts.get(model, 0),
+                'width': self.get_width(model)
+            }
+            for model, rate in self.failure_rates.items()
+        }
+
+
+async def race_first(coros: List[Awaitable[Any]],
+                     accept: Callable[[Any], bool]) -> Tuple[Optional[Any], List[Any]]:
+    """
+    Run coroutines concurrently and return the first result accepted by `accept`,
+    cancelling the ones still running.
+
+    Returns a tuple (winner, rejected) where winner is None if no result was accepted
+    and rejected holds the results (or exceptions) of the completed losing attempts.
+    """
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    pending = set(tasks)
+    rejected: List[Any] = []
+
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.cancelled():
+                    continue
+                if task.exception() is not None:
+                    rejected.append(task.exception())
+                    continue
+                result = task.result()
+                if accept(result):
+                    return result, rejected
+                rejected.append(result)
+        return None, rejected
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
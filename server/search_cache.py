@@ -0,0 +1,182 @@
+"""
+Search result cache with query normalization and a warm pool of results per query.
+"""
+import re
+import time
+import uuid
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Any, List, Optional, Tuple
+
+from .similarity_index import SimilarityIndex
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalize a search query so that trivially different spellings share a cache entry.
+
+    Lowercases, strips punctuation and collapses whitespace,
+    eg "  Cat   Surfing!! " -> "cat surfing"
+    """
+    query = query.lower()
+    query = re.sub(r'[^\w\s]', ' ', query)
+    return ' '.join(query.split())
+
+
+@dataclass
+class SearchPool:
+    """A pool of distinct past results for a single normalized query."""
+    results: List[Dict[str, Any]] = field(default_factory=list)
+    created_at: List[float] = field(default_factory=list)
+    next_index: int = 0
+    hits: int = 0
+    last_hit: float = 0
+
+
+class SearchCache:
+    """
+    LRU cache mapping normalized queries to a pool of search results.
+
+    Results are served round-robin so that repeated searches still feel fresh,
+    and pools are topped up in the background for the hottest queries.
+    When a similarity index is given, a query without its own pool can also be
+    served from the pool of a near-duplicate query ("a surfing cat video" -> "cat surfing"),
+    and the results generated for it on a miss go to that same pool.
+    """
+
+    def __init__(self, pool_size: int = 8, max_queries: int = 2000, ttl: float = 3600,
+                 similarity_index: Optional[SimilarityIndex] = None):
+        self.pool_size = pool_size
+        self.max_queries = max_queries
+        self.ttl = ttl
+        self.pools: "OrderedDict[str, SearchPool]" = OrderedDict()
+        self.similarity_index = similarity_index
+
+        # Statistics
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.refills = 0
+
+    def _expire(self, pool: SearchPool) -> None:
+        """Drop results older than the TTL from a pool"""
+        cutoff = time.time() - self.ttl
+        kept = [(r, t) for r, t in zip(pool.results, pool.created_at) if t >= cutoff]
+        pool.results = [r for r, _ in kept]
+        pool.created_at = [t for _, t in kept]
+        if pool.results:
+            pool.next_index %= len(pool.results)
+        else:
+            pool.next_index = 0
+
+    def _resolve(self, key: str) -> Tuple[str, Optional[SearchPool], bool]:
+        """
+        Find the pool of a normalized query, or of a near-duplicate query if it has none,
+        as a tuple (key of the pool, pool or None, whether it is a near-duplicate)
+        """
+        pool = self.pools.get(key)
+        if pool is None and self.similarity_index is not None and key:
+            match = self.similarity_index.find(key)
+            if match:
+                matched_key, _ = match
+                matched_pool = self.pools.get(matched_key)
+                if matched_pool is not None:
+                    return matched_key, matched_pool, True
+        return key, pool, False
+
+    def get(self, query: str) -> Optional[Dict[str, Any]]:
+        """
+        Get a cached result for a query, or None if the pool is not full yet.
+
+        A pool is only served once it holds `pool_size` results, so the first
+        searches for a query keep generating fresh results to fill it.
+        """
+        key, pool, is_near_hit = self._resolve(normalize_query(query))
+
+        if pool is None:
+            self.misses += 1
+            return None
+
+        self.pools.move_to_end(key)
+        pool.hits += 1
+        pool.last_hit = time.time()
+        self._expire(pool)
+
+        if len(pool.results) < self.pool_size:
+            self.misses += 1
+            return None
+
+        result = pool.results[pool.next_index]
+        pool.next_index = (pool.next_index + 1) % len(pool.results)
+        self.hits += 1
+        if is_near_hit:
+            self.near_hits += 1
+
+        # Give each served copy its own id so cards rendered side by side stay distinct
+        return {**result, 'id': str(uuid.uuid4())}
+
+    def add(self, query: str, result: Dict[str, Any]) -> None:
+        """
+        Add a freshly generated result to the pool of a query,
+        or to the pool of its near-duplicate query so that the variants fill a single pool
+        """
+        key = normalize_query(query)
+        if not key:
+            return
+
+        key, pool, _ = self._resolve(key)
+        if pool is None:
+            pool = SearchPool()
+            self.pools[key] = pool
+            if self.similarity_index is not None:
+                self.similarity_index.add(key)
+        self.pools.move_to_end(key)
+
+        # Keep the pool made of distinct results
+        if any(r.get('title') == result.get('title') for r in pool.results):
+            return
+
+        pool.results.append(result)
+        pool.created_at.append(time.time())
+        if len(pool.results) > self.pool_size:
+            pool.results.pop(0)
+            pool.created_at.pop(0)
+            pool.next_index %= len(pool.results)
+
+        while len(self.pools) > self.max_queries:
+            evicted_key, _ = self.pools.popitem(last=False)
+            if self.similarity_index is not None:
+                self.similarity_index.remove(evicted_key)
+
+    def get_refill_candidates(self, limit: int) -> List[str]:
+        """
+        Get the hottest queries whose pool is missing results.
+        Hit counts are halved on each call so hotness follows recent traffic.
+        """
+        candidates = []
+        for key, pool in self.pools.items():
+            self._expire(pool)
+            if len(pool.results) < self.pool_size and pool.hits > 0:
+                candidates.append((pool.hits, key))
+            pool.hits //= 2
+        candidates.sort(reverse=True)
+        return [key for _, key in candidates[:limit]]
+
+    def get_stats(self, include_samples: bool = False) -> Dict[str, Any]:
+        """Get cache statistics"""
+        total = self.hits + self.misses
+        stats = {
+            'queries': len(self.pools),
+            'results': sum(len(pool.results) for pool in self.pools.values()),
+            'hits': self.hits,
+            'near_hits': self.near_hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'refills': self.refills,
+        }
+        if self.similarity_index is not None:
+            stats['similarity'] = self.similarity_index.get_stats(include_samples)
+        return stats
@@ -0,0 +1,352 @@
+"""
+State shared by the worker processes of the multi-process mode, served over a Unix socket
+by the supervisor process: endpoint slots, rate limit counters, gauges and pub/sub channels.
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from .api_config import SHARED_STATE_SOCKET
+from .endpoint_manager import EndpointManager
+from .llm_metrics import RollingHistogram
+from .models import Endpoint
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the request latency buckets (the last bucket is unbounded)
+SHARED_STATE_LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1)
+# Maximum size of a message (a line of JSON)
+MAX_MESSAGE_SIZE = 4 * 1024 * 1024
+# Interval between two purges of the expired counters
+PURGE_INTERVAL_SECONDS = 60
+
+
+def _encode(message: Dict[str, Any]) -> bytes:
+    return json.dumps(message).encode('utf-8') + b'\n'
+
+
+@dataclass(eq=False)
+class WorkerConnection:
+    """What a worker holds on the shared state server, released when its connection is lost."""
+    writer: asyncio.StreamWriter
+    endpoints: List[Endpoint] = field(default_factory=list)
+    gauges: Dict[str, int] = field(default_factory=dict)
+    channels: Set[str] = field(default_factory=set)
+
+
+class SharedStateServer:
+    """
+    Shared state server, run by the supervisor of the workers.
+
+    Each request is a line of JSON {'id', 'op', ...} answered by {'id', 'result'} (or {'id', 'error'}),
+    and the messages published on a channel are pushed as {'channel', 'message'} to the other subscribers.
+    The endpoints are picked with the same strategy as in a single process, but across all the workers,
+    and their state is pushed on the 'endpoints' channel whenever it changes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.endpoint_manager = EndpointManager()
+        # key -> (value, expiry timestamp or None)
+        self.counters: Dict[str, Tuple[int, Optional[float]]] = {}
+        self.gauges: Dict[str, int] = {}
+        self.channels: Dict[str, Set[WorkerConnection]] = {}
+        self.connections: Set[WorkerConnection] = set()
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.purge_task: Optional[asyncio.Task] = None
+
+        # Statistics
+        self.requests = 0
+        self.messages_published = 0
+
+    async def start(self) -> None:
+        """Start listening on the Unix socket (replacing a stale one)"""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self._handle, path=self.path, limit=MAX_MESSAGE_SIZE)
+        self.purge_task = asyncio.create_task(self._purge_counters())
+        logger.info(f"Shared state server listening on {self.path}")
+
+    async def close(self) -> None:
+        """Stop the server and remove its socket"""
+        if self.purge_task is not None:
+            self.purge_task.cancel()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def _purge_counters(self) -> None:
+        while True:
+            await asyncio.sleep(PURGE_INTERVAL_SECONDS)
+            current_time = time.time()
+            for key in [key for key, (_, expires_at) in self.counters.items()
+                        if expires_at is not None and expires_at <= current_time]:
+                del self.counters[key]
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        conn = WorkerConnection(writer=writer)
+        self.connections.add(conn)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = json.loads(line)
+                self.requests += 1
+                handler = getattr(self, f"_op_{request.pop('op', '')}", None)
+                request_id = request.pop('id', None)
+                try:
+                    if handler is None:
+                        raise ValueError('Unknown operation')
+                    reply = {'id': request_id, 'result': await handler(conn, **request)}
+                except Exception as e:
+                    reply = {'id': request_id, 'error': str(e)}
+                writer.write(_encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logger.warning(f"Lost the connection of a worker: {e}")
+        finally:
+            await self._release(conn)
+            writer.close()
+
+    async def _release(self, conn: WorkerConnection) -> None:
+        """Release what a worker held (it exited, or crashed)"""
+        self.connections.discard(conn)
+        for endpoint in conn.endpoints:
+            await self.endpoint_manager.release(endpoint)
+        if conn.endpoints:
+            self._push('endpoints', self._get_endpoint_snapshot(), conn)
+        for key, value in conn.gauges.items():
+            self.gauges[key] = self.gauges.get(key, 0) - value
+            if not self.gauges[key]:
+                del self.gauges[key]
+        for channel in conn.channels:
+            self.channels.get(channel, set()).discard(conn)
+
+    def _get_endpoint_snapshot(self) -> Dict[str, Any]:
+        """Get the state of the endpoints, and the generations holding one across all the workers"""
+        return {
+            'endpoints': [
+                {'id': ep.id, 'busy': ep.busy, 'last_used': ep.last_used,
+                 'error_count': ep.error_count, 'error_until': ep.error_until}
+                for ep in self.endpoint_manager.endpoints
+            ],
+            'in_flight': self.endpoint_manager.in_flight
+        }
+
+    def _publish_endpoints(self, conn: WorkerConnection) -> Dict[str, Any]:
+        """Push the state of the endpoints to the other workers, returns it for the reply to conn"""
+        snapshot = self._get_endpoint_snapshot()
+        self._push('endpoints', snapshot, conn)
+        return snapshot
+
+    def _push(self, channel: str, message: Any, sender: Optional[WorkerConnection] = None) -> int:
+        """Push a message to the subscribers of a channel (except its sender), returns their number"""
+        data = _encode({'channel': channel, 'message': message})
+        subscribers = [subscriber for subscriber in self.channels.get(channel, ()) if subscriber is not sender]
+        for subscriber in subscribers:
+            subscriber.writer.write(data)
+        return len(subscribers)
+
+    def _get_endpoint(self, endpoint_id: int) -> Endpoint:
+        for endpoint in self.endpoint_manager.endpoints:
+            if endpoint.id == endpoint_id:
+                return endpoint
+        raise ValueError(f'Unknown endpoint {endpoint_id}')
+
+    async def _op_acquire_endpoint(self, conn: WorkerConnection, lane: str = 'clip') -> Dict[str, Any]:
+        endpoint = await self.endpoint_manager.acquire(lane)
+        conn.endpoints.append(endpoint)
+        return {'endpoint_id': endpoint.id, **self._publish_endpoints(conn)}
+
+    async def _op_release_endpoint(self, conn: WorkerConnection, endpoint_id: int) -> Dict[str, Any]:
+        endpoint = self._get_endpoint(endpoint_id)
+        if endpoint in conn.endpoints:
+            conn.endpoints.remove(endpoint)
+            await self.endpoint_manager.release(endpoint)
+        return self._publish_endpoints(conn)
+
+    async def _op_endpoint_error(self, conn: WorkerConnection, endpoint_id: int,
+                                 is_timeout: bool = False) -> Dict[str, Any]:
+        await self.endpoint_manager.mark_endpoint_error(self._get_endpoint(endpoint_id), is_timeout)
+        return self._publish_endpoints(conn)
+
+    async def _op_get_endpoints(self, conn: WorkerConnection) -> Dict[str, Any]:
+        return self._get_endpoint_snapshot()
+
+    async def _op_incr(self, conn: WorkerConnection, key: str, amount: int = 1,
+                       ttl: Optional[float] = None) -> int:
+        value, expires_at = self.counters.get(key, (0, None))
+        if expires_at is not None and expires_at <= time.time():
+            value = 0
+        value += amount
+        self.counters[key] = (value, time.time() + ttl if ttl else None)
+        return value
+
+    async def _op_get(self, conn: WorkerConnection, keys: List[str]) -> List[int]:
+        current_time = time.time()
+        values = []
+        for key in keys:
+            value, expires_at = self.counters.get(key, (0, None))
+            values.append(0 if expires_at is not None and expires_at <= current_time else value)
+        return values
+
+    async def _op_gauge(self, conn: WorkerConnection, key: str, delta: int) -> int:
+        conn.gauges[key] = conn.gauges.get(key, 0) + delta
+        if not conn.gauges[key]:
+            del conn.gauges[key]
+        self.gauges[key] = self.gauges.get(key, 0) + delta
+        value = self.gauges[key]
+        if not value:
+            del self.gauges[key]
+        return value
+
+    async def _op_subscribe(self, conn: WorkerConnection, channel: str) -> None:
+        conn.channels.add(channel)
+        self.channels.setdefault(channel, set()).add(conn)
+
+    async def _op_publish(self, conn: WorkerConnection, channel: str, message: Any) -> int:
+        """Push a message to the other subscribers of a channel, returns their number"""
+        self.messages_published += 1
+        return self._push(channel, message, conn)
+
+    async def _op_stats(self, conn: WorkerConnection) -> Dict[str, Any]:
+        return self.get_stats()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'workers': len(self.connections),
+            'requests': self.requests,
+            'messages_published': self.messages_published,
+            'endpoints_in_flight': self.endpoint_manager.in_flight,
+            'counters': len(self.counters),
+            'gauges': len(self.gauges),
+            'channels': {channel: len(subscribers) for channel, subscribers in self.channels.items()}
+        }
+
+
+class SharedStateClient:
+    """Connection of a worker process to the shared state server."""
+
+    def __init__(self, path: str, window: float = 3600):
+        self.path = path
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.reader_task: Optional[asyncio.Task] = None
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.next_id = 0
+        # channel -> callback of the messages published by the other workers
+        self.subscriptions: Dict[str, Callable[[Any], Awaitable[None]]] = {}
+
+        # Statistics
+        self.requests = 0
+        self.errors = 0
+        self.messages_received = 0
+        self.latency = RollingHistogram(SHARED_STATE_LATENCY_BUCKETS, window)
+
+    @property
+    def connected(self) -> bool:
+        return self.writer is not None
+
+    async def connect(self, timeout: float = 10.0) -> None:
+        """Connect to the server (waiting for it to start) and subscribe to the channels"""
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.path, limit=MAX_MESSAGE_SIZE)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.time() >= deadline:
+                    raise
+                await asyncio.sleep(0.1)
+        self.reader_task = asyncio.create_task(self._read())
+        for channel in self.subscriptions:
+            await self.request('subscribe', channel=channel)
+        logger.info(f"Connected to the shared state server on {self.path}")
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            await asyncio.gather(self.reader_task, return_exceptions=True)
+
+    async def request(self, op: str, **args) -> Any:
+        """Run an operation on the server and return its result"""
+        if self.writer is None:
+            raise ConnectionError('Not connected to the shared state server')
+        self.next_id += 1
+        request_id = self.next_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        started = time.time()
+        self.requests += 1
+        try:
+            self.writer.write(_encode({'id': request_id, 'op': op, **args}))
+            await self.writer.drain()
+            return await future
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.pending.pop(request_id, None)
+            self.latency.observe(time.time() - started)
+
+    def subscribe(self, channel: str, callback: Callable[[Any], Awaitable[None]]) -> None:
+        """Get the messages published on a channel by the other workers (subscribed on connection)"""
+        self.subscriptions[channel] = callback
+
+    async def publish(self, channel: str, message: Any) -> int:
+        """Publish a message to the other workers, returns the number of workers it was pushed to"""
+        return await self.request('publish', channel=channel, message=message)
+
+    async def _read(self) -> None:
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if 'channel' in message:
+                    self.messages_received += 1
+                    callback = self.subscriptions.get(message['channel'])
+                    if callback is not None:
+                        try:
+                            await callback(message['message'])
+                        except Exception as e:
+                            logger.error(f"Error handling a message of channel {message['channel']}: {e}")
+                    continue
+                future = self.pending.get(message.get('id'))
+                if future is None or future.done():
+                    continue
+                if 'error' in message:
+                    future.set_exception(RuntimeError(message['error']))
+                else:
+                    future.set_result(message.get('result'))
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logger.error(f"Error reading from the shared state server: {e}")
+        finally:
+            self.writer = None
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('Lost the connection to the shared state server'))
+            logger.warning("Disconnected from the shared state server")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'connected': self.connected,
+            'requests': self.requests,
+            'errors': self.errors,
+            'messages_received': self.messages_received,
+            'latency': self.latency.get_stats()
+        }
+
+
+# Set in the worker processes of the multi-process mode (by the supervisor)
+shared_state = SharedStateClient(SHARED_STATE_SOCKET) if SHARED_STATE_SOCKET else None
@@ -0,0 +1,187 @@
+"""
+Shared simulation loop: one server-side story per watched video, advanced on a
+fixed cadence and broadcast to every subscribed viewer.
+"""
+import time
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional, Set
+
+from aiohttp import web
+
+from .ws_codec import BroadcastMessage, send_message
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SharedStory:
+    """A story shared by all the viewers of a video."""
+    video_id: str
+    story_id: str
+    # kept to seed a new story state if the current one was evicted from the store
+    original_title: str
+    original_description: str
+    current_description: str
+    # the story is evolved with the priority of the viewer who started it
+    user_role: str
+    subscribers: Set[web.WebSocketResponse] = field(default_factory=set)
+    task: Optional[asyncio.Task] = None
+    # number of chat messages of the room already given to the LLM
+    chat_cursor: int = 0
+    evolution_count: int = 0
+    last_evolved: float = 0
+
+
+class SharedStoryManager:
+    """
+    Runs one simulation task per video with at least one subscriber,
+    so the LLM cost of a video doesn't depend on the size of its audience.
+    """
+
+    def __init__(self, api, interval: float = 10.0):
+        self.api = api
+        self.interval = interval
+        self.stories: Dict[str, SharedStory] = {}
+        self.lock = asyncio.Lock()
+
+        # Statistics
+        self.evolutions_shed = 0
+
+    async def subscribe(self, video_id: str, ws: web.WebSocketResponse,
+                        original_title: str, original_description: str, user_role: str) -> Dict[str, Any]:
+        """Subscribe a viewer to the shared story of a video, starting it if needed"""
+        async with self.lock:
+            shared = self.stories.get(video_id)
+            if shared is None:
+                story = self.api.story_states.create(
+                    video_id, original_title, original_description, original_description
+                )
+                story.pinned = True
+                room = self.api.chat_manager.chat_rooms[video_id]
+                shared = SharedStory(
+                    video_id=video_id,
+                    story_id=story.story_id,
+                    original_title=original_title,
+                    original_description=original_description,
+                    current_description=original_description,
+                    user_role=user_role,
+                    chat_cursor=room.message_count
+                )
+                self.stories[video_id] = shared
+                shared.task = asyncio.create_task(self._run(shared))
+                logger.info(f"Started shared story for video {video_id} (role={user_role})")
+            shared.subscribers.add(ws)
+
+        story = self.api.story_states.get(shared.story_id)
+        return {
+            'story_id': shared.story_id,
+            'evolved_description': story.current_description if story else original_description,
+            'evolution_count': shared.evolution_count,
+            'subscribers': len(shared.subscribers)
+        }
+
+    async def unsubscribe(self, video_id: str, ws: web.WebSocketResponse) -> None:
+        """Unsubscribe a viewer, stopping the story when the last one leaves"""
+        async with self.lock:
+            shared = self.stories.get(video_id)
+            if shared is None:
+                return
+            shared.subscribers.discard(ws)
+            if shared.subscribers:
+                return
+            del self.stories[video_id]
+
+        # The story itself unsubscribes the viewers it fails to reach, then stops on its own
+        if shared.task and shared.task is not asyncio.current_task():
+            shared.task.cancel()
+            await asyncio.gather(shared.task, return_exceptions=True)
+        story = self.api.story_states.get(shared.story_id)
+        if story:
+            story.pinned = False
+        logger.info(f"Stopped shared story for video {video_id}, no viewer left")
+
+    def count_subscriptions(self, ws: web.WebSocketResponse) -> int:
+        """Count the shared stories a viewer is subscribed to"""
+        return sum(1 for shared in self.stories.values() if ws in shared.subscribers)
+
+    async def unsubscribe_all(self, ws: web.WebSocketResponse) -> None:
+        """Unsubscribe a viewer from every shared story (when its session ends)"""
+        for video_id in [video_id for video_id, shared in self.stories.items() if ws in shared.subscribers]:
+            await self.unsubscribe(video_id, ws)
+
+    def _collect_chat_messages(self, shared: SharedStory) -> str:
+        """Get the chat messages posted in the video's room since the last evolution"""
+        room = self.api.chat_manager.chat_rooms[shared.video_id]
+        new_count = min(room.message_count - shared.chat_cursor, len(room.messages))
+        shared.chat_cursor = room.message_count
+        if new_count <= 0:
+            return ''
+        return '\n'.join(
+            f"{message.get('username', 'Anonymous')}: {message.get('content', '')}"
+            for message in room.messages[-new_count:]
+        )
+
+    async def _run(self, shared: SharedStory) -> None:
+        """Advance the story on a fixed cadence and broadcast each evolution"""
+        while self.stories.get(shared.video_id) is shared:
+            started = time.time()
+            try:
+                # Each evolution goes through the admission control like the simulations requested by the viewers
+                retry_after = await self.api.admission.admit_request(shared.user_role)
+                if retry_after is not None:
+                    self.evolutions_shed += 1
+                    await asyncio.sleep(retry_after)
+                    continue
+
+                # The story fields are only used if the story state is gone from the store (it is pinned)
+                result = await self.api.simulate(
+                    original_title=shared.original_title,
+                    original_description=shared.original_description,
+                    current_description=shared.current_description,
+                    condensed_history='',
+                    evolution_count=shared.evolution_count,
+                    chat_messages=self._collect_chat_messages(shared),
+                    story_id=shared.story_id,
+                    video_id=shared.video_id
+                )
+                if result['story_id'] != shared.story_id:
+                    # A story state created by simulate, if the previous one was lost anyway
+                    story = self.api.story_states.get(result['story_id'])
+                    if story:
+                        story.pinned = True
+                shared.story_id = result['story_id']
+                shared.current_description = result['evolved_description']
+                shared.evolution_count += 1
+                shared.last_evolved = time.time()
+
+                message = BroadcastMessage({
+                    'action': 'shared_story_update',
+                    'broadcast': True,
+                    'video_id': shared.video_id,
+                    'story_id': shared.story_id,
+                    'evolved_description': result['evolved_description'],
+                    'evolution_count': shared.evolution_count
+                })
+                for ws in list(shared.subscribers):
+                    try:
+                        await send_message(ws, message)
+                    except Exception as e:
+                        logger.error(f"Failed to broadcast shared story update: {e}")
+                        # Unpins the story and stops this task once the last viewer is gone
+                        await self.unsubscribe(shared.video_id, ws)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error evolving shared story for video {shared.video_id}: {e}")
+
+            await asyncio.sleep(max(0.0, self.interval - (time.time() - started)))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get the number of shared stories and viewers"""
+        return {
+            'stories': len(self.stories),
+            'subscribers': sum(len(shared.subscribers) for shared in self.stories.values()),
+            'evolutions_shed': self.evolutions_shed
+        }
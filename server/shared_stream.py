@@ -0,0 +1,188 @@
+"""
+Shared video streams: the clips of a shared stream are generated once and
+pushed to every subscribed viewer, with a short replay buffer for late joiners.
+"""
+import time
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, Optional, Set
+
+from aiohttp import web
+
+from .utils import generate_seed
+from .ws_codec import BroadcastMessage, send_message
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SharedStream:
+    """A stream of clips shared by all the viewers of a video."""
+    video_id: str
+    title: str
+    description: str
+    video_prompt_prefix: str
+    options: Dict[str, Any]
+    # the stream is rendered with the settings of the viewer who started it
+    user_role: str
+    subscribers: Set[web.WebSocketResponse] = field(default_factory=set)
+    replay: Deque[BroadcastMessage] = field(default_factory=deque)
+    task: Optional[asyncio.Task] = None
+    sequence: int = 0
+
+
+class SharedStreamManager:
+    """
+    Runs one clip generation task per shared stream, so GPU cost scales
+    with the number of distinct streams instead of the number of viewers.
+
+    When the video also has a shared story, each clip follows its latest description.
+    """
+
+    def __init__(self, api, clip_interval: float = 2.5, replay_size: int = 3):
+        self.api = api
+        self.clip_interval = clip_interval
+        self.replay_size = replay_size
+        self.streams: Dict[str, SharedStream] = {}
+        self.lock = asyncio.Lock()
+
+        # Statistics
+        self.clips_generated = 0
+        self.clips_delivered = 0
+        self.clips_shed = 0
+
+    async def subscribe(self, video_id: str, ws: web.WebSocketResponse, title: str, description: str,
+                        video_prompt_prefix: str, options: Dict[str, Any], user_role: str) -> Dict[str, Any]:
+        """Subscribe a viewer to the shared stream of a video, starting it if needed"""
+        async with self.lock:
+            stream = self.streams.get(video_id)
+            if stream is None:
+                stream = SharedStream(
+                    video_id=video_id,
+                    title=title,
+                    description=description,
+                    video_prompt_prefix=video_prompt_prefix,
+                    options={**options, 'video_id': video_id},
+                    user_role=user_role,
+                    replay=deque(maxlen=self.replay_size)
+                )
+                self.streams[video_id] = stream
+                stream.task = asyncio.create_task(self._run(stream))
+                logger.info(f"Started shared stream for video {video_id} (role={user_role})")
+            stream.subscribers.add(ws)
+            replay = list(stream.replay)
+
+        # Late joiners get the most recent clips right away
+        for message in replay:
+            if not await self._send(ws, message):
+                await self.unsubscribe(video_id, ws)
+                break
+
+        return {
+            'video_id': video_id,
+            'subscribers': len(stream.subscribers),
+            'replayed_clips': len(replay)
+        }
+
+    async def unsubscribe(self, video_id: str, ws: web.WebSocketResponse) -> None:
+        """Unsubscribe a viewer, stopping the stream when the last one leaves"""
+        async with self.lock:
+            stream = self.streams.get(video_id)
+            if stream is None:
+                return
+            stream.subscribers.discard(ws)
+            if stream.subscribers:
+                return
+            del self.streams[video_id]
+
+        # The stream itself unsubscribes the viewers it fails to reach, then stops on its own
+        if stream.task and stream.task is not asyncio.current_task():
+            stream.task.cancel()
+            await asyncio.gather(stream.task, return_exceptions=True)
+        logger.info(f"Stopped shared stream for video {video_id}, no viewer left")
+
+    def count_subscriptions(self, ws: web.WebSocketResponse) -> int:
+        """Count the shared streams a viewer is subscribed to"""
+        return sum(1 for stream in self.streams.values() if ws in stream.subscribers)
+
+    async def unsubscribe_all(self, ws: web.WebSocketResponse) -> None:
+        """Unsubscribe a viewer from every shared stream (when its session ends)"""
+        for video_id in [video_id for video_id, stream in self.streams.items() if ws in stream.subscribers]:
+            await self.unsubscribe(video_id, ws)
+
+    async def _send(self, ws: web.WebSocketResponse, message: BroadcastMessage) -> bool:
+        """Push a clip to a viewer, returns False if its connection failed"""
+        try:
+            await send_message(ws, message)
+            self.clips_delivered += 1
+            return True
+        except Exception as e:
+            logger.error(f"Failed to push shared stream clip: {e}")
+            return False
+
+    def _get_description(self, stream: SharedStream) -> str:
+        """Follow the shared story of the video if there is one"""
+        shared_story = self.api.shared_stories.stories.get(stream.video_id)
+        if shared_story:
+            return shared_story.current_description
+        return stream.description
+
+    async def _run(self, stream: SharedStream) -> None:
+        """Generate the clips of a stream on a fixed cadence and push each one to every viewer"""
+        while self.streams.get(stream.video_id) is stream:
+            # No new clips while the server drains, the viewers are about to reconnect elsewhere
+            if self.api.admission.draining:
+                return
+            started = time.time()
+            try:
+                # Each clip goes through the admission control like the clips requested by the viewers
+                retry_after = await self.api.admission.admit_request(stream.user_role)
+                if retry_after is not None:
+                    self.clips_shed += 1
+                    await asyncio.sleep(retry_after)
+                    continue
+
+                options = dict(stream.options)
+                if not options.get('use_fixed_seed'):
+                    options['seed'] = generate_seed()
+
+                video_data = await self.api.generate_video(
+                    stream.title, self._get_description(stream),
+                    stream.video_prompt_prefix, options, stream.user_role
+                )
+
+                if video_data:
+                    self.clips_generated += 1
+                    stream.sequence += 1
+                    message = BroadcastMessage({
+                        'action': 'stream_clip',
+                        'broadcast': True,
+                        'video_id': stream.video_id,
+                        'sequence': stream.sequence,
+                        'video': video_data
+                    })
+                    stream.replay.append(message)
+                    subscribers = list(stream.subscribers)
+                    delivered = await asyncio.gather(*(self._send(ws, message) for ws in subscribers))
+                    # Viewers which can't be reached anymore (eg. disconnected slow consumers) are unsubscribed
+                    for ws, ok in zip(subscribers, delivered):
+                        if not ok:
+                            await self.unsubscribe(stream.video_id, ws)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error generating shared stream clip for video {stream.video_id}: {e}")
+
+            await asyncio.sleep(max(0.0, self.clip_interval - (time.time() - started)))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get the number of shared streams, viewers and clips"""
+        return {
+            'streams': len(self.streams),
+            'subscribers': sum(len(stream.subscribers) for stream in self.streams.values()),
+            'clips_generated': self.clips_generated,
+            'clips_delivered': self.clips_delivered,
+            'clips_shed': self.clips_shed
+        }
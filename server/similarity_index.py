@@ -0,0 +1,186 @@
+"""
+In-process near-duplicate index for short texts such as search queries,
+based on MinHash signatures of character n-grams with LSH banding.
+"""
+import random
+import hashlib
+import logging
+from collections import OrderedDict, defaultdict, deque
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Words which don't change the intent of a search query
+STOPWORDS = {'a', 'an', 'the', 'of', 'some', 'video', 'videos', 'clip', 'clips'}
+
+# Mersenne prime used for the MinHash permutations
+_PRIME = (1 << 61) - 1
+
+
+def get_shingles(text: str, n: int = 3) -> Set[str]:
+    """
+    Get the character n-grams of a normalized text.
+
+    Stopwords are dropped and words are sorted, so that "cat surfing" and
+    "a surfing cat video" share the same shingles. A text made only of stopwords
+    has no shingles, as it says nothing to compare it with other texts.
+    """
+    words = sorted(word for word in text.split() if word not in STOPWORDS)
+    if not words:
+        return set()
+    canonical = f" {' '.join(words)} "
+    if len(canonical) <= n:
+        return {canonical}
+    return {canonical[i:i + n] for i in range(len(canonical) - n + 1)}
+
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    """Exact Jaccard similarity of two sets"""
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class SimilarityIndex:
+    """
+    Bounded LRU index returning the most similar previously added text above a threshold.
+
+    Each text is sketched into a MinHash signature of `bands * rows` values. Candidates
+    are the texts sharing at least one band, and their similarity is estimated
+    as the fraction of equal signature values.
+    """
+
+    def __init__(self, threshold: float = 0.6, max_entries: int = 2000,
+                 bands: int = 16, rows: int = 4, sample_rate: float = 0.05):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.bands = bands
+        self.rows = rows
+        self.sample_rate = sample_rate
+
+        rng = random.Random(42)
+        self.permutations = [
+            (rng.randrange(1, _PRIME), rng.randrange(0, _PRIME))
+            for _ in range(bands * rows)
+        ]
+
+        self.signatures: "OrderedDict[str, Tuple[int, ...]]" = OrderedDict()
+        self.buckets: Dict[Tuple[int, Tuple[int, ...]], Set[str]] = defaultdict(set)
+
+        # Statistics
+        self.lookups = 0
+        self.hits = 0
+        self.sampled = 0
+        self.false_positives = 0
+        self.recent_samples = deque(maxlen=20)
+
+    def _signature(self, text: str) -> Tuple[int, ...]:
+        """Compute the MinHash signature of a text"""
+        hashes = [
+            int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little')
+            for shingle in get_shingles(text)
+        ]
+        return tuple(
+            min((a * h + b) % _PRIME for h in hashes)
+            for a, b in self.permutations
+        )
+
+    def _bands_of(self, signature: Tuple[int, ...]) -> List[Tuple[int, Tuple[int, ...]]]:
+        return [
+            (band, signature[band * self.rows:(band + 1) * self.rows])
+            for band in range(self.bands)
+        ]
+
+    def add(self, text: str) -> None:
+        """
+        Add a text to the index, evicting the least recently used ones if full.
+        Texts without shingles (only stopwords) are not indexed.
+        """
+        if text in self.signatures:
+            self.signatures.move_to_end(text)
+            return
+        if not get_shingles(text):
+            return
+
+        signature = self._signature(text)
+        self.signatures[text] = signature
+        for band_key in self._bands_of(signature):
+            self.buckets[band_key].add(text)
+
+        while len(self.signatures) > self.max_entries:
+            oldest, oldest_signature = self.signatures.popitem(last=False)
+            self._remove_from_buckets(oldest, oldest_signature)
+
+    def remove(self, text: str) -> None:
+        """Remove a text from the index"""
+        signature = self.signatures.pop(text, None)
+        if signature is not None:
+            self._remove_from_buckets(text, signature)
+
+    def _remove_from_buckets(self, text: str, signature: Tuple[int, ...]) -> None:
+        for band_key in self._bands_of(signature):
+            bucket = self.buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(text)
+                if not bucket:
+                    del self.buckets[band_key]
+
+    def find(self, text: str) -> Optional[Tuple[str, float]]:
+        """
+        Find the most similar indexed text, as a tuple (text, estimated similarity),
+        or None if no indexed text reaches the threshold or the text has no shingles.
+        """
+        if not get_shingles(text):
+            return None
+        self.lookups += 1
+        signature = self._signature(text)
+
+        candidates: Set[str] = set()
+        for band_key in self._bands_of(signature):
+            candidates.update(self.buckets.get(band_key, ()))
+        candidates.discard(text)
+
+        best = None
+        best_similarity = 0.0
+        for candidate in candidates:
+            other = self.signatures[candidate]
+            similarity = sum(1 for x, y in zip(signature, other) if x == y) / len(signature)
+            if similarity > best_similarity:
+                best, best_similarity = candidate, similarity
+
+        if best is None or best_similarity < self.threshold:
+            return None
+
+        self.hits += 1
+        self.signatures.move_to_end(best)
+
+        # Check a sample of the hits against the exact similarity, to monitor
+        # how often the MinHash estimate matches texts it shouldn't
+        if random.random() < self.sample_rate:
+            exact = jaccard(get_shingles(text), get_shingles(best))
+            self.sampled += 1
+            if exact < self.threshold:
+                self.false_positives += 1
+            self.recent_samples.append({
+                'query': text,
+                'match': best,
+                'estimated': round(best_similarity, 3),
+                'exact': round(exact, 3)
+            })
+
+        return best, best_similarity
+
+    def get_stats(self, include_samples: bool = False) -> Dict[str, Any]:
+        """Get index statistics, optionally with the recent samples (which contain user queries)"""
+        stats = {
+            'entries': len(self.signatures),
+            'lookups': self.lookups,
+            'hits': self.hits,
+            'hit_rate': self.hits / self.lookups if self.lookups else 0.0,
+            'sampled': self.sampled,
+            'false_positives': self.false_positives,
+            'false_positive_rate': self.false_positives / self.sampled if self.sampled else 0.0,
+        }
+        if include_samples:
+            stats['recent_samples'] = list(self.recent_samples)
+        return stats
@@ -0,0 +1,130 @@
+"""
+Server-managed story state for video simulations, with incremental condensation
+of the scene history and prompt token budgeting.
+"""
+import time
+import uuid
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count of a text (about 4 characters per token for English)"""
+    return (len(text) + 3) // 4
+
+
+def fit_chat_messages(chat_messages: str, max_tokens: int) -> str:
+    """
+    Truncate chat messages (one per line) to a token budget.
+    The most recent messages have priority, so the oldest ones are dropped first.
+    """
+    if max_tokens <= 0 or not chat_messages:
+        return ''
+    kept: List[str] = []
+    used = 0
+    for line in reversed(chat_messages.split('\n')):
+        cost = estimate_tokens(line) + 1
+        if used + cost > max_tokens:
+            break
+        kept.append(line)
+        used += cost
+    return '\n'.join(reversed(kept))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Keep the end of a text within a token budget (the most recent part of a history)"""
+    max_chars = max(0, max_tokens) * 4
+    if len(text) <= max_chars:
+        return text
+    return text[len(text) - max_chars:]
+
+
+@dataclass
+class StoryState:
+    """The evolving story of a simulated video."""
+    story_id: str
+    video_id: str
+    original_title: str
+    original_description: str
+    current_description: str
+    # summary of the scenes which have already been condensed
+    condensed_history: str = ''
+    # scenes evolved since the last condensation, oldest first
+    recent_scenes: List[str] = field(default_factory=list)
+    evolution_count: int = 0
+    last_used: float = field(default_factory=time.time)
+    condensing: bool = False
+    # pinned stories (shared ones, while they have viewers) are never evicted nor expired
+    pinned: bool = False
+
+    def get_history(self) -> str:
+        """Get the history to give to the LLM: the condensed summary followed by the recent scenes"""
+        parts = [self.condensed_history] if self.condensed_history else []
+        # the last recent scene is the current description, which has its own prompt section
+        parts.extend(self.recent_scenes[:-1])
+        return '\n'.join(parts)
+
+
+class StoryStateStore:
+    """Bounded LRU store of story states, expiring the ones unused for a while (unless pinned)."""
+
+    def __init__(self, max_stories: int = 5000, ttl: float = 3600):
+        self.max_stories = max_stories
+        self.ttl = ttl
+        self.stories: "OrderedDict[str, StoryState]" = OrderedDict()
+
+    @staticmethod
+    def build(video_id: str, original_title: str, original_description: str,
+              current_description: str, condensed_history: str = '',
+              evolution_count: int = 0) -> StoryState:
+        """Build a story seeded with what the client knows so far, without storing it"""
+        return StoryState(
+            story_id=str(uuid.uuid4()),
+            video_id=video_id,
+            original_title=original_title,
+            original_description=original_description,
+            current_description=current_description,
+            condensed_history=condensed_history,
+            recent_scenes=[current_description],
+            evolution_count=evolution_count
+        )
+
+    def create(self, video_id: str, original_title: str, original_description: str,
+               current_description: str, condensed_history: str = '',
+               evolution_count: int = 0) -> StoryState:
+        """Create and store a new story, seeded with what the client knows so far"""
+        story = self.build(
+            video_id, original_title, original_description,
+            current_description, condensed_history, evolution_count
+        )
+        self.stories[story.story_id] = story
+        self._evict()
+        return story
+
+    def get(self, story_id: Optional[str]) -> Optional[StoryState]:
+        """Get a story by its handle, or None if it doesn't exist or has expired"""
+        if not story_id:
+            return None
+        story = self.stories.get(story_id)
+        if story is None:
+            return None
+        if not story.pinned and time.time() - story.last_used > self.ttl:
+            del self.stories[story_id]
+            return None
+        story.last_used = time.time()
+        self.stories.move_to_end(story_id)
+        return story
+
+    def _evict(self) -> None:
+        while len(self.stories) > self.max_stories:
+            oldest = next((story_id for story_id, story in self.stories.items() if not story.pinned), None)
+            if oldest is None:
+                return
+            del self.stories[oldest]
+
+    def __len__(self) -> int:
+        return len(self.stories)
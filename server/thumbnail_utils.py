@@ -0,0 +1,138 @@
+"""
+Derivation of thumbnails from already generated clips, with ffmpeg.
+"""
+import os
+import time
+import base64
+import shutil
+import asyncio
+import logging
+import tempfile
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def parse_data_uri(data_uri: str) -> Optional[Tuple[str, bytes]]:
+    """Get the mime type and the content of a base64 data URI, or None if it isn't one"""
+    if not data_uri.startswith('data:'):
+        return None
+    header, _, data = data_uri.partition(',')
+    if not header.endswith(';base64'):
+        return None
+    try:
+        return header[5:-7], base64.b64decode(data)
+    except ValueError:
+        return None
+
+
+class ThumbnailDeriver:
+    """
+    Extracts a poster frame ('image') or a short low-resolution loop ('video') from a clip,
+    running at most max_workers ffmpeg processes at a time.
+    """
+
+    def __init__(self, max_workers: int = 2, output_format: str = 'video', width: int = 512,
+                 duration: float = 1.0, timeout: float = 10.0):
+        self.output_format = output_format
+        self.width = width
+        self.duration = duration
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(max_workers)
+        self.ffmpeg = shutil.which('ffmpeg')
+        if not self.ffmpeg:
+            logger.warning("ffmpeg not found, thumbnails will be generated by the endpoints")
+
+        # Statistics
+        self.derived = 0
+        self.failed = 0
+        self.total_duration = 0.0
+
+    @property
+    def available(self) -> bool:
+        return self.ffmpeg is not None
+
+    def _get_ffmpeg_args(self, input_path: str, output_path: str) -> list:
+        scale = f"scale={self.width}:-2"
+        if self.output_format == 'image':
+            return [self.ffmpeg, '-v', 'error', '-y', '-i', input_path,
+                    '-frames:v', '1', '-vf', scale, '-q:v', '4', output_path]
+        return [self.ffmpeg, '-v', 'error', '-y', '-i', input_path, '-t', str(self.duration),
+                '-vf', scale, '-an', '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '30',
+                '-pix_fmt', 'yuv420p', '-movflags', '+faststart', output_path]
+
+    async def derive(self, video_data_uri: str) -> str:
+        """Derive a thumbnail data URI from a clip data URI, or return "" on failure"""
+        parsed = parse_data_uri(video_data_uri) if self.available else None
+        if not parsed:
+            self.failed += 1
+            return ""
+        _, video_bytes = parsed
+
+        mime_type = 'image/jpeg' if self.output_format == 'image' else 'video/mp4'
+        extension = 'jpg' if self.output_format == 'image' else 'mp4'
+
+        async with self.semaphore:
+            start_time = time.time()
+            try:
+                thumbnail_bytes = await self._run_ffmpeg(video_bytes, extension)
+            except OSError as e:
+                logger.error(f"Failed to run ffmpeg to derive a thumbnail: {e}")
+                thumbnail_bytes = None
+            if not thumbnail_bytes:
+                self.failed += 1
+                return ""
+
+            self.derived += 1
+            self.total_duration += time.time() - start_time
+
+        return f"data:{mime_type};base64,{base64.b64encode(thumbnail_bytes).decode('ascii')}"
+
+    async def _run_ffmpeg(self, video_bytes: bytes, extension: str) -> Optional[bytes]:
+        """Run ffmpeg on a clip, returns the thumbnail or None if ffmpeg failed or timed out"""
+        with tempfile.TemporaryDirectory(prefix='thumbnail-') as tmp_dir:
+            input_path = os.path.join(tmp_dir, 'clip.mp4')
+            output_path = os.path.join(tmp_dir, f"thumbnail.{extension}")
+            await asyncio.to_thread(self._write_file, input_path, video_bytes)
+
+            process = await asyncio.create_subprocess_exec(
+                *self._get_ffmpeg_args(input_path, output_path),
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                _, stderr = await asyncio.wait_for(process.communicate(), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                logger.error(f"ffmpeg timed out deriving a thumbnail (after {self.timeout}s)")
+                return None
+            except asyncio.CancelledError:
+                process.kill()
+                await process.wait()
+                raise
+
+            if process.returncode != 0 or not os.path.exists(output_path):
+                logger.error(f"ffmpeg failed to derive a thumbnail: {stderr.decode(errors='ignore').strip()}")
+                return None
+
+            return await asyncio.to_thread(self._read_file, output_path)
+
+    @staticmethod
+    def _write_file(path: str, data: bytes) -> None:
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    @staticmethod
+    def _read_file(path: str) -> bytes:
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'available': self.available,
+            'format': self.output_format,
+            'derived': self.derived,
+            'failed': self.failed,
+            'avg_duration': self.total_duration / self.derived if self.derived else 0.0
+        }
@@ -128,4 +128,98 @@ def sanitize_yaml_response(response_text: str) -> str:
         else:
             sanitized_lines.append(f'{field}: "No {field} provided"')
     
-    return '\n'.join(sanitized_lines)
\ No newline at end of file
+    return '\n'.join(sanitized_lines)
+
+# Characters removed from tags: non-ASCII, and anything but alphanumerics, spaces and hyphens
+_INVALID_TAG_CHARS = re.compile(r'[^\x00-\x7F]|[^a-zA-Z0-9\s-]')
+
+
+def _unquote(value: str) -> str:
+    """Remove the quotes around a value, and a stray opening or closing quote"""
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'':
+        return value[1:-1]
+    # eg. the LLM continued our prompt ending with 'title: "' and closed the quote
+    for quote in '"\'':
+        if value.count(quote) % 2:
+            if value.startswith(quote):
+                return value[1:]
+            if value.endswith(quote):
+                return value[:-1]
+    return value
+
+
+def parse_search_response(response_text: str) -> dict:
+    """
+    Extract the title, description and tags of a search result from raw LLM text.
+
+    This is a tolerant, single-pass equivalent of sanitize_yaml_response() followed by
+    yaml.safe_load(): it handles code fences, nested "title:" prefixes, multi-line values
+    and missing fields the same way, but never fails on quotes or backslashes in the values.
+    """
+    text = response_text.strip()
+
+    # Remove code block markers
+    if text.startswith("```"):
+        text = text[7:] if text.startswith("```yaml") else text[3:]
+        if text.endswith("```"):
+            text = text[:-3]
+        text = text.strip()
+
+    # The LLM may have repeated the end of our prompt
+    if text.startswith('title: \\"'):
+        text = text[9:].strip()
+
+    # Anything after another code block is commentary
+    text = text.split("```", 1)[0].strip()
+
+    # Remove YAML document markers
+    if text.endswith("..."):
+        text = text[:-3]
+    text = text.replace("---", "")
+
+    result = {}
+    tags = None
+    current_field = 'title'
+    first_line = True
+
+    for line in text.split('\n'):
+        stripped = line.strip()
+        if not stripped:
+            continue
+
+        # The response usually starts with the value of the title (the end of our prompt)
+        if first_line and not stripped.startswith(('title:', 'title :')):
+            stripped = f"title: {stripped}"
+        first_line = False
+
+        if stripped.startswith(('title:', 'description:')):
+            field_name, field_value = stripped.split(':', 1)
+            field_value = _unquote(field_value.strip())
+
+            # Nested title pattern, eg. title: "title: "Something""
+            if field_name == 'title' and field_value.lower().startswith('title:'):
+                field_value = field_value[6:].strip().strip('"\'')
+
+            result[field_name] = field_value
+            current_field = field_name
+
+        elif stripped.startswith('tags:'):
+            tags = []
+            current_field = 'tags'
+
+        elif stripped.startswith('-') and current_field == 'tags':
+            tag = _INVALID_TAG_CHARS.sub('', stripped[1:].strip().strip('"\''))
+            tag = tag.strip().lower().replace(' ', '-')
+            if tag:
+                tags.append(tag)
+
+        elif current_field in result:
+            # Multi-line title or description
+            value = stripped.strip('"\'')
+            if value:
+                result[current_field] = f"{result[current_field]} {value}"
+
+    result.setdefault('title', 'No title provided')
+    result.setdefault('description', 'No description provided')
+    result['tags'] = tags if tags is not None else ['default']
+    return result
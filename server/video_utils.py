@@ -61,7 +61,7 @@ async def generate_video_content_with_inference_endpoints(
         }
 
     # logger.info(f"[{request_id}] Waiting for an available endpoint...")
-    async with endpoint_manager.get_endpoint() as endpoint:
+    async with endpoint_manager.get_endpoint(lane='thumbnail' if is_thumbnail else 'clip') as endpoint:
         # logger.info(f"[{request_id}] Using endpoint {endpoint.id} for generation")
         
         try:
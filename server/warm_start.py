@@ -0,0 +1,111 @@
+"""
+Warm start of the first clips of search results: generations started speculatively
+before the client asks for them, parked until the matching request arrives.
+"""
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class WarmGeneration:
+    """A speculative generation and when it was started."""
+    task: asyncio.Task
+    started_at: float
+
+
+class WarmStartCache:
+    """
+    Short-lived cache of speculative generations, keyed by the exact generation request
+    so a request only gets a result it would have generated itself.
+
+    Generations which expire or get evicted before a request takes them are counted as wasted.
+    """
+
+    def __init__(self, ttl: float = 30, max_entries: int = 200, max_in_flight: int = 2):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_in_flight = max_in_flight
+        self.entries: "OrderedDict[str, WarmGeneration]" = OrderedDict()
+
+        # Statistics
+        self.started = 0
+        self.hits = 0
+        self.wasted = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def _prune(self) -> None:
+        now = time.time()
+        while self.entries:
+            key, generation = next(iter(self.entries.items()))
+            if now - generation.started_at <= self.ttl and len(self.entries) <= self.max_entries:
+                break
+            del self.entries[key]
+            self.wasted += 1
+
+    def in_flight(self) -> int:
+        """Get the number of speculative generations still running"""
+        return sum(1 for generation in self.entries.values() if not generation.task.done())
+
+    def can_start(self, key: str) -> bool:
+        """Check whether a speculative generation may be started for a request"""
+        self._prune()
+        if key in self.entries or self.in_flight() >= self.max_in_flight:
+            self.skipped += 1
+            return False
+        return True
+
+    def put(self, key: str, task: asyncio.Task) -> None:
+        """Park a speculative generation until a request takes it"""
+        # Nobody may ever await it, don't let asyncio complain about its exceptions
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self.entries[key] = WarmGeneration(task=task, started_at=time.time())
+        self.started += 1
+        self._prune()
+
+    async def take(self, key: str) -> Optional[Any]:
+        """
+        Take the speculative generation of a request (waiting for it if it is still running).
+        Returns None if there is none, or if it failed.
+        """
+        self._prune()
+        generation = self.entries.pop(key, None)
+        if generation is None:
+            return None
+
+        try:
+            result = await asyncio.shield(generation.task)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Warm start generation failed: {e}")
+            result = None
+
+        if not result:
+            self.failed += 1
+            return None
+
+        self.hits += 1
+        return result
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get the number of speculative generations used and wasted"""
+        self._prune()
+        finished = self.hits + self.wasted + self.failed
+        return {
+            'entries': len(self.entries),
+            'in_flight': self.in_flight(),
+            'started': self.started,
+            'skipped': self.skipped,
+            'hits': self.hits,
+            'failed': self.failed,
+            'wasted': self.wasted,
+            'hit_rate': self.hits / finished if finished else 0.0,
+            'waste_rate': self.wasted / finished if finished else 0.0
+        }
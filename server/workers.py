@@ -0,0 +1,81 @@
+"""
+Multi-process serving: a supervisor process runs the shared state server and the worker
+processes, which all listen on the same port (SO_REUSEPORT, so the kernel spreads the connections).
+"""
+import os
+import signal
+import asyncio
+import logging
+import tempfile
+import multiprocessing
+from typing import Callable, Dict, Optional
+
+from .shared_state import SharedStateServer
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerSupervisor:
+    """
+    Runs count worker processes until it gets SIGTERM (or SIGINT), which is forwarded to the
+    workers as SIGTERM so they drain before exiting. A worker which exits on its own (after a drain
+    requested through its admin endpoint, or a crash) is started again.
+    """
+
+    def __init__(self, target: Callable[[], None], count: int, socket_path: Optional[str] = None,
+                 restart_delay: float = 1.0):
+        self.target = target
+        self.count = count
+        self.socket_path = socket_path or os.path.join(
+            tempfile.gettempdir(), f'tikslop-shared-state-{os.getpid()}.sock'
+        )
+        self.restart_delay = restart_delay
+        # Workers are started from a fresh interpreter, and read the socket path from their environment
+        self.context = multiprocessing.get_context('spawn')
+        self.processes: Dict[int, multiprocessing.process.BaseProcess] = {}
+        self.stopping = False
+        self.restarts = 0
+
+    async def run(self) -> None:
+        server = SharedStateServer(self.socket_path)
+        await server.start()
+        os.environ['SHARED_STATE_SOCKET'] = self.socket_path
+
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.stop)
+
+        try:
+            await asyncio.gather(*(self._supervise(index) for index in range(self.count)))
+        finally:
+            await server.close()
+        logger.info(f"All workers stopped ({self.restarts} restarts)")
+
+    async def _supervise(self, index: int) -> None:
+        loop = asyncio.get_running_loop()
+        while not self.stopping:
+            process = self.context.Process(target=self.target, name=f'worker-{index}')
+            process.start()
+            self.processes[index] = process
+            logger.info(f"Started worker {index} (pid {process.pid})")
+
+            await loop.run_in_executor(None, process.join)
+            if self.stopping:
+                break
+            self.restarts += 1
+            logger.warning(f"Worker {index} (pid {process.pid}) exited with code {process.exitcode}, "
+                           f"restarting it in {self.restart_delay}s")
+            await asyncio.sleep(self.restart_delay)
+
+    def stop(self) -> None:
+        """Ask the workers to drain and exit"""
+        self.stopping = True
+        logger.info("Stopping the workers...")
+        for process in self.processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+
+def run_workers(target: Callable[[], None], count: int, socket_path: Optional[str] = None) -> None:
+    """Run count worker processes calling target, with the state they share, until stopped"""
+    asyncio.run(WorkerSupervisor(target, count, socket_path).run())
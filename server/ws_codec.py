@@ -0,0 +1,107 @@
+"""
+Encoding of the WebSocket messages: stdlib JSON, a faster JSON encoder (orjson)
+or binary MessagePack frames, chosen per connection.
+"""
+import json
+import logging
+from typing import Any, Dict, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+
+class WebSocketCodec:
+    """Stdlib JSON in text frames."""
+    name = 'json'
+    binary = False
+
+    def encode(self, payload: Any) -> Union[str, bytes]:
+        return json.dumps(payload)
+
+    def decode(self, data: Union[str, bytes]) -> Any:
+        return json.loads(data)
+
+
+class OrjsonCodec(WebSocketCodec):
+    """JSON in text frames, with orjson."""
+    name = 'orjson'
+
+    def encode(self, payload: Any) -> Union[str, bytes]:
+        # Text frames must be sent as str, the decoding is a cheap copy compared to the encoding
+        return orjson.dumps(payload).decode('utf-8')
+
+    def decode(self, data: Union[str, bytes]) -> Any:
+        return orjson.loads(data)
+
+
+class MsgpackCodec(WebSocketCodec):
+    """MessagePack in binary frames."""
+    name = 'msgpack'
+    binary = True
+
+    def encode(self, payload: Any) -> Union[str, bytes]:
+        return msgpack.packb(payload, use_bin_type=True)
+
+    def decode(self, data: Union[str, bytes]) -> Any:
+        if isinstance(data, str):
+            # Clients may still send their requests as JSON text frames
+            return json.loads(data)
+        return msgpack.unpackb(data, raw=False)
+
+
+CODECS: Dict[str, WebSocketCodec] = {'json': WebSocketCodec()}
+if orjson is not None:
+    CODECS['orjson'] = OrjsonCodec()
+if msgpack is not None:
+    CODECS['msgpack'] = MsgpackCodec()
+
+
+def get_codec(name: Optional[str], default: str = 'json') -> WebSocketCodec:
+    """Get a codec by name, falling back to the default one (then stdlib JSON) if it isn't available"""
+    if name and name not in CODECS:
+        logger.warning(f"WebSocket codec '{name}' is not available (installed: {', '.join(CODECS)})")
+    return CODECS.get(name) or CODECS.get(default) or CODECS['json']
+
+
+class BroadcastMessage:
+    """A message sent to many connections, encoded once per codec."""
+
+    def __init__(self, payload: Dict[str, Any]):
+        self.payload = payload
+        self.encoded: Dict[str, Union[str, bytes]] = {}
+
+    def encode(self, codec: WebSocketCodec) -> Union[str, bytes]:
+        data = self.encoded.get(codec.name)
+        if data is None:
+            data = codec.encode(self.payload)
+            self.encoded[codec.name] = data
+        return data
+
+
+async def send_message(ws, payload: Union[Dict[str, Any], BroadcastMessage]) -> None:
+    """
+    Send a message with the codec of a connection (stdlib JSON if it has none),
+    through its outbound queue if it has one
+    """
+    codec = getattr(ws, 'codec', None) or CODECS['json']
+    outbox = getattr(ws, 'outbox', None)
+    if outbox is not None:
+        outbox.put(payload, codec)
+        return
+    if isinstance(payload, BroadcastMessage):
+        data = payload.encode(codec)
+    else:
+        data = codec.encode(payload)
+    if codec.binary:
+        await ws.send_bytes(data)
+    else:
+        await ws.send_str(data)
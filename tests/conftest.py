@@ -0,0 +1,8 @@
+"""
+Tests of the Python server, run from the repository root with: python -m pytest tests
+"""
+import sys
+from pathlib import Path
+
+# Make the server package importable without installing it
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,47 @@
+"""
+Single-flight computations of AsyncTTLCache: a cancelled caller doesn't cancel the computation
+the other callers of the same key are waiting for.
+"""
+import asyncio
+
+import pytest
+
+from server.cache_utils import AsyncTTLCache
+
+
+def test_cancelled_leader_doesnt_cancel_followers():
+    async def main():
+        cache = AsyncTTLCache()
+        computations = []
+
+        async def compute():
+            computations.append(1)
+            await asyncio.sleep(0.05)
+            return 'caption'
+
+        leader = asyncio.create_task(cache.get_or_compute('key', compute))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(cache.get_or_compute('key', compute))
+        await asyncio.sleep(0)
+        leader.cancel()
+
+        assert await follower == 'caption'
+        assert leader.cancelled()
+        assert len(computations) == 1
+        assert cache.get('key') == 'caption'
+        assert cache.in_flight == {}
+    asyncio.run(main())
+
+
+def test_failed_computation_is_retried():
+    async def main():
+        cache = AsyncTTLCache()
+
+        async def fail():
+            raise ValueError('boom')
+
+        with pytest.raises(ValueError):
+            await cache.get_or_compute('key', fail)
+        assert cache.in_flight == {}
+        assert await cache.get_or_compute('key', lambda: asyncio.sleep(0, 'caption')) == 'caption'
+    asyncio.run(main())
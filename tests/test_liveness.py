@@ -0,0 +1,104 @@
+"""
+Liveness of the sessions, through the WebSocket handler of the server: a client which stops
+answering the pings loses its connection, an idle session is reaped, an active one is kept.
+"""
+import time
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web, WSCloseCode, WSMsgType
+from aiohttp.test_utils import TestServer
+
+import api
+from server.liveness import SessionReaper
+
+
+@pytest.fixture
+def session_reaper(monkeypatch):
+    # the heartbeat of the connections is short, the reaping of the idle sessions is triggered by the tests
+    monkeypatch.setattr(api, 'WS_HEARTBEAT_SECONDS', 0.2)
+    reaper = SessionReaper(api.session_manager, api.metrics_tracker, idle_timeout=0.5, interval=3600)
+    monkeypatch.setattr(api, 'session_reaper', reaper)
+    return reaper
+
+
+def run_with_server(test):
+    """Run test(server, client_session) with the WebSocket handler of the server on /ws"""
+    async def main():
+        app = web.Application()
+        app.router.add_get('/ws', api.websocket_handler)
+        server = TestServer(app)
+        await server.start_server()
+        try:
+            async with aiohttp.ClientSession() as client_session:
+                await test(server, client_session)
+        finally:
+            await api.session_manager.close_all_sessions()
+            await server.close()
+    asyncio.run(main())
+
+
+async def receive_until_closed(ws, timeout=5.0):
+    """Read the messages of a client connection until it is closed, returns the last one"""
+    while True:
+        msg = await ws.receive(timeout=timeout)
+        if msg.type in (WSMsgType.CLOSE, WSMsgType.CLOSED, WSMsgType.ERROR):
+            return msg
+
+
+def get_user_sessions(user_ids):
+    return [api.session_manager.sessions.get(user_id) for user_id in user_ids]
+
+
+def test_missed_pong_releases_the_session(session_reaper):
+    async def test(server, client_session):
+        existing = set(api.session_manager.sessions)
+        # without autoping, the client never answers the pings of the server
+        ws = await client_session.ws_connect(server.make_url('/ws'), autoping=False)
+        await ws.receive_json()  # session token
+        (user_id,) = set(api.session_manager.sessions) - existing
+
+        await receive_until_closed(ws)
+        deadline = time.time() + 5
+        while session_reaper.reaped['missed_pong'] == 0:
+            assert time.time() < deadline, 'session was not released'
+            await asyncio.sleep(0.05)
+
+        session = api.session_manager.sessions.get(user_id)
+        # kept for the resume grace period, without its connection
+        assert session is None or session.detached_at is not None
+        assert session_reaper.reclaimed_bytes > 0
+    run_with_server(test)
+
+
+def test_idle_session_is_reaped_and_active_one_kept(session_reaper):
+    async def test(server, client_session):
+        existing = set(api.session_manager.sessions)
+        idle_ws = await client_session.ws_connect(server.make_url('/ws'))
+        await idle_ws.receive_json()
+        (idle_user_id,) = set(api.session_manager.sessions) - existing
+        active_ws = await client_session.ws_connect(server.make_url('/ws'))
+        await active_ws.receive_json()
+        (active_user_id,) = set(api.session_manager.sessions) - existing - {idle_user_id}
+
+        # both clients answer the pings (while they read), only one of them sends messages
+        idle_closed = asyncio.create_task(receive_until_closed(idle_ws))
+        for _ in range(15):
+            await active_ws.send_json({'action': 'heartbeat', 'requestId': 'heartbeat'})
+            await active_ws.receive_json()
+            await asyncio.sleep(0.05)
+
+        assert await session_reaper.reap_idle_sessions() == 1
+        msg = await idle_closed
+        assert msg.type == WSMsgType.CLOSE and msg.data == WSCloseCode.GOING_AWAY
+
+        idle_session, active_session = get_user_sessions((idle_user_id, active_user_id))
+        assert idle_session is None
+        assert active_session is not None and active_session.detached_at is None
+        assert session_reaper.reaped == {'idle': 1, 'missed_pong': 0}
+
+        await active_ws.send_json({'action': 'heartbeat', 'requestId': 'heartbeat'})
+        assert (await active_ws.receive_json())['action'] == 'heartbeat'
+        await active_ws.close()
+    run_with_server(test)
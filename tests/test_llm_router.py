@@ -0,0 +1,72 @@
+"""
+LLM provider router: errors of a provider, including ValueErrors raised by the client,
+fail over to the next provider, only the configuration errors are raised right away.
+"""
+import json
+import asyncio
+
+import pytest
+
+from server import llm_utils
+from server.llm_utils import LLMConfigurationError, LLMProviderRouter, LLMProviderState
+
+ROUTE = {'model': 'model'}
+REAL_GET_CLIENT = LLMProviderState.get_client
+
+
+@pytest.fixture
+def fake_providers(monkeypatch):
+    """Each provider answers with its own outcome: a text, or an exception which is raised"""
+    outcomes = {}
+
+    async def generate_with_client(client, prompt, model, max_new_tokens, temperature, call_info=None):
+        outcome = outcomes[client]
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(llm_utils, 'HF_TOKEN', 'token')
+    monkeypatch.setattr(LLMProviderState, 'get_client', lambda state: state.provider)
+    monkeypatch.setattr(llm_utils, '_generate_text_with_client', generate_with_client)
+    return outcomes
+
+
+def generate(router):
+    return asyncio.run(router.generate('prompt', ROUTE, 10, 0.7, timeout=5))
+
+
+@pytest.mark.parametrize('error', [
+    json.JSONDecodeError('Expecting value', '', 0),
+    ValueError("Model 'model' is not supported by provider 'primary'"),
+    RuntimeError('HTTP 503'),
+], ids=['json', 'value', 'runtime'])
+def test_provider_errors_fail_over(fake_providers, error):
+    fake_providers.update({'primary': error, 'secondary': 'text'})
+    router = LLMProviderRouter(['primary', 'secondary'])
+
+    text, state, fallback = generate(router)
+    assert (text, state.provider, fallback) == ('text', 'secondary', True)
+    assert router.states[0].failures == router.states[0].consecutive_failures == 1
+
+
+def test_failing_provider_opens_its_circuit(fake_providers, monkeypatch):
+    monkeypatch.setattr(llm_utils, 'LLM_CIRCUIT_FAILURE_THRESHOLD', 2)
+    fake_providers.update({'primary': ValueError('bad response'), 'secondary': 'text'})
+    router = LLMProviderRouter(['primary', 'secondary'])
+
+    generate(router)
+    generate(router)
+    assert router.states[0].circuit == 'open'
+    assert [state.provider for state in router.get_candidates()] == ['secondary']
+
+
+def test_configuration_error_is_raised(fake_providers, monkeypatch):
+    # the real clients, which can't be created without the server's token
+    monkeypatch.setattr(LLMProviderState, 'get_client', REAL_GET_CLIENT)
+    monkeypatch.setattr(llm_utils, 'HF_TOKEN', None)
+    fake_providers.update({'primary': 'text', 'secondary': 'text'})
+    router = LLMProviderRouter(['primary', 'secondary'])
+
+    with pytest.raises(LLMConfigurationError):
+        generate(router)
+    assert all(state.failures == 0 for state in router.states)
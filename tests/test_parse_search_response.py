@@ -0,0 +1,92 @@
+"""
+parse_search_response against the pipeline it replaced, yaml.safe_load(sanitize_yaml_response(...)),
+on a corpus of LLM responses: the results must be the same, except for the cases listed below.
+"""
+import pytest
+
+yaml = pytest.importorskip('yaml')
+
+from server.utils import parse_search_response, sanitize_yaml_response
+
+CORPUS = {
+    'closed_title': 'title: "A cat surfing at sunset"\ndescription: "A tabby rides the waves"\ntags:\n  - cat\n  - surf',
+    'fenced_yaml': '```yaml\ntitle: "Robot chef"\ndescription: "A robot cooks pasta"\ntags:\n  - robot\n  - cooking\n```',
+    'fenced_plain': '```\ntitle: "Robot chef"\ndescription: "A robot cooks pasta"\ntags:\n  - robot\n```',
+    'nested_title': 'title: "title: "Space Cats""\ndescription: "Cats in orbit"\ntags:\n  - space',
+    'missing_tags': 'title: "Quiet lake"\ndescription: "Mist over a lake at dawn"',
+    'missing_description': 'title: "Quiet lake"\ntags:\n  - lake',
+    'document_markers': '---\ntitle: "Desert road"\ndescription: "An empty road"\ntags:\n  - desert\n...',
+    'tag_cleanup': 'title: "Pets"\ndescription: "Pets playing"\ntags:\n  - Cats & Dogs!\n  - "Golden Retriever"\n  - café',
+    'trailing_commentary': 'title: "Old train"\ndescription: "A steam train"\ntags:\n  - train\n```\nHere is your result!',
+    'unquoted_values': 'title: Northern lights\ndescription: Green lights over snow\ntags:\n  - aurora',
+    'single_quotes': "title: 'Tiny house'\ndescription: 'A tiny house in the woods'\ntags:\n  - house",
+    'inner_quotes': 'title: "He said "hi""\ndescription: "A friendly greeting"\ntags:\n  - hello',
+    'colon_in_value': 'title: "Tea time: the sequel"\ndescription: "Tea: hot"\ntags:\n  - tea',
+    'blank_lines': '\n\ntitle: "Spaced"\n\ndescription: "Out"\n\ntags:\n\n  - space\n',
+}
+
+# The responses parsed differently on purpose, with the result of parse_search_response
+INTENTIONAL_CHANGES = {
+    # the stray closing quote of the title (the prompt ends with an opening one) was kept in the title
+    'stray_closing_quote': (
+        'Neon city"\ndescription: "Rain on neon signs"\ntags:\n  - city',
+        {'title': 'Neon city', 'description': 'Rain on neon signs', 'tags': ['city']}
+    ),
+    'prompt_prefix': (
+        'title: \\"Neon city"\ndescription: "Rain on neon signs"\ntags:\n  - city',
+        {'title': 'Neon city', 'description': 'Rain on neon signs', 'tags': ['city']}
+    ),
+    # the opening quote of a multi-line description was kept in the description
+    'multiline_description': (
+        'title: "Lava lamp"\ndescription: "A slow lava lamp\n  glowing in a dark room\n  at night"\ntags:\n  - lamp',
+        {'title': 'Lava lamp', 'description': 'A slow lava lamp glowing in a dark room at night', 'tags': ['lamp']}
+    ),
+    # backslashes were read as escape sequences of a double-quoted YAML string, and failed
+    'backslash': (
+        'title: "Windows path"\ndescription: "Files in C:\\Users\\cat"\ntags:\n  - pc',
+        {'title': 'Windows path', 'description': 'Files in C:\\Users\\cat', 'tags': ['pc']}
+    ),
+    # nested single quotes failed to parse
+    'nested_title_single_quotes': (
+        "title: 'title: 'Space Cats''\ndescription: \"Cats in orbit\"\ntags:\n  - space",
+        {'title': 'Space Cats', 'description': 'Cats in orbit', 'tags': ['space']}
+    ),
+    # tags are always strings, YAML made numbers of them
+    'numeric_tag': (
+        'title: "Year"\ndescription: "Party"\ntags:\n  - 2024',
+        {'title': 'Year', 'description': 'Party', 'tags': ['2024']}
+    ),
+}
+
+
+def legacy_parse(text):
+    return yaml.safe_load(sanitize_yaml_response(text.strip()))
+
+
+@pytest.mark.parametrize('name', sorted(CORPUS))
+def test_same_result_as_yaml_pipeline(name):
+    text = CORPUS[name]
+    assert parse_search_response(text) == legacy_parse(text)
+
+
+@pytest.mark.parametrize('name', sorted(INTENTIONAL_CHANGES))
+def test_intentional_changes(name):
+    text, expected = INTENTIONAL_CHANGES[name]
+    try:
+        legacy = legacy_parse(text)
+    except yaml.YAMLError:
+        legacy = None
+    assert legacy != expected
+    assert parse_search_response(text) == expected
+
+
+def test_stray_closing_quote_kept_by_yaml_pipeline():
+    text, _ = INTENTIONAL_CHANGES['stray_closing_quote']
+    assert legacy_parse(text)['title'] == 'Neon city"'
+    assert parse_search_response(text)['title'] == 'Neon city'
+
+
+def test_backslash_failed_in_yaml_pipeline():
+    text, _ = INTENTIONAL_CHANGES['backslash']
+    with pytest.raises(yaml.YAMLError):
+        legacy_parse(text)
@@ -0,0 +1,31 @@
+"""
+Adaptive race width: a model starts with a single attempt, and is only raced
+once failures of its attempts have been observed.
+"""
+from server.racing import AdaptiveRaceWidth
+
+
+def test_new_model_is_not_raced():
+    race_width = AdaptiveRaceWidth(max_width=3, target_failure=0.1)
+    assert race_width.get_width('model') == 1
+
+    for _ in range(20):
+        race_width.record('model', success=True)
+    assert race_width.get_width('model') == 1
+
+
+def test_width_grows_with_failures_and_shrinks_back():
+    race_width = AdaptiveRaceWidth(max_width=3, target_failure=0.1)
+
+    widths = []
+    for _ in range(10):
+        race_width.record('model', success=False)
+        widths.append(race_width.get_width('model'))
+    # a single failure stays within the target, repeated ones widen the race up to the maximum
+    assert widths[0] == 1
+    assert widths == sorted(widths) and widths[-1] == 3
+
+    for _ in range(50):
+        race_width.record('model', success=True)
+    assert race_width.get_width('model') == 1
+    assert race_width.get_width('other-model') == 1
@@ -0,0 +1,50 @@
+"""
+Search cache: the near-duplicate variants of a query fill and share a single pool, and
+queries made only of stopwords are never matched with each other.
+"""
+from server.search_cache import SearchCache
+from server.similarity_index import SimilarityIndex, get_shingles
+
+
+def make_result(title):
+    return {'id': title, 'title': title, 'description': f'{title} description'}
+
+
+def test_near_duplicate_misses_fill_the_canonical_pool():
+    cache = SearchCache(pool_size=4, similarity_index=SimilarityIndex(threshold=0.6))
+    cache.add('cat surfing', make_result('result-0'))
+
+    # the pool isn't full yet: the variants miss, and their results go to the same pool
+    for i, query in enumerate(('A surfing cat video', 'the cat surfing', 'surfing cat'), start=1):
+        assert cache.get(query) is None
+        cache.add(query, make_result(f'result-{i}'))
+
+    assert list(cache.pools) == ['cat surfing']
+    assert len(cache.pools['cat surfing'].results) == 4
+
+    served = {cache.get(query)['title'] for query in ('cat surfing', 'surfing cat', 'a surfing cat video', 'the cat surfing')}
+    assert served == {f'result-{i}' for i in range(4)}
+    assert cache.near_hits == 3
+
+
+def test_distinct_queries_keep_their_own_pool():
+    cache = SearchCache(pool_size=2, similarity_index=SimilarityIndex(threshold=0.6))
+    cache.add('cat surfing', make_result('cat'))
+    cache.add('dog skiing in the alps', make_result('dog'))
+    assert set(cache.pools) == {'cat surfing', 'dog skiing in the alps'}
+
+
+def test_stopword_only_queries_are_not_matched():
+    assert get_shingles('the video') == set()
+
+    index = SimilarityIndex(threshold=0.6)
+    index.add('the video')
+    assert index.find('a clip') is None
+    assert index.get_stats()['entries'] == 0
+
+    cache = SearchCache(pool_size=1, similarity_index=index)
+    cache.add('the video', make_result('the video'))
+    cache.add('some clips', make_result('some clips'))
+    assert set(cache.pools) == {'the video', 'some clips'}
+    assert cache.get('a clip') is None
+    assert cache.get('the video')['title'] == 'the video'
@@ -0,0 +1,223 @@
+"""
+State shared by the worker processes of the multi-process mode: a shared state server with
+two worker clients in the same process, then real worker processes started by the supervisor.
+"""
+import os
+import sys
+import time
+import signal
+import socket
+import asyncio
+
+import pytest
+
+from server import endpoint_manager as endpoint_manager_module
+from server.admission import AdmissionController
+from server.api_metrics import MetricsTracker
+from server.chat import ChatManager
+from server.endpoint_manager import SharedEndpointManager
+from server.shared_state import SharedStateClient, SharedStateServer
+from server.workers import WorkerSupervisor
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send_str(self, data):
+        self.sent.append(data)
+
+
+@pytest.fixture(autouse=True)
+def endpoints(monkeypatch):
+    monkeypatch.setattr(endpoint_manager_module, 'VIDEO_ROUND_ROBIN_ENDPOINT_URLS',
+                        ['http://endpoint-1', 'http://endpoint-2', 'http://endpoint-3'])
+
+
+def run_with_workers(test, tmp_path):
+    """Run test(server, worker1, worker2) with a shared state server and two connected clients"""
+    async def main():
+        path = str(tmp_path / 'shared-state.sock')
+        server = SharedStateServer(path)
+        await server.start()
+        workers = [SharedStateClient(path), SharedStateClient(path)]
+        try:
+            await test(server, *workers)
+        finally:
+            for worker in workers:
+                await worker.close()
+            await server.close()
+    asyncio.run(main())
+
+
+async def wait_for(condition, timeout=2.0):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        await asyncio.sleep(0.01)
+
+
+def test_endpoints_are_shared(tmp_path):
+    async def test(server, worker1, worker2):
+        endpoints1, endpoints2 = SharedEndpointManager(worker1), SharedEndpointManager(worker2)
+        await worker1.connect()
+        await worker2.connect()
+
+        first = await endpoints1.acquire()
+        second = await endpoints2.acquire()
+        assert first.id != second.id
+        assert server.endpoint_manager.in_flight == 2
+
+        # the other worker mirrors the busy and error states once pushed
+        await endpoints2.mark_endpoint_error(second)
+        await wait_for(lambda: endpoints1.endpoints[second.id - 1].error_until > time.time())
+        third = await endpoints1.acquire()
+        assert third.id not in (first.id, second.id)
+
+        for endpoints, endpoint in ((endpoints1, first), (endpoints2, second), (endpoints1, third)):
+            await endpoints.release(endpoint)
+        assert server.endpoint_manager.in_flight == 0
+        await wait_for(lambda: not any(ep.busy for ep in endpoints2.endpoints))
+    run_with_workers(test, tmp_path)
+
+
+def test_admission_counts_generations_of_all_workers(tmp_path):
+    async def test(server, worker1, worker2):
+        endpoints1, endpoints2 = SharedEndpointManager(worker1), SharedEndpointManager(worker2)
+        await worker1.connect()
+        await worker2.connect()
+        await endpoints2.sync()
+        admission = AdmissionController(endpoints2, thresholds={'anon': 0.5}, generations_per_endpoint=1)
+
+        held = [await endpoints1.acquire() for _ in range(2)]
+        await wait_for(lambda: endpoints2.get_in_flight_generations() == 2)
+        assert endpoints2.in_flight == 0
+        assert admission.get_load()['in_flight_generations'] == 2
+        assert admission.admit_session('anon') is not None
+
+        for endpoint in held:
+            await endpoints1.release(endpoint)
+        await wait_for(lambda: endpoints2.get_in_flight_generations() == 0)
+        assert admission.admit_session('anon') is None
+    run_with_workers(test, tmp_path)
+
+
+def test_chat_messages_reach_the_other_workers(tmp_path):
+    async def test(server, worker1, worker2):
+        chat1, chat2 = ChatManager(worker1), ChatManager(worker2)
+        await worker1.connect()
+        await worker2.connect()
+        sender, receiver = FakeWebSocket(), FakeWebSocket()
+        await chat1.handle_join_chat({'videoId': 'video', 'requestId': 'join'}, sender)
+        await chat2.handle_join_chat({'videoId': 'video', 'requestId': 'join'}, receiver)
+
+        await chat1.handle_chat_message(
+            {'videoId': 'video', 'requestId': 'message', 'content': 'hello', 'username': 'someone'}, sender
+        )
+        await wait_for(lambda: receiver.sent)
+        assert 'hello' in receiver.sent[0]
+        assert not sender.sent
+    run_with_workers(test, tmp_path)
+
+
+def test_rate_limits_are_shared(tmp_path):
+    async def test(server, worker1, worker2):
+        metrics1, metrics2 = MetricsTracker(worker1), MetricsTracker(worker2)
+        await worker1.connect()
+        await worker2.connect()
+        for metrics in (metrics1, metrics2):
+            metrics.rate_limits['anon']['video'] = 7
+
+        # the rate weights the current minute by 0.7, so 10 requests reach the limit
+        for index in range(10):
+            assert not await metrics1.is_rate_limited('user', 'video', 'anon')
+            await (metrics1 if index % 2 else metrics2).record_request('user', 'ip', 'video', 'anon')
+        assert await metrics1.is_rate_limited('user', 'video', 'anon')
+        assert await metrics2.is_rate_limited('user', 'video', 'anon')
+        assert not await metrics2.is_rate_limited('other-user', 'video', 'anon')
+    run_with_workers(test, tmp_path)
+
+
+def test_lost_worker_releases_what_it_held(tmp_path):
+    async def test(server, worker1, worker2):
+        endpoints1, endpoints2 = SharedEndpointManager(worker1), SharedEndpointManager(worker2)
+        await worker1.connect()
+        await worker2.connect()
+        await worker1.request('gauge', key='anon:ip', delta=1)
+        await worker2.request('gauge', key='anon:ip', delta=1)
+        await endpoints2.acquire()
+        await wait_for(lambda: endpoints1.get_in_flight_generations() == 1)
+
+        await worker2.close()
+        await wait_for(lambda: server.endpoint_manager.in_flight == 0)
+        assert await worker1.request('gauge', key='anon:ip', delta=0) == 1
+        await wait_for(lambda: endpoints1.get_in_flight_generations() == 0)
+        with pytest.raises(ConnectionError):
+            await worker2.request('get', keys=['key'])
+    run_with_workers(test, tmp_path)
+
+
+def serve_worker():
+    """Worker process answering its pid on the shared port, counted in the 'workers' gauge"""
+    from server.shared_state import shared_state
+
+    async def answer(reader, writer):
+        writer.write(f'{os.getpid()}\n'.encode())
+        await writer.drain()
+        writer.close()
+
+    async def main():
+        await shared_state.connect()
+        await shared_state.request('gauge', key='workers', delta=1)
+        server = await asyncio.start_server(answer, '127.0.0.1', int(os.environ['TEST_WORKER_PORT']), reuse_port=True)
+        stopped = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set)
+        await stopped.wait()
+        server.close()
+    asyncio.run(main())
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='SO_REUSEPORT spreads connections on Linux')
+def test_worker_processes_share_the_port(tmp_path, monkeypatch):
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    monkeypatch.setenv('TEST_WORKER_PORT', str(port))
+    monkeypatch.delenv('SHARED_STATE_SOCKET', raising=False)
+
+    async def get_pid():
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        pid = int(await reader.readline())
+        writer.close()
+        return pid
+
+    async def main():
+        supervisor = WorkerSupervisor(serve_worker, 2, str(tmp_path / 'shared-state.sock'), restart_delay=0.1)
+        supervision = asyncio.create_task(supervisor.run())
+        client = SharedStateClient(supervisor.socket_path)
+        try:
+            await client.connect()
+
+            async def count_workers():
+                return await client.request('gauge', key='workers', delta=0)
+
+            deadline = time.time() + 30
+            while await count_workers() != 2:
+                assert time.time() < deadline, 'workers did not start'
+                await asyncio.sleep(0.1)
+            pids = {await get_pid() for _ in range(50)}
+            assert pids == {process.pid for process in supervisor.processes.values()}
+
+            # a crashed worker is started again, and what it held is released meanwhile
+            crashed = supervisor.processes[0].pid
+            os.kill(crashed, signal.SIGKILL)
+            while supervisor.processes[0].pid == crashed or await count_workers() != 2:
+                assert time.time() < deadline, 'worker was not restarted'
+                await asyncio.sleep(0.1)
+            assert supervisor.restarts == 1
+        finally:
+            await client.close()
+            supervisor.stop()
+            await asyncio.wait_for(supervision, timeout=10)
+        assert not any(process.is_alive() for process in supervisor.processes.values())
+    asyncio.run(main())
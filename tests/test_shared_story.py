@@ -0,0 +1,110 @@
+"""
+Shared stories stop evolving, and are unpinned from the story store, as soon as their last
+viewer is gone (including the viewers whose connection failed). They go through the admission
+control, and are limited per session.
+"""
+import asyncio
+
+from server.api_session import SessionManager
+from server.chat import ChatManager
+from server.shared_story import SharedStoryManager
+from server.story_state import StoryStateStore
+
+
+class FakeAdmission:
+    def __init__(self):
+        self.draining = False
+        self.retry_after = None
+        self.requests = 0
+
+    async def admit_request(self, user_role):
+        self.requests += 1
+        return self.retry_after
+
+
+class FakeAPI:
+    def __init__(self):
+        self.admission = FakeAdmission()
+        self.story_states = StoryStateStore()
+        self.chat_manager = ChatManager()
+        self.simulations = 0
+
+    async def simulate(self, story_id, current_description, **kwargs):
+        self.simulations += 1
+        return {'story_id': story_id, 'evolved_description': current_description + ' and then'}
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send_str(self, data):
+        self.sent.append(data)
+
+
+class ClosedWebSocket:
+    """Connection whose outbound queue was closed (a slow consumer which got disconnected)"""
+
+    async def send_str(self, data):
+        raise ConnectionResetError('Connection closed')
+
+
+def test_story_stops_when_its_only_viewer_fails():
+    async def main():
+        api = FakeAPI()
+        manager = SharedStoryManager(api, interval=0.01)
+        result = await manager.subscribe('video', ClosedWebSocket(), 'title', 'description', 'anon')
+        task = manager.stories['video'].task
+
+        await asyncio.wait_for(task, timeout=1)
+        await asyncio.sleep(0.05)
+        assert manager.stories == {}
+        assert api.simulations == 1
+        assert not api.story_states.get(result['story_id']).pinned
+    asyncio.run(main())
+
+
+def test_story_evolutions_go_through_admission():
+    async def main():
+        api = FakeAPI()
+        api.admission.retry_after = 0.01
+        manager = SharedStoryManager(api, interval=0.01)
+        ws = FakeWebSocket()
+        await manager.subscribe('video', ws, 'title', 'description', 'anon')
+
+        await asyncio.sleep(0.1)
+        assert api.admission.requests > 1
+        assert api.simulations == 0
+        assert manager.evolutions_shed == api.admission.requests
+
+        api.admission.retry_after = None
+        await asyncio.sleep(0.1)
+        assert api.simulations > 0 and ws.sent
+        await manager.unsubscribe('video', ws)
+    asyncio.run(main())
+
+
+def test_shared_stories_limited_per_session():
+    async def main():
+        session_manager = SessionManager()
+        shared_stories = session_manager.shared_api.shared_stories
+
+        async def run(shared):
+            await asyncio.Event().wait()
+        shared_stories._run = run
+
+        session = await session_manager.create_session('user', 'anon', FakeWebSocket())
+        responses = []
+        for video_id in ('video-1', 'video-1', 'video-2'):
+            responses.append(await session._handle_subscribe_story({
+                'action': 'subscribe_story', 'video_id': video_id,
+                'original_title': 'title', 'original_description': 'description'
+            }))
+        # subscribing again to the same story doesn't count
+        assert [response['success'] for response in responses] == [True, True, False]
+        assert 'Too many shared stories' in responses[2]['error']
+        assert list(shared_stories.stories) == ['video-1']
+
+        await session_manager.close_all_sessions()
+        assert shared_stories.stories == {}
+    asyncio.run(main())
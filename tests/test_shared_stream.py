@@ -0,0 +1,106 @@
+"""
+Shared streams stop generating as soon as their last viewer is gone (including the viewers
+whose connection failed), go through the admission control, and are limited per session.
+"""
+import asyncio
+from types import SimpleNamespace
+
+from server.api_session import SessionManager
+from server.shared_stream import SharedStreamManager
+
+
+class FakeAdmission:
+    def __init__(self):
+        self.draining = False
+        self.retry_after = None
+        self.requests = 0
+
+    async def admit_request(self, user_role):
+        self.requests += 1
+        return self.retry_after
+
+
+class FakeAPI:
+    def __init__(self):
+        self.admission = FakeAdmission()
+        self.shared_stories = SimpleNamespace(stories={})
+        self.generations = 0
+
+    async def generate_video(self, title, description, video_prompt_prefix, options, user_role):
+        self.generations += 1
+        return 'data:video/mp4;base64,AAAA'
+
+
+class ClosedWebSocket:
+    """Connection whose outbound queue was closed (a slow consumer which got disconnected)"""
+
+    async def send_str(self, data):
+        raise ConnectionResetError('Connection closed')
+
+
+def test_stream_stops_when_its_only_viewer_fails():
+    async def main():
+        api = FakeAPI()
+        manager = SharedStreamManager(api, clip_interval=0.01)
+        await manager.subscribe('video', ClosedWebSocket(), 'title', 'description', '', {}, 'anon')
+        task = manager.streams['video'].task
+
+        await asyncio.wait_for(task, timeout=1)
+        generations = api.generations
+        await asyncio.sleep(0.05)
+        assert manager.streams == {}
+        assert api.generations == generations == 1
+    asyncio.run(main())
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send_str(self, data):
+        self.sent.append(data)
+
+
+def test_stream_clips_go_through_admission():
+    async def main():
+        api = FakeAPI()
+        api.admission.retry_after = 0.01
+        manager = SharedStreamManager(api, clip_interval=0.01)
+        ws = FakeWebSocket()
+        await manager.subscribe('video', ws, 'title', 'description', '', {}, 'anon')
+
+        await asyncio.sleep(0.1)
+        assert api.admission.requests > 1
+        assert api.generations == 0
+        assert manager.clips_shed == api.admission.requests
+
+        api.admission.retry_after = None
+        await asyncio.sleep(0.1)
+        assert api.generations > 0 and ws.sent
+        await manager.unsubscribe('video', ws)
+    asyncio.run(main())
+
+
+def test_shared_streams_limited_per_session():
+    async def main():
+        session_manager = SessionManager()
+        shared_streams = session_manager.shared_api.shared_streams
+
+        async def run(stream):
+            await asyncio.Event().wait()
+        shared_streams._run = run
+
+        session = await session_manager.create_session('user', 'anon', FakeWebSocket())
+        responses = []
+        for video_id in ('video-1', 'video-1', 'video-2'):
+            responses.append(await session._handle_subscribe_stream({
+                'action': 'subscribe_stream', 'video_id': video_id, 'title': 'title', 'description': 'description'
+            }))
+        # subscribing again to the same stream doesn't count
+        assert [response['success'] for response in responses] == [True, True, False]
+        assert 'Too many shared streams' in responses[2]['error']
+        assert list(shared_streams.streams) == ['video-1']
+
+        await session_manager.close_all_sessions()
+        assert shared_streams.streams == {}
+    asyncio.run(main())
@@ -0,0 +1,42 @@
+"""
+Thumbnail derivation never fails the request: when ffmpeg fails or times out, derive returns ""
+so the thumbnail is generated by an endpoint instead.
+"""
+import asyncio
+import base64
+import sys
+
+import pytest
+
+from server.thumbnail_utils import ThumbnailDeriver
+
+CLIP = 'data:video/mp4;base64,' + base64.b64encode(b'not really a clip').decode('ascii')
+
+
+@pytest.fixture
+def fake_ffmpeg(tmp_path):
+    """Write an executable standing in for ffmpeg, running the given shell commands"""
+    def write(commands):
+        path = tmp_path / 'ffmpeg'
+        path.write_text(f'#!/bin/sh\n{commands}\n')
+        path.chmod(0o755)
+        return str(path)
+    return write
+
+
+@pytest.mark.skipif(sys.platform.startswith('win'), reason='uses a shell script as ffmpeg')
+@pytest.mark.parametrize('commands', ['exec sleep 5', 'exit 1'], ids=['timeout', 'error'])
+def test_derive_returns_empty_string_on_failure(fake_ffmpeg, commands):
+    deriver = ThumbnailDeriver(timeout=0.2)
+    deriver.ffmpeg = fake_ffmpeg(commands)
+
+    assert asyncio.run(deriver.derive(CLIP)) == ''
+    assert deriver.failed == 1 and deriver.derived == 0
+
+
+def test_derive_returns_empty_string_when_ffmpeg_is_missing(tmp_path):
+    deriver = ThumbnailDeriver()
+    deriver.ffmpeg = str(tmp_path / 'missing-ffmpeg')
+
+    assert asyncio.run(deriver.derive(CLIP)) == ''
+    assert deriver.failed == 1
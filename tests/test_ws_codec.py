@@ -0,0 +1,52 @@
+"""
+WebSocket codecs: every installed codec round-trips the messages of the protocol, and a
+broadcast is encoded once per codec.
+"""
+import json
+
+import pytest
+
+from server.ws_codec import CODECS, BroadcastMessage, get_codec
+
+MESSAGES = [
+    {'action': 'heartbeat', 'requestId': 'request-1', 'success': True, 'user_role': 'anon'},
+    {'action': 'chat_message', 'broadcast': True, 'videoId': 'video-1', 'content': 'what a strange cat 🐱'},
+    {'action': 'search', 'success': True, 'result': {'title': 'A "cat"', 'tags': ['cat', 'surf'], 'seed': 2**40}},
+    {'action': 'generate_video', 'success': False, 'error': None, 'progress': 0.5, 'clips': []},
+]
+
+
+@pytest.fixture(params=['json', 'orjson', 'msgpack'])
+def codec(request):
+    if request.param != 'json':
+        pytest.importorskip(request.param)
+    return CODECS[request.param]
+
+
+@pytest.mark.parametrize('message', MESSAGES, ids=[message['action'] for message in MESSAGES])
+def test_round_trip(codec, message):
+    data = codec.encode(message)
+    assert isinstance(data, bytes if codec.binary else str)
+    assert codec.decode(data) == message
+
+
+def test_json_requests_decoded_by_every_codec(codec):
+    # clients may send their requests as JSON text frames whatever the codec of their responses
+    assert codec.decode(json.dumps(MESSAGES[0])) == MESSAGES[0]
+
+
+def test_broadcast_encoded_once_per_codec(codec, monkeypatch):
+    calls = []
+    encode = codec.encode
+    monkeypatch.setattr(codec, 'encode', lambda payload: calls.append(payload) or encode(payload))
+
+    broadcast = BroadcastMessage(MESSAGES[1])
+    encoded = [broadcast.encode(codec) for _ in range(10)]
+    assert len(calls) == 1
+    assert all(data is encoded[0] for data in encoded)
+    assert codec.decode(encoded[0]) == MESSAGES[1]
+
+
+def test_unknown_codec_falls_back():
+    assert get_codec('unknown', 'json') is CODECS['json']
+    assert get_codec(None, 'unknown') is CODECS['json']